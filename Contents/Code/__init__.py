@@ -1,7 +1,7 @@
 # -*- encoding: utf-8 -*-
 if None:
     from nonexistent import HTTP, Prefs, Thread, Proxy, MetadataSearchResult  # NOQA
-    from nonexistent import Locale, Agent, Dict
+    from nonexistent import Locale, Agent, Dict, Core
 
     def Log(msg):
         print msg
@@ -21,14 +21,26 @@ OLD_ANIDB_PIC_URL_BASE = "http://img7.anidb.net/pics/anime/"
 
 IDLE_TIMEOUT = timedelta(seconds=60 * 30)
 
+# Guards setting up and closing CONNECTION, which takes round trips to the
+# API: nothing else should wait on it
 LOCK = threading.RLock()
 
 CONNECTION = None
+HASH_INDEX = None
+RATE_LIMITER = None
+PRE_HASHER = None
+CIRCUIT_BREAKER = None
+METRICS = None
 LAST_ACCESS = None
-LAST_COOLDOWN = None
 INITIAL_COOLDOWN = timedelta(hours=1)
 COOLDOWN_CAP = timedelta(hours=48)
 
+# Most episodes prefetched in a single batch
+PREFETCH_WINDOW = 100
+
+# Written by tools/prewarm_cache.py, merged into the Dict on start
+PREWARM_FILE = "prewarm.json"
+
 LANGUAGE_MAP = dict()
 
 
@@ -44,7 +56,7 @@ def thread_lock(func):
     def do_call(*args, **kwargs):
         try:
             LOCK.acquire()
-            func(*args, **kwargs)
+            return func(*args, **kwargs)
 
         finally:
             LOCK.release()
@@ -59,6 +71,142 @@ def Start():
     LANGUAGE_MAP["Romaji"] = "romaji_name"
     LANGUAGE_MAP["Kanji"] = "kanji_name"
 
+    openSharedState()
+    importPrewarmedCache()
+    startPreHasher()
+    scheduleMetricsDump()
+
+
+def dataPath(name):
+    """Return the path of the file `name` in the plugin data directory."""
+    return Core.storage.join_path(Core.storage.data_path, name)
+
+
+def importPrewarmedCache():
+    """Merge the metadata loaded ahead of time by tools/prewarm_cache.py into
+    the Dict, so scanning the library it was run on hits the cache. Entries
+    the Dict already has are only replaced by newer records."""
+    export = adba.CacheExport(dataPath(PREWARM_FILE))
+    try:
+        entries = export.load()
+        if not entries:
+            return
+
+        imported = 0
+        for (key, value) in entries.iteritems():
+            if key not in Dict or isNewerRecord(value, Dict[key]):
+                Dict[key] = value
+                imported += 1
+        Dict.Save()
+        export.clear()
+        Log("Imported %i of %i prewarmed cache entries" %
+            (imported, len(entries)))
+    except Exception:
+        Log("Unable to import prewarmed cache, traceback:")
+        Log("".join(traceback.format_exception(*sys.exc_info())))
+
+
+def isNewerRecord(value, cached):
+    """Return whether the cached anime record `value` was updated on AniDB
+    after `cached`. Entries without a date never are."""
+    if not isinstance(value, dict) or not isinstance(cached, dict):
+        return False
+    try:
+        return int(value.get("date_record_updated")) > \
+            int(cached.get("date_record_updated"))
+    except (TypeError, ValueError):
+        return False
+
+
+def openSharedState():
+    """Create the rate limiter, circuit breaker, metrics and hash index
+    shared by all connections. Their state outlives connections, and is
+    saved to disk where a restart of the plugin mustn't reset it."""
+    global HASH_INDEX
+    global RATE_LIMITER
+    global CIRCUIT_BREAKER
+    global METRICS
+
+    RATE_LIMITER = adba.RateLimiter(dataPath("ratelimit.json"))
+    CIRCUIT_BREAKER = adba.CircuitBreaker(
+        dataPath("circuit.json"),
+        initialCooldown=INITIAL_COOLDOWN.total_seconds(),
+        cap=COOLDOWN_CAP.total_seconds())
+    METRICS = adba.MetricsRegistry()
+
+    try:
+        HASH_INDEX = adba.HashIndex(dataPath("hashes.db"))
+    except Exception:
+        Log("Unable to open hash index, traceback:")
+        Log("".join(traceback.format_exception(*sys.exc_info())))
+
+
+def hashIndex():
+    """Return the on-disk index of local file hashes, or None if it couldn't
+    be opened, in which case files will simply be hashed every time."""
+    return HASH_INDEX
+
+
+def rateLimiter():
+    """Return the API rate limiter."""
+    return RATE_LIMITER
+
+
+def circuitBreaker():
+    """Return the breaker keeping the agent off the API while banned."""
+    return CIRCUIT_BREAKER
+
+
+def metrics():
+    """Return the registry timing API requests."""
+    return METRICS
+
+
+def scheduleMetricsDump():
+    try:
+        interval = float(Prefs["metrics_interval"] or 0) * 60
+    except ValueError:
+        interval = 0
+
+    if interval > 0:
+        Thread.CreateTimer(interval, dumpMetrics)
+
+
+def dumpMetrics():
+    """Write the API timing metrics to the log and to metrics.json."""
+    try:
+        metrics().log(Log)
+        metrics().dump(dataPath("metrics.json"))
+    except Exception:
+        Log("Unable to dump metrics, traceback:")
+        Log("".join(traceback.format_exception(*sys.exc_info())))
+
+    scheduleMetricsDump()
+
+
+def startPreHasher():
+    """Start hashing new files in the user-configured library folders in the
+    background, so hash searches don't have to."""
+    global PRE_HASHER
+
+    roots = [root.strip() for root in (Prefs["prehash_roots"] or "").split(";")
+             if root.strip()]
+    if not roots or PRE_HASHER is not None or hashIndex() is None:
+        return
+
+    try:
+        # Keep background hashing from getting in the way of playback
+        rate = float(Prefs["prehash_rate"] or 0) * 1000 * 1000
+        budget = adba.IOBudget(rate=rate or None)
+
+        PRE_HASHER = adba.PreHasher(roots, hashIndex(), Log,
+                                    settle=int(Prefs["prehash_settle"]),
+                                    budget=budget)
+        PRE_HASHER.start()
+    except Exception:
+        Log("Unable to start pre-hasher, traceback:")
+        Log("".join(traceback.format_exception(*sys.exc_info())))
+
 
 def titleKey():
     """Utility method for finding the key name of the currently user-selected
@@ -92,8 +240,10 @@ def checkConnection():
     try:
         if CONNECTION is not None and LAST_ACCESS is not None \
                 and (datetime.now() - IDLE_TIMEOUT) > LAST_ACCESS \
-                and not CONNECTION.banned:
-            CONNECTION.stop()
+                and not CONNECTION.link.banned and not CONNECTION.busy():
+            # Don't log out, so the next connection can resume the session
+            # if AniDB hasn't expired it by then.
+            CONNECTION.cut()
             CONNECTION = None
             Log("Connection timeout reached. Closing connection!")
     except:
@@ -117,60 +267,52 @@ class MotherAgent:
     def connection(self):
         "Create an API session and authenticate with the stored credentials."
 
+        # Checked before taking the lock, which is held while authenticating
+        if self.is_banned:
+            Log("Banned, %is of the cooldown left" %
+                CIRCUIT_BREAKER.remaining())
+            return CONNECTION
+
+        return self.openConnection()
+
+    @thread_lock
+    def openConnection(self):
         global CONNECTION
         global LAST_ACCESS
-        global LAST_COOLDOWN
 
         try:
             username = Prefs["username"]
             password = Prefs["password"]
 
             if CONNECTION is not None:
-                # Take care of ban handling
-                if self.is_banned:
-                    # Initialize the cooldown timer if neccessary
-                    if not CONNECTION.ban_cooldown:
-                        # Set cooldown
-                        if LAST_COOLDOWN:
-                            LAST_COOLDOWN = LAST_COOLDOWN * 2
-                        else:
-                            LAST_COOLDOWN = INITIAL_COOLDOWN
-
-                        # Constrain the max cooldown time
-                        if LAST_COOLDOWN > COOLDOWN_CAP:
-                            LAST_COOLDOWN = COOLDOWN_CAP
-
-                        Log("Ban cooldown: %r" % LAST_COOLDOWN)
-                        CONNECTION.ban_cooldown = datetime.utcnow() + LAST_COOLDOWN
-                        Log("Ban cooldown expires on %r" % CONNECTION.ban_cooldown)
-
-                    # Clear ban timer if cooldown is over
-                    if not CONNECTION.ban_cooldown_active:
-                        Log("Banned but cooldown over, clearing ban state")
-                        CONNECTION.link.banned = False
-
                 # Perform connection
-                if not self.is_banned and not CONNECTION.authed():
+                if not CONNECTION.authed():
                     Log("Authenticating")
                     CONNECTION.auth(username, password)
 
-                elif self.is_banned:
-                    Log("Banned, will return current connection")
-
                 else:
                     Log("Reusing authenticated connection")
                     LAST_ACCESS = datetime.now()
 
                 return CONNECTION
 
-            CONNECTION = adba.Connection(log=True, keepAlive=True)
+            capture = None
+            if Prefs["capture_packets"]:
+                capture = adba.PacketCapture(dataPath("packets.capture"))
+
+            CONNECTION = adba.Connection(
+                log=True, keepAlive=True, rateLimiter=rateLimiter(),
+                sessionStore=adba.SessionStore(dataPath("session.json")),
+                circuitBreaker=circuitBreaker(), metrics=metrics(),
+                capture=capture)
 
             Thread.CreateTimer(60, checkConnection)
 
             if not username or not password:
                     raise Exception("Set username and password!")
 
-            CONNECTION.auth(username, password)
+            # Picks up the session of the last run if it's still valid
+            CONNECTION.resume(username, password)
             Log("Auth ok!")
 
         except Exception:
@@ -182,10 +324,7 @@ class MotherAgent:
 
     @property
     def is_banned(self):
-        if CONNECTION and CONNECTION.link:
-            return CONNECTION.link.banned
-
-        return False
+        return CIRCUIT_BREAKER is not None and CIRCUIT_BREAKER.blocked()
 
     def decodeString(self, string=None):
         """"Decode" and return the given string.
@@ -219,7 +358,6 @@ class MotherAgent:
         "Return one 1400-byte `part` of the description for AniDB anime `aid`."
 
         Log("Description stuff")
-        animeDesc = adba.AnimeDesc(self.connection, aid=aid, part=part)
 
         cacheKey = "aid:%s:desc" % aid
         if part == 0 and cacheKey in Dict \
@@ -230,11 +368,13 @@ class MotherAgent:
         Log("Cache miss for key %s" % cacheKey)
 
         if self.is_banned:
-            Log("Banned from the API and with no cache, returning no desc data")
+            Log("Banned from the API and with no cache, returning no "
+                "desc data")
             return None
 
         Log("Loading desc from API for key %s" % cacheKey)
 
+        animeDesc = adba.AnimeDesc(self.connection, aid=aid, part=part)
         try:
             animeDesc.load_data()
         except IndexError:
@@ -345,21 +485,25 @@ class MotherAgent:
 
         Log("Loading metadata for anime aid " + aid)
 
-        anime = adba.Anime(self.connection, aid=metadata.id,
+        # Only connect once the cache and the ban state have been checked
+        anime = adba.Anime(None, aid=metadata.id,
                            paramsA=["epno", "english_name", "kanji_name",
                                     "romaji_name", "other_name", "year",
                                     "picname", "url", "rating", "episodes",
                                     "tag_weight_list", "tag_name_list",
-                                    "highest_episode_number", "air_date"])
+                                    "highest_episode_number", "air_date",
+                                    "date_record_updated"])
 
         cacheKey = "aid:%s" % metadata.id
         if cacheKey not in Dict or force:
             Log("Cache miss for key %s" % cacheKey)
 
             if self.is_banned:
-                Log("Banned from the API and with no cache, returning no anime data")
+                Log("Banned from the API and with no cache, returning no "
+                    "anime data")
                 return None
 
+            anime.set_connection(self.connection)
             anime.load_data()
             Dict[cacheKey] = anime.dataDict
             Log("Anime dump: %r" % (anime.dataDict, ))
@@ -460,20 +604,41 @@ class MotherAgent:
 
         filePath = urllib.unquote(filename)
 
-        fileInfo = adba.File(self.connection, filePath=filePath, paramsF=["aid"],
-                             paramsA=["english_name", "romaji_name",
-                                      "kanji_name", "year"])
+        fileInfo = adba.File(None, filePath=filePath, paramsF=["aid"],
+                             paramsA=["epno", "english_name", "romaji_name",
+                                      "kanji_name", "year"],
+                             hashIndex=hashIndex())
+        fileInfo.log = Log
+
+        try:
+            (fileInfo.ed2k, fileInfo.size) = \
+                fileInfo.calculate_file_stuff(filePath)
+        except Exception, e:
+            Log("Could not hash file, msg: " + str(e))
+            return fileInfo
+
+        # Files are looked up by hash, so the result holds for any copy
+        cacheKey = "file:%s:%s" % (fileInfo.size, fileInfo.ed2k)
+        if cacheKey in Dict:
+            Log("Loading file info from cache key %s" % cacheKey)
+            fileInfo.dataDict = Dict[cacheKey]
+            return fileInfo
 
         if self.is_banned:
-            Log("Banned from the API and with no cache, returning no hash search data")
+            Log("Banned from the API and with no cache, returning no "
+                "hash search data")
             return None
 
+        fileInfo.set_connection(self.connection)
         try:
             Log("Trying to lookup %s by file on anidb" % filePath)
             fileInfo.load_data()
         except Exception, e:
             Log("Could not load file data, msg: " + str(e))
 
+        if "aid" in fileInfo.dataDict:
+            Dict[cacheKey] = fileInfo.dataDict
+
         return fileInfo
 
     def doNameSearch(self, results, name):
@@ -481,15 +646,16 @@ class MotherAgent:
         field.
         """
 
+        if self.is_banned:
+            Log("Banned from the API and with no cache, returning no "
+                "name search data")
+            return None
+
         fileInfo = adba.Anime(self.connection, name=name,
                               paramsA=["english_name", "kanji_name",
                                        "romaji_name", "other_name", "year",
                                        "aid"])
 
-        if self.is_banned:
-            Log("Banned from the API and with no cache, returning no name search data")
-            return None
-
         try:
             Log("Trying to lookup %s by name on anidb" % name)
             fileInfo.load_data()
@@ -570,12 +736,11 @@ class AniDBAgentMovies(Agent.Movies, MotherAgent):
     accepts_from = ['com.plexapp.agents.localmedia',
                     'com.plexapp.agents.opensubtitles']
 
-    @thread_lock
     def search(self, results, media, lang):
         # TODO: Move me into the MotherAgent class
-        self.doSearch(results, media, lang)
+        with adba.prioritized(adba.PRIORITY_INTERACTIVE):
+            self.doSearch(results, media, lang)
 
-    @thread_lock
     def update(self, metadata, media, lang, force=None):
         # TODO: Move me into the MotherAgent class
 
@@ -584,7 +749,8 @@ class AniDBAgentMovies(Agent.Movies, MotherAgent):
             Log("Caller didn't specify whether to skip cache. User pref: %s" %
                 force)
 
-        self.doUpdate(metadata, media, lang, force)
+        with adba.prioritized(adba.PRIORITY_FOREGROUND):
+            self.doUpdate(metadata, media, lang, force)
 
     def doUpdate(self, metadata, media, lang, force):
         self.getAnimeInfo(metadata.id, metadata, True, force)
@@ -599,12 +765,11 @@ class AniDBAgentTV(Agent.TV_Shows, MotherAgent):
     accepts_from = ['com.plexapp.agents.localmedia',
                     'com.plexapp.agents.opensubtitles']
 
-    @thread_lock
     def search(self, results, media, lang):
         # TODO: Move me into the MotherAgent class
-        self.doSearch(results, media, lang)
+        with adba.prioritized(adba.PRIORITY_INTERACTIVE):
+            self.doSearch(results, media, lang)
 
-    @thread_lock
     def update(self, metadata, media, lang, force=None):
         # TODO: Move me into the MotherAgent class
 
@@ -613,10 +778,12 @@ class AniDBAgentTV(Agent.TV_Shows, MotherAgent):
             Log("Caller didn't specify whether to skip cache. User pref: %s" %
                 force)
 
-        self.doUpdate(metadata, media, lang, force)
+        with adba.prioritized(adba.PRIORITY_FOREGROUND):
+            self.doUpdate(metadata, media, lang, force)
 
     def doUpdate(self, metadata, media, lang, force):
         self.getAnimeInfo(metadata.id, metadata, False, force)
+        self.prefetchEpisodes(metadata, media, force)
 
         for s in media.seasons:
 
@@ -639,14 +806,92 @@ class AniDBAgentTV(Agent.TV_Shows, MotherAgent):
                 episode.duration = episodeData["length"]
                 episode.originally_available_at = episodeData["aired"]
 
-    def loadEpisode(self, metadata, season, episode, force):
+    def getEpisodeKey(self, metadata, season, episode):
+        return ("aid:" + str(metadata.id) + "-" + str(season) + "-"
+                + str(episode) + "-")
 
-        epno = episode
+    def getEpisodeNumber(self, season, episode):
         if str(season) == "0":
-            epno = "S" + str(epno)
+            return "S" + str(episode)
+        return episode
+
+    def isEpisodeCached(self, episodeKey, force):
+        return (str(episodeKey + "kanji_name") in Dict and not force) or \
+            episodeKey in Dict
+
+    def prefetchEpisodes(self, metadata, media, force):
+        """Load every episode missing from the cache in batches of up to
+        PREFETCH_WINDOW, so their round trips overlap instead of adding
+        up."""
+        global LAST_ACCESS
+
+        if self.is_banned:
+            return
+
+        wanted = []
+        for s in media.seasons:
+            for ep in media.seasons[s].episodes:
+                episodeKey = self.getEpisodeKey(metadata, s, ep)
+                if self.isEpisodeCached(episodeKey, force):
+                    continue
+                epno = self.getEpisodeNumber(s, ep)
+                wanted.append((episodeKey, epno, adba.Episode(
+                    self.connection, aid=metadata.id, epno=epno)))
+
+        if not wanted:
+            return
+
+        Log("Loading metadata for %i episodes of '%s' from AniDB" %
+            (len(wanted), metadata.title))
+
+        connection = self.connection
+        # A batch holds on to a tag per command, and there are only 999
+        for start in xrange(0, len(wanted), PREFETCH_WINDOW):
+            if self.is_banned:
+                return
+            window = wanted[start:start + PREFETCH_WINDOW]
+            batch = connection.batch(
+                [episode.command() for (_, _, episode) in window])
+
+            # Every episode could be queued behind the others
+            timeout = connection.link.timeout + \
+                len(window) * connection.link.rateLimiter.longInterval
+
+            try:
+                for outcome in batch.as_completed(timeout):
+                    # Keep the connection from being cut as idle meanwhile
+                    LAST_ACCESS = datetime.now()
+                    self.storePrefetched(window, batch, *outcome)
+            except adba.AniDBCommandTimeoutError:
+                missing = len(wanted) - start - batch.completed()
+                Log("Timed out prefetching episodes of '%s', skipping the %i "
+                    "missing" % (metadata.title, missing))
+                batch.cancel()
+                return
+
+    def storePrefetched(self, wanted, batch, index, resp, error):
+        (episodeKey, epno, episode) = wanted[index]
+
+        if error:
+            Log("Could not load episode info for episode %s, msg: %s" %
+                (epno, error))
+            return
 
-        episodeKey = ("aid:" + str(metadata.id) + "-" + str(season) + "-"
-                      + str(episode) + "-")
+        try:
+            episode.load_response(resp)
+        except IndexError, e:
+            Log("Episode number is incorrect, msg: " + str(e) +
+                " for episode " + epno)
+            return
+
+        self.storeEpisode(episodeKey, episode)
+        Log("Loaded episode %s (%i/%i), about %is left" %
+            (epno, batch.completed(), len(batch), batch.eta()))
+
+    def loadEpisode(self, metadata, season, episode, force):
+
+        epno = self.getEpisodeNumber(season, episode)
+        episodeKey = self.getEpisodeKey(metadata, season, episode)
 
         Log("Force: " + str(force))
         Log("Has key: " + str(str(episodeKey + "kanji_name") in Dict))
@@ -664,7 +909,8 @@ class AniDBAgentTV(Agent.TV_Shows, MotherAgent):
             return episodeKey
 
         if self.is_banned:
-            Log("Banned from the API and with no cache, returning no episode data for %r" % episodeKey)
+            Log("Banned from the API and with no cache, returning no "
+                "episode data for %r" % episodeKey)
             return None
 
         episode = adba.Episode(self.connection, aid=metadata.id, epno=epno)
@@ -678,6 +924,10 @@ class AniDBAgentTV(Agent.TV_Shows, MotherAgent):
             Log("Could not load episode info, msg: " + str(e))
             raise e
 
+        self.storeEpisode(episodeKey, episode)
+        return episodeKey
+
+    def storeEpisode(self, episodeKey, episode):
         # FIXME: Cache shit lists
         if "english_name" in episode.dataDict:
             if isinstance(episode.dataDict["english_name"], list):
@@ -706,5 +956,3 @@ class AniDBAgentTV(Agent.TV_Shows, MotherAgent):
                 Dict[episodeKey + "aired"] = aired
             except:
                 pass
-
-        return episodeKey
@@ -24,9 +24,23 @@ import threading
 from time import time, sleep, strftime, localtime
 import types
 from aniDBlink import AniDBLink
-from aniDBerrors import AniDBCommandTimeoutError
+from aniDBrateLimiter import RateLimiter, monotonic  # NOQA
+from aniDBmetrics import MetricsRegistry  # NOQA
+from aniDBscheduler import RequestScheduler, prioritized  # NOQA
+from aniDBsupervisor import LinkSupervisor
+from aniDBscheduler import PRIORITY_INTERACTIVE, PRIORITY_FOREGROUND  # NOQA
+from aniDBscheduler import PRIORITY_BACKGROUND  # NOQA
+from aniDBerrors import AniDBCommandTimeoutError, AniDBCancelledError
+from aniDBerrors import AniDBError
+from aniDBfuture import Batch, CommandFuture  # NOQA
 from aniDBAbstracter import Anime, AnimeDesc, Episode, File  # NOQA
-from datetime import datetime
+from aniDBfileInfo import IOBudget  # NOQA
+from aniDBhashIndex import HashIndex  # NOQA
+from aniDBpreHasher import PreHasher  # NOQA
+from aniDBsession import SessionStore  # NOQA
+from aniDBcircuitBreaker import CircuitBreaker  # NOQA
+from aniDBcapture import PacketCapture, CaptureReplay  # NOQA
+from aniDBcacheExport import CacheExport  # NOQA
 
 
 class adb(object):
@@ -35,13 +49,18 @@ class adb(object):
 
 version = 100
 
+# Seconds between saves of an unchanged session, keeping the time of its
+# last packet roughly up to date
+SESSION_REFRESH = 5 * 60
+
 
 class Connection(threading.Thread):
-    ban_cooldown = None
 
     def __init__(self, clientname='adba', server='api.anidb.info', port=9000,
                  myport=9876, user=None, password=None, session=None,
-                 log=False, logPrivate=False, keepAlive=False):
+                 log=False, logPrivate=False, keepAlive=False,
+                 rateLimiter=None, sessionStore=None, circuitBreaker=None,
+                 metrics=None, capture=None, transport=None):
         threading.Thread.__init__(self)
         # setting the log function
         self.logPrivate = logPrivate
@@ -61,9 +80,26 @@ class Connection(threading.Thread):
             self.log = self.print_log_dummy
         self.logPrivate = True
 
+        # A saved session is only valid from the port it was created from
+        self.sessionStore = sessionStore
+        self.savedSession = None
+        self.savedAt = 0
+        saved = sessionStore.load() if sessionStore else None
+        if saved:
+            myport = saved[1]
+
         self.link = AniDBLink(server, port, myport, self.log,
-                              logPrivate=self.logPrivate)
+                              logPrivate=self.logPrivate,
+                              rateLimiter=rateLimiter,
+                              circuitBreaker=circuitBreaker,
+                              metrics=metrics, capture=capture,
+                              transport=transport)
+        self.metrics = self.link.metrics
         self.link.session = session
+        self.scheduler = RequestScheduler(self.link, self.log)
+        self.link.retransmitter = self.scheduler.retransmit
+        self.supervisor = LinkSupervisor(self, self.log)
+        self.supervisor.watch(self.link)
 
         self.clientname = clientname
         self.clientver = version
@@ -74,6 +110,10 @@ class Connection(threading.Thread):
         # to lock other threads out
         self.lock = threading.RLock()
 
+        # commands waiting for a response, by Command.key()
+        self.inflight = {}
+        self.inflightLock = threading.Lock()
+
         # thread keep alive stuff
         self.keepAlive = keepAlive
         self.setDaemon(True)
@@ -84,9 +124,6 @@ class Connection(threading.Thread):
 
         self.iamALIVE = False
 
-        self.counter = 0
-        self.counterAge = 0
-
     def print_log(self, data):
         Log(strftime("%Y-%m-%d %H:%M:%S",
             localtime(time())) + ": " + str(data))
@@ -98,42 +135,92 @@ class Connection(threading.Thread):
         self.logout(cutConnection=True)
 
     def cut(self):
-        self.link.stop()
-
-    def handle_response(self, response):
+        """Close the connection, failing the commands that haven't been
+        answered yet."""
+        self.keepAlive = False
+        error = AniDBError("connection closed")
+        self.scheduler.stop(error)
+        self.link.stop(error)
+
+    def busy(self):
+        """Return whether commands are queued or waiting for a response."""
+        return bool(self.scheduler.pending() or self.link.cmd_queue)
+
+    def handle_response(self, response, command=None):
+        """Return the response to `command` (by default the one the response
+        is for), sending the command again after re-authenticating if the
+        session had expired."""
         # I think I can add ban and other error-handling here if I can't get
         # it to work some other place.
+        if command is None:
+            command = response.req
+
         if response.rescode in ('501', '506') \
-                and response.req.command != 'AUTH':
+                and command.command != 'AUTH':
             self.log("seams like the last command got a not authed error back "
                      "tring to reconnect now")
 
-            if self.reAuthenticate():
-                response.req.resp = None
-                response = self.handle(response.req, response.req.callback)
+            if self.reAuthenticate(command.session):
+                command.reset()
+                return self.handle(command, None)
+
+        self.save_session()
+        return response
+
+    def save_session(self):
+        """Save the session if it changed since it was last saved. The time
+        of the last packet is only refreshed every SESSION_REFRESH seconds,
+        rather than written on every response."""
+        if not self.sessionStore or not self.link.session:
+            return
+        state = (self.link.session, self.link.myport, self.username)
+        if state == self.savedSession and \
+                time() - self.savedAt < SESSION_REFRESH:
+            return
+        self.savedSession = state
+        self.savedAt = time()
+        self.sessionStore.save(*state)
+
+    def resume(self, username, password):
+        """Log in, reusing the saved session if AniDB still accepts it."""
+        self.remember(username, password)
+
+        saved = self.sessionStore.load(username) if self.sessionStore \
+            else None
+        if not saved or saved[1] != self.link.myport:
+            return self.auth(username, password)
+
+        self.log("resuming saved session")
+        self.link.session = saved[0]
+        self.lastAuth = time()
+
+        # UPTIME needs a valid session, and re-authenticates transparently
+        # if it isn't.
+        return self.uptime()
 
     def handle(self, command, callback):
-        self.lock.acquire()
-        # if the last request was older then 2 min reset delay and counter
-        if self.counterAge < (time() - 120):
-            self.counter = 0
-            self.link.delay = 2
-
-        else:  # something happend in the last 120 seconds
-            if self.counter < 5:
-                # short term "A Client MUST NOT send more than 0.5 packets per
-                # second (that's one packet every two seconds, not two packets
-                # a second!)"
-                self.link.delay = 2
-
-            elif self.counter >= 5:
-                # long term "A Client MUST NOT send more than one packet every
-                # four seconds over an extended amount of time."
-                self.link.delay = 6
+        self.dispatch(command, self.mode, callback)
 
+        # handle mode 1 (wait for response)
+        if self.mode == 1:
+            command.wait_response()
+            return self.finish(command)
+
+    def submit(self, command, priority=None):
+        """Send `command` without waiting for the response, and return a
+        CommandFuture for it."""
+        following = self.dispatch(command, 1, None, priority)
+        return CommandFuture(self, command, following)
+
+    def batch(self, commands, priority=None):
+        """Send all of `commands` without waiting for the responses, and
+        return a Batch to collect them from."""
+        return Batch(self, commands, priority)
+
+    def dispatch(self, command, mode, callback, priority=None):
+        """Queue `command` to be sent, and return whether it shares the
+        response of an identical command already on its way instead."""
         if command.command not in ('AUTH', 'PING', 'ENCRYPT'):
-            self.counterAge = time()
-            self.counter = self.counter + 1
             if self.keepAlive:
                 self.log("Keepalive authcheck in handle")
                 self.authed()
@@ -143,43 +230,101 @@ class Connection(threading.Thread):
             if callback:
                 callback(resp)
 
-        self.log("handling(" + str(self.counter) + "-" + str(self.link.delay) +
-                 ") command " + str(command.command))
+        self.log("handling command " + str(command.command))
+        self.supervisor.check()
 
-        # make live request
-        command.authorize(self.mode, self.link.new_tag(), self.link.session,
-                          callback_wrapper)
-        self.link.request(command)
+        started = monotonic()
+        command.add_done_callback(
+            lambda command: self.record(command, started))
 
-        # handle mode 1 (wait for response)
-        if self.mode == 1:
-            command.wait_response()
+        # An identical read-only command that's already on its way gets the
+        # same response, so wait for that one instead of sending another.
+        key = command.key() if command.idempotent else None
 
-            try:
-                command.resp
+        self.lock.acquire()
+        self.inflightLock.acquire()
+        try:
+            leader = self.inflight.get(key) if key else None
+            if leader is not None and command.follow(leader, mode, callback):
+                self.log("coalescing with in-flight %s" % command.command)
+                self.metrics.counter("coalesced",
+                                     command=command.command).inc()
+                return True
 
-            except:
-                self.lock.release()
+            command.authorize(mode, self.link.new_tag(), self.link.session,
+                              callback_wrapper)
+            if key:
+                self.inflight[key] = command
+        finally:
+            self.inflightLock.release()
+            self.lock.release()
 
-                # Allow empty response for description - if this is a real
-                # timeout so be it.
-                if command.command == 'ANIMEDESC':
-                    return None
-                else:
-                    raise AniDBCommandTimeoutError("Command has timed out")
+        if key:
+            command.add_done_callback(self.forget_inflight)
 
-            self.handle_response(command.resp)
-            self.lock.release()
-            return command.resp
+        # Everything else needs a session, so don't keep it waiting
+        if command.command == 'AUTH':
+            priority = PRIORITY_INTERACTIVE
+
+        # make live request
+        self.scheduler.submit(command, priority)
+        return False
+
+    def record(self, command, started):
+        if hasattr(command, 'resp'):
+            result = command.resp.rescode
+        elif command.error:
+            result = command.error.__class__.__name__
         else:
+            result = "timeout"
+        self.metrics.histogram("request_seconds", command=command.command,
+                               result=result).observe(monotonic() - started)
+
+    def forget_inflight(self, command):
+        # Called from the link thread, which mustn't wait for self.lock
+        with self.inflightLock:
+            if self.inflight.get(command.key()) is command:
+                del self.inflight[command.key()]
+
+    def finish(self, command):
+        """Return the response of the finished `command`, or raise the error
+        it failed with."""
+        if command.error:
+            raise command.error
+
+        try:
+            command.resp
+
+        except:
+            # Allow empty response for description - if this is a real
+            # timeout so be it.
+            if command.command == 'ANIMEDESC':
+                return None
+            else:
+                raise AniDBCommandTimeoutError("Command has timed out")
+
+        return self.handle_response(command.resp, command)
+
+    def abandon(self, command, following):
+        """Stop waiting for the response of `command`, dropping it from the
+        queue if it hasn't been sent yet and nothing else is waiting for
+        it."""
+        error = AniDBCancelledError("%s was cancelled" % command.command)
+
+        self.lock.acquire()
+        try:
+            if following:
+                if command.unfollow():
+                    command.fail(error)
+            elif not command.followers and self.scheduler.remove(command):
+                self.link.release_tag(command.tag)
+                command.fail(error)
+        finally:
             self.lock.release()
 
     @property
     def ban_cooldown_active(self):
-        if not self.ban_cooldown:
-            return False
-
-        return datetime.utcnow() < self.ban_cooldown
+        return self.link.circuitBreaker.blocked()
 
     def authed(self, reAuthenticate=False):
         self.lock.acquire()
@@ -187,6 +332,7 @@ class Connection(threading.Thread):
 
         if self.link and self.link.banned:
             self.log("banned, won't auth")
+            self.lock.release()
             return False
 
         if not authed and (reAuthenticate or self.keepAlive):
@@ -200,14 +346,24 @@ class Connection(threading.Thread):
         self.lock.release()
         return authed
 
-    def reAuthenticate(self):
-        if self.username and self.password:
-            self.log("auto re authenticating !")
-            resp = self.auth(self.username, self.password)
-            if resp.rescode not in ('500'):
+    def reAuthenticate(self, staleSession=None):
+        """Authenticate again, unless another thread already replaced the
+        expired session `staleSession`."""
+        self.lock.acquire()
+        try:
+            if staleSession and self.link.session and \
+                    self.link.session != staleSession:
                 return True
-        else:
-            return False
+
+            if self.username and self.password:
+                self.log("auto re authenticating !")
+                resp = self.auth(self.username, self.password)
+                if resp.rescode not in ('500'):
+                    return True
+            else:
+                return False
+        finally:
+            self.lock.release()
 
     def keep_alive(self):
         self.lastKeepAliveCheck = time()
@@ -251,11 +407,23 @@ class Connection(threading.Thread):
         mtu     - maximum transmission unit (max packet size) (default: 1400)
 
         """
+        self.remember(username, password)
+
+        self.lastAuth = time()
+        return self.handle(adb.cmd.AuthCommand(username, password, 3,
+                                               self.clientname,
+                                               self.clientver, nat, 1, 'utf8',
+                                               mtu), callback)
+
+    def remember(self, username, password):
+        """Keep the credentials for re-authenticating, and start keeping the
+        session alive if asked to."""
+        self.username = username
+        self.password = password
+
         self.log("ok1")
         if self.keepAlive:
             self.log("ok2")
-            self.username = username
-            self.password = password
 
             if not self.is_alive():
                 self.log("You wanted to keep this thing alive!")
@@ -269,18 +437,15 @@ class Connection(threading.Thread):
                     self.log("not starting thread seams like it is already "
                              "running. this must be a reAuthenticate")
 
-        self.lastAuth = time()
-        return self.handle(adb.cmd.AuthCommand(username, password, 3,
-                                               self.clientname,
-                                               self.clientver, nat, 1, 'utf8',
-                                               mtu), callback)
-
     def logout(self, cutConnection=False, callback=None):
         """
         Log out from AniDB UDP API
 
         """
         result = self.handle(adb.cmd.LogoutCommand(), callback)
+        if self.sessionStore:
+            self.sessionStore.clear()
+            self.savedSession = None
         if(cutConnection):
             self.cut()
         return result
@@ -15,6 +15,7 @@
 
 import aniDBfileInfo as fileInfo
 from aniDBmaper import AniDBMaper
+from aniDBcommands import EpisodeCommand
 import aniDBerrors as err
 
 
@@ -204,8 +205,15 @@ class Episode(aniDBabstractObject):
 
     def load_data(self):
         """load the data from anidb"""
-        self.rawData = self.aniDB.episode(eid=self.epid, aid=self.aid,
-                                          epno=self.epno)
+        self.load_response(self.aniDB.episode(eid=self.epid, aid=self.aid,
+                                              epno=self.epno))
+
+    def command(self):
+        """Return the command loading the data, for sending in a batch"""
+        return EpisodeCommand(eid=self.epid, aid=self.aid, epno=self.epno)
+
+    def load_response(self, rawData):
+        self.rawData = rawData
         self.fill(self.rawData.datalines[0])
         self.loaded = True
 
@@ -213,7 +221,8 @@ class Episode(aniDBabstractObject):
 class File(aniDBabstractObject):
 
     def __init__(self, aniDB, number=None, epid=None, filePath=None, fid=None,
-                 epno=None, paramsA=None, paramsF=None, load=False):
+                 epno=None, paramsA=None, paramsF=None, hashIndex=None,
+                 load=False):
         if not aniDB and not number and not epid and not file and not fid:
             return None
 
@@ -222,6 +231,7 @@ class File(aniDBabstractObject):
         self.filePath = filePath
         self.fid = fid
         self.epno = epno
+        self.hashIndex = hashIndex
 
         if not paramsA:
             self.bitCodeA = "C000F0C0"
@@ -278,6 +288,10 @@ class File(aniDBabstractObject):
     def calculate_file_stuff(self, filePath):
         if not filePath:
             return (None, None)
+
+        if self.hashIndex:
+            return self.hashIndex.hash(filePath, self.log)
+
         self.log("Calculating the ed2k. Please wait...")
         ed2k = fileInfo.get_file_hash(filePath)
         size = fileInfo.get_file_size(filePath)
@@ -0,0 +1,77 @@
+# This file is part of aDBa.
+#
+# aDBa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# aDBa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+DATETIME = "$datetime"
+
+
+def encode(value):
+    if isinstance(value, datetime):
+        return {DATETIME: time.mktime(value.timetuple())}
+    raise TypeError("%r is not JSON serializable" % (value, ))
+
+
+def decode(value):
+    if len(value) == 1 and DATETIME in value:
+        return datetime.fromtimestamp(value[DATETIME])
+    return value
+
+
+class CacheExport(object):
+    """Entries of the metadata cache (the Dict of the agent) saved to `path`,
+    so that they can be loaded outside of Plex and merged into the Dict when
+    the agent starts.
+
+    Entries are saved as JSON, datetimes as {"$datetime": timestamp}.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Return the saved entries, or an empty dict if there are none."""
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f, object_hook=decode)
+        except (IOError, ValueError):
+            return {}
+
+        if not isinstance(entries, dict):
+            return {}
+        # The agent builds its keys as str
+        return dict((key.encode("utf-8"), value)
+                    for (key, value) in entries.iteritems())
+
+    def save(self, entries):
+        with self.lock:
+            temp = self.path + ".tmp"
+            with open(temp, "w") as f:
+                json.dump(entries, f, default=encode)
+            if os.name == "nt" and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temp, self.path)
+
+    def clear(self):
+        with self.lock:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,301 @@
+# This file is part of aDBa.
+#
+# aDBa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# aDBa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
+
+import Queue
+import re
+import socket
+import threading
+import time
+import zlib
+from collections import defaultdict
+from HTMLParser import HTMLParser
+import aniDBcommands
+from aniDBcommands import Command
+from aniDBrateLimiter import monotonic
+from aniDBresponses import ResponseResolver
+
+CAPTURE_VERSION = 1
+
+OUTBOUND = ">"
+INBOUND = "<"
+
+# Parameters holding credentials or the session key
+SECRET_PARAMETERS = re.compile(r"(^|[ &])(user|pass|s|apipassword)=[^&]*")
+LOGIN_RESPONSE = re.compile(r"^((?:T\d+ )?20[01] )\S+")
+
+# Names of the commands that only read data, e.g. ANIMEDESC for
+# AnimeDescCommand
+IDEMPOTENT = set(name[:-len("Command")].upper() for (name, cls) in
+                 vars(aniDBcommands).items() if name.endswith("Command") and
+                 isinstance(cls, type) and cls.idempotent)
+
+
+def redact(data, direction):
+    """Blank out the credentials and session key in a packet."""
+    if direction == OUTBOUND:
+        return SECRET_PARAMETERS.sub(r"\1\2=*", data)
+
+    compressed = data[:2] == "\x00\x00"
+    plain = zlib.decompressobj().decompress(data[2:]) if compressed else data
+    if not LOGIN_RESPONSE.match(plain):
+        return data
+    # Left uncompressed, it's the only packet that has to be decompressed
+    return LOGIN_RESPONSE.sub(r"\1*****", plain)
+
+
+class PacketCapture(object):
+    """Records the packets an AniDBLink sends and receives to `path`.
+
+    Every packet is a line holding the seconds since the capture started,
+    > or < for outbound or inbound, and the packet with string escapes. The
+    credentials and session key are blanked out unless `redact` is False.
+    """
+
+    def __init__(self, path, redact=True, clock=monotonic):
+        self.path = path
+        self.redact = redact
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        self.started = clock()
+        self.file = open(path, "a")
+        self.file.write("# adba capture %i %s\n" % (
+            CAPTURE_VERSION, time.strftime("%Y-%m-%d %H:%M:%S")))
+        self.file.flush()
+
+    def outbound(self, data):
+        self.write(OUTBOUND, data)
+
+    def inbound(self, data):
+        self.write(INBOUND, data)
+
+    def write(self, direction, data):
+        offset = self.clock() - self.started
+        if self.redact:
+            try:
+                data = redact(data, direction)
+            except zlib.error:
+                pass
+
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write("%.6f %s %s\n" % (offset, direction,
+                                              data.encode("string_escape")))
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(path):
+    """Return the (offset, direction, packet) tuples of a capture file. A
+    file holding several captures is read as one, each starting where the
+    previous one ended."""
+    packets = []
+    base = 0
+    last = 0
+    with open(path, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            if line.startswith("#"):
+                base = last
+                continue
+            (offset, direction, data) = line.split(" ", 2)
+            last = base + float(offset)
+            packets.append((last, direction, data.decode("string_escape")))
+    return packets
+
+
+def split_command(data):
+    """Return the name, tag and parameters of an outbound packet, along with
+    the key identifying what it asks for regardless of tag and session."""
+    (name, _, rest) = data.partition(" ")
+    tag = None
+    pairs = []
+    for pair in rest.split("&") if rest else []:
+        (key, _, value) = pair.partition("=")
+        if key == "tag":
+            tag = value
+        elif key != "s":
+            pairs.append(pair)
+    return (name, tag, pairs, " ".join([name, "&".join(pairs)]))
+
+
+def response_tag(data):
+    if data[:2] == "\x00\x00":
+        data = zlib.decompressobj().decompress(data[2:])
+    first = data.split(" ", 1)[0]
+    return first if first.startswith("T") else None
+
+
+class ReplayCommand(Command):
+    """A command rebuilt from a capture, for resolving its response.
+    Parameters that weren't sent read as None."""
+
+    unescaper = HTMLParser()
+
+    def __init__(self, data):
+        (name, tag, pairs, _) = split_command(data)
+        parameters = {}
+        for pair in pairs:
+            (key, _, value) = pair.partition("=")
+            value = self.unescaper.unescape(value.replace("<br />", "\n"))
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            parameters[key] = value
+        Command.__init__(self, name, **parameters)
+        self.parameters = defaultdict(lambda: None, self.parameters)
+        self.idempotent = name in IDEMPOTENT
+        self.tag = tag
+        self.session = None
+
+
+class CaptureReplay(object):
+    """Plays a capture back.
+
+    responses() resolves the recorded responses through ResponseResolver and
+    the responses table, as AniDBLink does. socket() returns a stand-in for
+    the UDP socket of an AniDBLink, answering every command sent through it
+    with the response recorded for the same command.
+
+    With `realtime`, packets are played back with their recorded timing,
+    sped up `speed` times. Otherwise they are played back as fast as
+    possible.
+    """
+
+    def __init__(self, path, realtime=False, speed=1.0):
+        self.path = path
+        self.realtime = realtime
+        self.speed = speed
+        self.packets = read_capture(path)
+
+    def exchanges(self):
+        """Return the (command, sent, response, received) tuples of the
+        capture, pairing commands and responses by tag. Commands that went
+        unanswered have None for response."""
+        exchanges = []
+        pending = {}
+        for (offset, direction, data) in self.packets:
+            if direction == OUTBOUND:
+                (_, tag, _, _) = split_command(data)
+                entry = [data, offset, None, None]
+                exchanges.append(entry)
+                if tag:
+                    pending[tag] = entry
+                continue
+
+            try:
+                tag = response_tag(data)
+            except zlib.error:
+                continue
+            entry = pending.pop(tag, None)
+            if entry is not None:
+                entry[2:] = [data, offset]
+        return [tuple(entry) for entry in exchanges]
+
+    def wait_until(self, started, offset):
+        if self.realtime:
+            delay = offset / self.speed - (monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+    def responses(self):
+        """Yield (command, response) for every answered command, the
+        response resolved and parsed."""
+        started = monotonic()
+        for (data, sent, response, received) in self.exchanges():
+            if response is None:
+                continue
+            self.wait_until(started, received)
+
+            command = ReplayCommand(data)
+            if response[:2] == "\x00\x00":
+                response = zlib.decompressobj().decompress(response[2:])
+            resolved = ResponseResolver(response).resolve(command)
+            resolved.parse()
+            yield (command, resolved)
+
+    def socket(self, family=socket.AF_INET, type=socket.SOCK_DGRAM):
+        return ReplaySocket(self)
+
+
+class ReplaySocket(object):
+    """Answers the commands sent to it with the responses recorded for the
+    same commands, in the order they were recorded, with the tag of the new
+    command. Commands with no recorded response go unanswered."""
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.answers = defaultdict(list)
+        for (data, sent, response, received) in replay.exchanges():
+            if response is not None:
+                self.answers[split_command(data)[3]].append(
+                    (response, received - sent))
+
+        self.timeout = None
+        self.closed = False
+        self.inbox = Queue.Queue()
+        self.misses = 0
+
+    def bind(self, address):
+        pass
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def close(self):
+        self.closed = True
+        self.inbox.put(None)
+
+    def sendto(self, data, address):
+        if self.closed:
+            raise socket.error("Socket closed")
+
+        (_, tag, _, key) = split_command(data)
+        if not self.answers.get(key):
+            self.misses += 1
+            return len(data)
+
+        (response, rtt) = self.answers[key].pop(0)
+        compressed = response[:2] == "\x00\x00"
+        if compressed:
+            response = zlib.decompressobj().decompress(response[2:])
+        oldTag = response_tag(response)
+        if oldTag and tag:
+            response = tag + response[len(oldTag):]
+        if compressed:
+            response = "\x00\x00" + zlib.compress(response)
+
+        delay = rtt / self.replay.speed if self.replay.realtime else 0
+        if delay > 0:
+            timer = threading.Timer(delay, self.inbox.put, (response, ))
+            timer.setDaemon(True)
+            timer.start()
+        else:
+            self.inbox.put(response)
+        return len(data)
+
+    def recv(self, size):
+        try:
+            data = self.inbox.get(True, self.timeout)
+        except Queue.Empty:
+            raise socket.timeout("timed out")
+        if data is None or self.closed:
+            raise socket.error("Socket closed")
+        return data[:size]
@@ -0,0 +1,188 @@
+# This file is part of aDBa.
+#
+# aDBa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# aDBa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# Bans remembered for the logs
+HISTORY_LENGTH = 10
+
+
+class CircuitBreaker(object):
+    """Keeps the client from talking to AniDB while it's banned.
+
+    The breaker is closed while all is well. A ban opens it for a cooldown
+    period, during which nothing may be sent. Once the cooldown is over it's
+    half-open: a single packet is let through to probe whether the ban has
+    been lifted, and the others are held back until it's answered
+    (awaiting_probe). A normal response
+    closes the breaker again, another ban reopens it with the cooldown
+    doubled, up to `cap` seconds. The cooldown drops back to
+    `initialCooldown` once the breaker has stayed closed for `cap` seconds.
+
+    The state is saved to `statePath` on every change and restored on start,
+    so restarting the client doesn't cut a cooldown short.
+    """
+
+    def __init__(self, statePath=None, initialCooldown=3600, cap=48 * 3600,
+                 probeTimeout=60, clock=time.time):
+        self.statePath = statePath
+        self.initialCooldown = initialCooldown
+        self.cap = cap
+        self.probeTimeout = probeTimeout
+        self.clock = clock
+
+        self.lock = threading.Lock()
+
+        self.state = CLOSED
+        self.cooldown = None
+        self.until = None
+        self.closedAt = None
+        self.probing = None
+        self.history = []
+
+        self.load()
+
+    def closed(self):
+        return self.state == CLOSED
+
+    def blocked(self):
+        """Return whether requests should be given up on without trying,
+        which doesn't change the state and is cheap enough to check before
+        anything else."""
+        # Requests made while a probe is in flight are held back until it's
+        # answered, rather than given up on
+        return self.state == OPEN and self.clock() < self.until
+
+    def awaiting_probe(self):
+        """Return whether a probe is in flight, until which no other packet
+        is allowed."""
+        probing = self.probing
+        return self.state == HALF_OPEN and probing is not None and \
+            self.clock() < probing + self.probeTimeout
+
+    def allow(self):
+        """Return whether a packet may be sent. The first packet after the
+        cooldown becomes the probe, and no other is allowed until it has
+        been answered or `probeTimeout` seconds have passed."""
+        if self.state == CLOSED:
+            return True
+
+        with self.lock:
+            now = self.clock()
+            if self.state == OPEN:
+                if now < self.until:
+                    return False
+                self.state = HALF_OPEN
+            elif self.probing is not None and \
+                    now < self.probing + self.probeTimeout:
+                return False
+            self.probing = now
+
+        self.save()
+        return True
+
+    def trip(self, reason=None):
+        """Open the breaker after being told the client is banned."""
+        with self.lock:
+            now = self.clock()
+            if self.state == OPEN and now < self.until:
+                return
+
+            if self.cooldown is None or (self.state == CLOSED and
+                                         self.closedAt is not None and
+                                         now - self.closedAt >= self.cap):
+                self.cooldown = self.initialCooldown
+            else:
+                self.cooldown = min(self.cooldown * 2, self.cap)
+
+            self.state = OPEN
+            self.until = now + self.cooldown
+            self.probing = None
+            self.history.append({"time": now, "cooldown": self.cooldown,
+                                 "reason": reason and str(reason)})
+            del self.history[:-HISTORY_LENGTH]
+
+        self.save()
+
+    def success(self):
+        """Close the breaker after a normal response."""
+        if self.state == CLOSED:
+            return
+
+        with self.lock:
+            if self.state == OPEN:
+                return
+            self.state = CLOSED
+            self.closedAt = self.clock()
+            self.probing = None
+
+        self.save()
+
+    def remaining(self):
+        """Return the number of seconds left of the cooldown."""
+        if self.state != OPEN:
+            return 0
+        return max(0, self.until - self.clock())
+
+    def load(self):
+        if not self.statePath or not os.path.exists(self.statePath):
+            return
+
+        try:
+            with open(self.statePath, "r") as f:
+                state = json.load(f)
+            if state["state"] not in (CLOSED, OPEN, HALF_OPEN):
+                return
+            self.state = state["state"]
+            self.cooldown = state["cooldown"]
+            self.until = state["until"]
+            self.closedAt = state["closedAt"]
+            self.history = list(state["history"])
+        except (IOError, ValueError, KeyError, TypeError):
+            return
+
+        # A probe in flight when the client stopped won't be answered
+        if self.state == HALF_OPEN:
+            self.state = OPEN
+
+    def save(self):
+        if not self.statePath:
+            return
+
+        with self.lock:
+            state = {
+                "state": self.state,
+                "cooldown": self.cooldown,
+                "until": self.until,
+                "closedAt": self.closedAt,
+                "history": self.history,
+            }
+
+        temp = self.statePath + ".tmp"
+        try:
+            with open(temp, "w") as f:
+                json.dump(state, f)
+            if os.name == "nt" and os.path.exists(self.statePath):
+                os.remove(self.statePath)
+            os.rename(temp, self.statePath)
+        except (IOError, OSError):
+            pass
@@ -21,7 +21,7 @@ else:
     Log("Running under Plex")
 
 
-from threading import Lock
+from threading import Event, Lock
 import cgi
 
 
@@ -35,6 +35,9 @@ class Command(object):
         None: None
     }
 
+    # Whether sending the command twice is harmless, i.e. it only reads data
+    idempotent = False
+
     def __init__(self, command, **parameters):
         self.command = command
         self.parameters = parameters
@@ -42,9 +45,28 @@ class Command(object):
 
         self.mode = None
         self.callback = None
+        self.error = None
         self.waiter = Lock()
         self.waiter.acquire()
 
+        # Times the command has been sent, when it was first sent, and when
+        # it was queued to be sent
+        self.transmissions = 0
+        self.firstSent = None
+        self.queued = None
+        self.priority = None
+
+        # Identical commands sharing the response of this one, or the one
+        # whose response this one shares
+        self.followers = []
+        self.leader = None
+        self.finished = False
+        self.stateLock = Lock()
+
+        # Set once the command has been answered, failed or timed out
+        self.done = Event()
+        self.doneCallbacks = []
+
     def __repr__(self):
         return "Command(%s, %s) %s\n%s\n" % (
             repr(self.tag),
@@ -62,7 +84,27 @@ class Command(object):
         self.parameters['tag'] = tag
         self.parameters['s'] = session
 
+    def reset(self):
+        """Make the command ready to be sent again, after it failed for want
+        of a valid session."""
+        if hasattr(self, 'resp'):
+            del self.resp
+        self.error = None
+        self.waiter = Lock()
+        self.waiter.acquire()
+        self.transmissions = 0
+        self.firstSent = None
+        self.followers = []
+        self.leader = None
+        self.finished = False
+        self.done = Event()
+        self.doneCallbacks = []
+
     def handle(self, resp):
+        # A retransmitted command may be answered more than once
+        followers = self.finish()
+        if followers is None:
+            return
         self.resp = resp
 
         if self.mode == 1:
@@ -75,13 +117,99 @@ class Command(object):
             Log("Was told to handle response with mode %i -- this is not "
                 "supposed to happen!")
 
+        self.complete()
+        for follower in followers:
+            follower.handle(resp)
+
+    def fail(self, error):
+        """Give up on getting a response, making the waiting caller raise
+        `error`."""
+        followers = self.finish()
+        if followers is None:
+            return
+        self.error = error
+        self.waiter.release()
+        self.complete()
+
+        for follower in followers:
+            follower.fail(error)
+
+    def expire(self):
+        """Give up on getting a response, after the command timed out."""
+        followers = self.finish()
+        if followers is None:
+            return
+        self.waiter.release()
+        self.complete()
+
+        for follower in followers:
+            follower.expire()
+
+    def finish(self):
+        """Mark the command as finished, and return the followers that should
+        get the same outcome, or None if it had already finished."""
+        with self.stateLock:
+            if self.finished:
+                return None
+            self.finished = True
+            (followers, self.followers) = (self.followers, [])
+        return followers
+
+    def complete(self):
+        with self.stateLock:
+            self.done.set()
+            (callbacks, self.doneCallbacks) = (self.doneCallbacks, [])
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Call `callback` with the command once it's done, right away if it
+        already is."""
+        with self.stateLock:
+            if not self.done.isSet():
+                self.doneCallbacks.append(callback)
+                return
+        callback(self)
+
+    def follow(self, leader, mode, callback):
+        """Share the response of the identical command `leader` instead of
+        being sent. Returns False if `leader` has already finished."""
+        with leader.stateLock:
+            if leader.finished:
+                return False
+            self.mode = mode
+            self.callback = callback
+            self.tag = None
+            self.session = leader.session
+            self.leader = leader
+            leader.followers.append(self)
+        return True
+
+    def unfollow(self):
+        """Stop sharing the response of the leader. Returns False if it has
+        already been shared."""
+        with self.leader.stateLock:
+            if self not in self.leader.followers:
+                return False
+            self.leader.followers.remove(self)
+        return True
+
+    def key(self):
+        """Return a string identifying what the command asks for, regardless
+        of the tag and session it's sent with."""
+        parameters = dict(self.parameters)
+        parameters.pop('tag', None)
+        parameters.pop('s', None)
+        return self.flatten(self.command, parameters)
+
     def wait_response(self):
         self.waiter.acquire()
 
     def flatten(self, command, parameters):
         tmp = []
 
-        for key, value in parameters.iteritems():
+        # Sorted, so identical commands flatten identically
+        for key, value in sorted(parameters.iteritems()):
 
             if value is not None:
                 tmp.append("%s=%s" % (
@@ -257,6 +385,8 @@ class BuddyStateCommand(Command):
 
 # first run
 class AnimeCommand(Command):
+    idempotent = True
+
     def __init__(self, aid=None, aname=None, amask=None):
         if not (aid or aname):
             raise adb.resp.AniDBIncorrectParameterError(
@@ -271,6 +401,8 @@ class AnimeCommand(Command):
 
 
 class AnimeDescCommand(Command):
+    idempotent = True
+
     def __init__(self, aid=None, part=0):
         if not (aid):
             raise adb.resp.AniDBIncorrectParameterError(
@@ -283,6 +415,8 @@ class AnimeDescCommand(Command):
 
 
 class EpisodeCommand(Command):
+    idempotent = True
+
     def __init__(self, eid=None, aid=None, aname=None, epno=None):
         if not (eid or ((aname or aid) and epno)) or \
                 (aname and aid) or \
@@ -301,6 +435,8 @@ class EpisodeCommand(Command):
 
 
 class FileCommand(Command):
+    idempotent = True
+
     def __init__(self, fid=None, size=None, ed2k=None, aid=None, aname=None,
                  gid=None, gname=None, epno=None, fmask=None, amask=None):
         if not (fid or (size and ed2k) or ((aid or aname) and (gid or gname) and epno)) \
@@ -329,6 +465,8 @@ class FileCommand(Command):
 
 
 class GroupCommand(Command):
+    idempotent = True
+
     def __init__(self, gid=None, gname=None):
         if not (gid or gname) or (gid and gname):
             raise adb.resp.AniDBIncorrectParameterError(
@@ -342,6 +480,8 @@ class GroupCommand(Command):
 
 
 class GroupstatusCommand(Command):
+    idempotent = True
+
     def __init__(self, aid=None, status=None):
         if not aid:
             raise adb.resp.AniDBIncorrectParameterError(
@@ -355,6 +495,8 @@ class GroupstatusCommand(Command):
 
 
 class ProducerCommand(Command):
+    idempotent = True
+
     def __init__(self, pid=None, pname=None):
         if not (pid or pname) or (pid and pname):
             raise adb.resp.AniDBIncorrectParameterError(
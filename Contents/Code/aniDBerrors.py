@@ -26,6 +26,10 @@ class AniDBCommandTimeoutError(AniDBError):
     pass
 
 
+class AniDBCancelledError(AniDBError):
+    pass
+
+
 class AniDBMustAuthError(AniDBError):
     pass
 
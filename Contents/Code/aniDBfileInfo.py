@@ -14,43 +14,431 @@
 # along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import with_statement
+import ctypes
+import ctypes.util
 import hashlib
+import multiprocessing
 import os
+import platform
+import sys
+import threading
+import zlib
+from time import time, sleep
 from lxml.etree import ElementTree as etree
-import urllib
 
 
-# http://www.radicand.org/blog/orz/2010/2/21/edonkey2000-hash-in-python/
-def get_file_hash(filePath):
-    """ Returns the ed2k hash of a given file."""
+# Size of the blocks an ed2k hash is made of, as defined by the eDonkey2000
+# network. Every full block is MD4-hashed on its own, and the ed2k hash of a
+# file with more than one block is the MD4 hash of the block hashes.
+ED2K_CHUNK_SIZE = 9728000
+
+# Number of ed2k blocks between two checkpoints of a resumable hash.
+CHECKPOINT_CHUNKS = 64
+
+# Size of each of the blocks sampled by get_file_fingerprint.
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+
+
+class Ed2kHash(object):
+    """Incremental ed2k hasher.
+
+    Data can be fed in slices of any size; the hasher keeps track of the ed2k
+    block boundaries itself. Block digests are appended to `chunkHashes` as
+    soon as a block is complete.
+
+    Hashing can be resumed by passing the block digests of the start of the
+    file as `chunkHashes`, and feeding the data that follows them.
+    """
+
+    def __init__(self, chunkHashes=None):
+        self.chunkHashes = list(chunkHashes or [])
+        self.size = len(self.chunkHashes) * ED2K_CHUNK_SIZE
+        self._current = hashlib.new('md4')
+        self._currentSize = 0
+
+    def update(self, data):
+        """Feed a string, buffer or memoryview of file data to the hasher."""
+        offset = 0
+        length = len(data)
+        while offset < length:
+            wanted = ED2K_CHUNK_SIZE - self._currentSize
+            if offset == 0 and length <= wanted:
+                piece = data
+            else:
+                piece = data[offset:offset + wanted]
+            self._current.update(piece)
+            self._currentSize += len(piece)
+            offset += len(piece)
+
+            if self._currentSize == ED2K_CHUNK_SIZE:
+                self.chunkHashes.append(self._current.digest())
+                self._current = hashlib.new('md4')
+                self._currentSize = 0
+
+        self.size += length
+
+    def digest(self):
+        hashes = list(self.chunkHashes)
+        if self._currentSize:
+            hashes.append(self._current.digest())
+
+        # A file of at most one block is identified by that block's digest.
+        # Note that a file of exactly ED2K_CHUNK_SIZE bytes is hashed without
+        # the trailing empty block some clients append.
+        if len(hashes) == 1:
+            return hashes[0]
+        return hashlib.new('md4', "".join(hashes)).digest()
+
+    def hexdigest(self):
+        return self.digest().encode("hex")
+
+
+class Crc32Hash(object):
+    """CRC32 checksum with the same interface as the hashlib hashes."""
+
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, data):
+        # zlib won't take a memoryview
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.crc = zlib.crc32(data, self.crc)
+
+    def digest(self):
+        return self.hexdigest().decode("hex")
+
+    def hexdigest(self):
+        return "%08x" % (self.crc & 0xffffffff)
+
+
+# Hashes supported by get_file_hashes, named like the matching file fields
+# of the UDP API.
+HASHES = {
+    "ed2k": Ed2kHash,
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "crc32": Crc32Hash,
+}
+
+
+# posix_fadvise(2) advice values on Linux
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+# ioprio_set(2) values and syscall numbers, which depend on the architecture
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+SYS_IOPRIO = {
+    "x86_64": (251, 252),
+    "i386": (289, 290),
+    "i686": (289, 290),
+    "aarch64": (30, 31),
+    "armv7l": (314, 315),
+}
+
+_libc = None
+
+
+def _get_libc():
+    """Return the C library, or False if there's none to be found."""
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        except (OSError, TypeError):
+            _libc = False
+    return _libc
+
+
+def _get_fadvise():
+    """Return posix_fadvise with its argument types set, or None on platforms
+    without it."""
+    libc = _get_libc()
+    fadvise = getattr(libc, "posix_fadvise64", None)
+    offset = ctypes.c_int64
+    if fadvise is None:
+        # Takes an off_t, which is a long unless built for large files
+        fadvise = getattr(libc, "posix_fadvise", None)
+        offset = ctypes.c_long
+    if fadvise is None:
+        return None
+    fadvise.argtypes = [ctypes.c_int, offset, offset, ctypes.c_int]
+    return fadvise
+
+
+_posix_fadvise = _get_fadvise()
+
+
+def _fadvise(f, offset, length, advice):
+    """posix_fadvise, or nothing on platforms without it."""
+    if _posix_fadvise is not None:
+        _posix_fadvise(f.fileno(), offset, length, advice)
+
+
+def _ioprio(value=None):
+    """Set the I/O priority of the calling thread to `value` and return the
+    previous priority, or return None if I/O priorities aren't supported."""
+    if not sys.platform.startswith("linux") or \
+            SYS_IOPRIO.get(platform.machine()) is None:
+        return None
+    (setNr, getNr) = SYS_IOPRIO[platform.machine()]
+
+    syscall = getattr(_get_libc(), "syscall", None)
+    if syscall is None:
+        return None
+    previous = syscall(getNr, IOPRIO_WHO_PROCESS, 0)
+    if previous < 0:
+        return None
+    if value is not None:
+        syscall(setNr, IOPRIO_WHO_PROCESS, 0, value)
+    return previous
+
+
+class IOBudget(object):
+    """Limits on how hard hashing may hit the disks, to keep it from getting
+    in the way of playback.
+
+    rate      - maximum read rate, in bytes per second (default: unlimited)
+    dropCache - drop what has been read from the page cache, so hashing
+                doesn't evict data other processes are using
+    idle      - read at idle I/O priority (Linux only)
+    """
+
+    def __init__(self, rate=None, dropCache=True, idle=True):
+        self.rate = rate
+        self.dropCache = dropCache
+        self.idle = idle
+
+    def track(self, f):
+        """Return an IOBudgetSession for reading the open file `f`."""
+        return IOBudgetSession(self, f)
+
+
+class IOBudgetSession(object):
+    """Applies an IOBudget to the reads of a single file."""
+
+    def __init__(self, budget, f):
+        self.budget = budget
+        self.f = f
+        self.started = time()
+        self.read = 0
+        self.dropped = f.tell()
+
+        self.previousPriority = None
+        if budget.idle:
+            self.previousPriority = _ioprio(
+                IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+
+        _fadvise(f, 0, 0, POSIX_FADV_SEQUENTIAL)
+
+    def account(self, length):
+        """Take `length` bytes that were just read off the budget."""
+        self.read += length
+
+        if self.budget.dropCache:
+            position = self.f.tell()
+            _fadvise(self.f, self.dropped, position - self.dropped,
+                     POSIX_FADV_DONTNEED)
+            self.dropped = position
+
+        if self.budget.rate:
+            ahead = self.read / float(self.budget.rate) - \
+                (time() - self.started)
+            if ahead > 0:
+                sleep(ahead)
+
+    def close(self):
+        if self.previousPriority is not None:
+            _ioprio(self.previousPriority)
+
+
+def read_file(f, bufferSize=None, budget=None):
+    """Yield the contents of the open file `f` as buffers of at most
+    `bufferSize` bytes, reading within the limits of the IOBudget `budget`.
+
+    A single buffer is reused for every read, so the yielded slices are only
+    valid until the next iteration.
+    """
+    if not bufferSize:
+        bufferSize = ED2K_CHUNK_SIZE
+    data = bytearray(bufferSize)
+    view = memoryview(data)
+    session = budget.track(f) if budget else None
+    try:
+        while True:
+            length = f.readinto(data)
+            if not length:
+                break
+            if session:
+                session.account(length)
+            if length == bufferSize:
+                yield view
+            else:
+                yield view[:length]
+    finally:
+        if session:
+            session.close()
+
+
+def get_file_hash(filePath, bufferSize=None, chunkHashes=None,
+                  checkpoint=None, budget=None):
+    """ Returns the ed2k hash of a given file.
+
+    chunkHashes - digests of the first ed2k blocks of the file, from an
+                  earlier checkpoint. Hashing resumes after these blocks.
+    checkpoint  - called with the list of digests of the complete blocks
+                  every CHECKPOINT_CHUNKS blocks, and once hashing is done.
+    budget      - IOBudget to read the file within
+    """
+    if not filePath:
+        return None
+
+    hasher = Ed2kHash(chunkHashes)
+    checkpointed = len(hasher.chunkHashes)
+    with open(filePath, "rb") as f:
+        f.seek(hasher.size)
+        for data in read_file(f, bufferSize, budget):
+            hasher.update(data)
+            if checkpoint and len(hasher.chunkHashes) >= \
+                    checkpointed + CHECKPOINT_CHUNKS:
+                checkpointed = len(hasher.chunkHashes)
+                checkpoint(hasher.chunkHashes[:])
+
+    if checkpoint and len(hasher.chunkHashes) != checkpointed:
+        checkpoint(hasher.chunkHashes[:])
+    return hasher.hexdigest()
+
+
+def check_chunk_hashes(filePath, digests, budget=None):
+    """Return how many of the first ed2k blocks of a given file still have
+    the digests `digests`, reading the file within the limits of the
+    IOBudget `budget`."""
+    hasher = Ed2kHash()
+    checked = 0
+    try:
+        with open(filePath, "rb") as f:
+            blocks = read_file(f, budget=budget)
+            try:
+                for data in blocks:
+                    hasher.update(data)
+                    for index in xrange(checked, min(len(hasher.chunkHashes),
+                                                     len(digests))):
+                        if hasher.chunkHashes[index] != digests[index]:
+                            return index
+                        checked += 1
+                    if checked == len(digests):
+                        break
+            finally:
+                blocks.close()
+    except (IOError, OSError):
+        return 0
+    return checked
+
+
+def get_file_hashes(filePath, algorithms=("ed2k", ), bufferSize=None,
+                    budget=None):
+    """Returns a dictionary of the hex digests of a given file for each of
+    the `algorithms` in HASHES, computed in a single pass over the file and
+    within the limits of the IOBudget `budget`."""
+    if not filePath:
+        return None
+
+    hashers = [(name, HASHES[name]()) for name in algorithms]
+    with open(filePath, "rb") as f:
+        for data in read_file(f, bufferSize, budget):
+            for (name, hasher) in hashers:
+                hasher.update(data)
+
+    return dict((name, hasher.hexdigest()) for (name, hasher) in hashers)
+
+
+def get_file_fingerprint(filePath):
+    """Returns a cheap fingerprint of a given file, made from its size and its
+    first, middle and last FINGERPRINT_BLOCK_SIZE bytes.
+
+    Unlike the ed2k hash this only reads a few blocks of the file, so it's
+    suitable for recognising files that have been moved or renamed. Files
+    that only differ outside of the sampled blocks have the same fingerprint.
+    """
+    if not filePath:
+        return None
+
+    size = get_file_size(filePath)
+    blockSize = FINGERPRINT_BLOCK_SIZE
+    offsets = sorted(set([0,
+                          max(0, (size - blockSize) // 2),
+                          max(0, size - blockSize)]))
+
+    sha1 = hashlib.sha1(str(size))
+    with open(filePath, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            sha1.update(f.read(blockSize))
+    return sha1.hexdigest()
+
+
+def _hash_chunk_range(filePath, first, last, hashes, bufferSize):
+    """Hash the ed2k blocks `first` up to, but not including, `last` of
+    `filePath` into the matching slots of `hashes`."""
+    data = bytearray(min(bufferSize, ED2K_CHUNK_SIZE))
+    view = memoryview(data)
+    with open(filePath, "rb") as f:
+        f.seek(first * ED2K_CHUNK_SIZE)
+        for index in xrange(first, last):
+            md4 = hashlib.new('md4')
+            remaining = ED2K_CHUNK_SIZE
+            while remaining:
+                length = f.readinto(view[:min(remaining, len(data))])
+                if not length:
+                    break
+                md4.update(view[:length])
+                remaining -= length
+            hashes[index] = md4.digest()
+
+
+def get_file_hash_threaded(filePath, threads=4, bufferSize=None):
+    """Returns the ed2k hash of a given file, hashing ranges of its blocks on
+    `threads` threads at once.
+
+    This only pays off for large files on storage that handles concurrent
+    reads well, as each thread reads its own part of the file.
+    """
     if not filePath:
         return None
-    md4 = hashlib.new('md4').copy
-
-    def gen_hashes(f):
-        result = []
-        x = f.read(9728000)
-        while x:
-            result.append(md4_hash(x).digest())
-            x = f.read(9728000)
-        return result
-
-    def md4_hash(data):
-        m = md4()
-        m.update(data)
-        return m
-
-    if os.name == "nt":
-        path = r'file:///%s' % filePath.replace('\\', '/')
-    else:
-        path = r'file://%s' % filePath
-
-    f = urllib.urlopen(path)
-    hashes = gen_hashes(f)
+    if not bufferSize:
+        bufferSize = ED2K_CHUNK_SIZE
+
+    size = get_file_size(filePath)
+    chunks = (size + ED2K_CHUNK_SIZE - 1) // ED2K_CHUNK_SIZE
+    hashes = [None] * chunks
+    errors = []
+
+    def worker(first, last):
+        try:
+            _hash_chunk_range(filePath, first, last, hashes, bufferSize)
+        except Exception, e:
+            errors.append(e)
+
+    threads = max(1, min(threads, chunks))
+    perThread = (chunks + threads - 1) // threads if chunks else 0
+    workers = []
+    for first in xrange(0, chunks, perThread or 1):
+        thread = threading.Thread(target=worker,
+                                  args=(first, min(first + perThread, chunks)))
+        thread.start()
+        workers.append(thread)
+
+    for thread in workers:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
     if len(hashes) == 1:
         return hashes[0].encode("hex")
-    else:
-        return md4_hash(reduce(lambda a, d: a + d, hashes, "")).hexdigest()
+    return hashlib.new('md4', "".join(hashes)).hexdigest()
 
 
 def get_file_size(path):
@@ -58,6 +446,43 @@ def get_file_size(path):
     return size
 
 
+def _hash_file_worker(args):
+    (filePath, bufferSize, budget) = args
+    try:
+        return (filePath, get_file_hash(filePath, bufferSize, budget=budget),
+                get_file_size(filePath))
+    except (IOError, OSError):
+        return (filePath, None, None)
+
+
+def hash_files(filePaths, workers=None, maxMemory=None, budget=None):
+    """Hash many files in parallel on a pool of worker processes.
+
+    Yields a (path, ed2k, size) tuple for every path as soon as it has been
+    hashed, so results don't come back in the order they were given. Files
+    that can't be read are yielded with an ed2k and size of None.
+
+    workers   - number of worker processes (default: one per CPU)
+    maxMemory - upper bound for the read buffer of each worker, in bytes
+                (default: one ed2k block)
+    budget    - IOBudget each worker reads its files within
+    """
+    bufferSize = ED2K_CHUNK_SIZE
+    if maxMemory:
+        bufferSize = max(min(maxMemory, ED2K_CHUNK_SIZE), 4096)
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        jobs = ((filePath, bufferSize, budget) for filePath in filePaths)
+        for result in pool.imap_unordered(_hash_file_worker, jobs):
+            yield result
+        pool.close()
+    finally:
+        # Doesn't wait for outstanding work if the caller stopped iterating
+        pool.terminate()
+        pool.join()
+
+
 def read_xml_into_etree(filePath):
         if not filePath:
             return None
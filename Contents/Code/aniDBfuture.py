@@ -0,0 +1,171 @@
+# This file is part of aDBa.
+#
+# aDBa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# aDBa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
+
+import Queue
+import threading
+from time import time
+from aniDBerrors import AniDBCancelledError, AniDBCommandTimeoutError
+
+
+class CommandFuture(object):
+    """The pending response of a command submitted with Connection.submit.
+
+    result() waits for the response and returns it, or raises the error the
+    command failed with, like Connection.handle does.
+    """
+
+    def __init__(self, connection, command, following):
+        self.connection = connection
+        self.command = command
+        self.following = following
+
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.resolved = False
+        self.value = None
+        self.error = None
+
+    def done(self):
+        return self.cancelled or self.command.done.isSet()
+
+    def cancel(self):
+        """Try to cancel the command. Returns False if it has already been
+        answered.
+
+        A command that hasn't been sent yet is dropped from the queue, and a
+        command that has been sent is no longer waited for.
+        """
+        if self.command.done.isSet():
+            return False
+        self.cancelled = True
+        self.connection.abandon(self.command, self.following)
+        return True
+
+    def add_done_callback(self, callback):
+        """Call `callback` with the future once the command is done."""
+        self.command.add_done_callback(lambda command: callback(self))
+
+    def result(self, timeout=None):
+        """Return the response, waiting at most `timeout` seconds for it."""
+        if self.cancelled:
+            raise AniDBCancelledError("%s was cancelled" %
+                                      self.command.command)
+        if not self.command.done.wait(timeout):
+            raise AniDBCommandTimeoutError("Timed out waiting for %s" %
+                                           self.command.command)
+
+        # Handling the response may re-authenticate and resend the command,
+        # which should only happen once.
+        with self.lock:
+            if not self.resolved:
+                try:
+                    self.value = self.connection.finish(self.command)
+                except Exception, e:
+                    self.error = e
+                self.resolved = True
+
+        if self.error:
+            raise self.error
+        return self.value
+
+    def exception(self, timeout=None):
+        """Return the error the command failed with, or None."""
+        if not self.cancelled and not self.command.done.wait(timeout):
+            raise AniDBCommandTimeoutError("Timed out waiting for %s" %
+                                           self.command.command)
+        try:
+            self.result()
+        except AniDBCancelledError:
+            raise
+        except Exception, e:
+            return e
+        return None
+
+
+class Batch(object):
+    """A list of commands submitted together with Connection.batch.
+
+    The results can be streamed in the order the commands were given in
+    (results) or in the order they arrive in (as_completed), as (index,
+    response, error) tuples where one of response and error is None. A
+    failing command doesn't stop the others.
+    """
+
+    def __init__(self, connection, commands, priority=None):
+        self.connection = connection
+        self.commands = list(commands)
+        self.started = time()
+
+        self.arrived = Queue.Queue()
+        self.futures = []
+        for (index, command) in enumerate(self.commands):
+            future = connection.submit(command, priority)
+            future.add_done_callback(
+                lambda future, index=index: self.arrived.put(index))
+            self.futures.append(future)
+
+    def __len__(self):
+        return len(self.futures)
+
+    def outcome(self, index, timeout=None):
+        try:
+            return (index, self.futures[index].result(timeout), None)
+        except AniDBCommandTimeoutError:
+            if not self.futures[index].done():
+                raise
+            return (index, None, self.futures[index].exception())
+        except Exception, e:
+            return (index, None, e)
+
+    def results(self, timeout=None):
+        """Yield the outcome of every command in order, waiting at most
+        `timeout` seconds for each."""
+        for index in xrange(len(self.futures)):
+            yield self.outcome(index, timeout)
+
+    def as_completed(self, timeout=None):
+        """Yield the outcome of every command as soon as it's done, waiting
+        at most `timeout` seconds for each."""
+        for _ in xrange(len(self.futures)):
+            try:
+                index = self.arrived.get(True, timeout)
+            except Queue.Empty:
+                raise AniDBCommandTimeoutError("Timed out waiting for the "
+                                               "batch")
+            yield self.outcome(index)
+
+    def wait(self, timeout=None):
+        """Return the responses in order, with None for the commands that
+        failed."""
+        return [response for (_, response, _) in self.results(timeout)]
+
+    def completed(self):
+        return len([future for future in self.futures if future.done()])
+
+    def eta(self):
+        """Return the estimated number of seconds until every command is
+        done."""
+        done = self.completed()
+        remaining = len(self.futures) - done
+        if not remaining:
+            return 0
+        if done:
+            return (time() - self.started) / done * remaining
+        return remaining * self.connection.link.rateLimiter.longInterval
+
+    def cancel(self):
+        """Cancel the commands that haven't been answered yet."""
+        for future in self.futures:
+            future.cancel()
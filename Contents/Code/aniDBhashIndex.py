@@ -0,0 +1,223 @@
+# This file is part of aDBa.
+#
+# aDBa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# aDBa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import threading
+import aniDBfileInfo as fileInfo
+
+
+class HashIndex(object):
+    """On-disk index of the ed2k hashes of local files.
+
+    Entries are keyed on the file path, and are only trusted as long as the
+    device, inode, size and modification time of the file still match the
+    ones recorded when it was hashed. A stale entry is dropped on lookup.
+
+    Entries also store the fingerprint of the file (see
+    aniDBfileInfo.get_file_fingerprint), which lets a file that has been
+    moved or renamed be recognised without hashing it again.
+
+    The digests of the ed2k blocks of a file are checkpointed separately,
+    keyed on its device and inode, so that hashing an interrupted or grown
+    file picks up where it left off. If the file was modified since the
+    checkpoint, the blocks are checked against the file first, and hashing
+    resumes after the last one that's unchanged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Let paths that aren't valid UTF-8 through untouched.
+        self.db.text_factory = str
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "path TEXT PRIMARY KEY, "
+                        "device INTEGER, "
+                        "inode INTEGER, "
+                        "size INTEGER, "
+                        "mtime REAL, "
+                        "ed2k TEXT)")
+
+        columns = [row[1] for row in
+                   self.db.execute("PRAGMA table_info(files)")]
+        if "fingerprint" not in columns:
+            self.db.execute("ALTER TABLE files ADD COLUMN fingerprint TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_fingerprint "
+                        "ON files (size, fingerprint)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks ("
+                        "path TEXT PRIMARY KEY, "
+                        "device INTEGER, "
+                        "inode INTEGER, "
+                        "hashes BLOB)")
+
+        columns = [row[1] for row in
+                   self.db.execute("PRAGMA table_info(chunks)")]
+        if "mtime" not in columns:
+            self.db.execute("ALTER TABLE chunks ADD COLUMN mtime REAL")
+        self.db.commit()
+
+    def stat(self, filePath):
+        """Return the (device, inode, size, mtime) tuple identifying the
+        current version of `filePath`."""
+        st = os.stat(filePath)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    def lookup(self, filePath, stat=None):
+        """Return the indexed (ed2k, size) of `filePath`, or None if the file
+        hasn't been hashed or has changed since."""
+        if stat is None:
+            stat = self.stat(filePath)
+
+        with self.lock:
+            row = self.db.execute("SELECT device, inode, size, mtime, ed2k "
+                                  "FROM files WHERE path = ?",
+                                  (filePath, )).fetchone()
+            if row is None:
+                return None
+
+            if tuple(row[:4]) != tuple(stat):
+                self.db.execute("DELETE FROM files WHERE path = ?",
+                                (filePath, ))
+                self.db.commit()
+                return None
+
+        return (row[4], row[2])
+
+    def lookup_fingerprint(self, size, fingerprint):
+        """Return the ed2k of a moved or renamed file with the given size and
+        fingerprint, or None if there's no such file.
+
+        The file is only considered moved if none of the indexed paths with
+        that fingerprint exist anymore and they all agree on the ed2k hash.
+        Their entries are dropped, as they have been superseded by the new
+        path.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT path, ed2k FROM files "
+                                   "WHERE size = ? AND fingerprint = ?",
+                                   (size, fingerprint)).fetchall()
+
+            if not rows or len(set(row[1] for row in rows)) != 1:
+                return None
+
+            if [True for row in rows if os.path.exists(row[0])]:
+                return None
+
+            self.db.executemany("DELETE FROM files WHERE path = ?",
+                                [(row[0], ) for row in rows])
+            self.db.commit()
+
+        return rows[0][1]
+
+    def store(self, filePath, ed2k, size, stat=None, fingerprint=None):
+        """Record the ed2k hash of `filePath`.
+
+        `stat` should be taken before the file was hashed, so that changes
+        made to the file while hashing invalidates the entry.
+        """
+        if stat is None:
+            stat = self.stat(filePath)
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files "
+                            "(path, device, inode, size, mtime, ed2k, "
+                            "fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (filePath, ) + tuple(stat[:2]) +
+                            (size, stat[3], ed2k, fingerprint))
+            self.db.commit()
+
+    def load_chunks(self, filePath, stat):
+        """Return the checkpointed ed2k block digests of `filePath` and the
+        modification time of the file when they were checkpointed, or None if
+        there are none for the current file at that path."""
+        with self.lock:
+            row = self.db.execute("SELECT device, inode, hashes, mtime "
+                                  "FROM chunks WHERE path = ?",
+                                  (filePath, )).fetchone()
+
+        if row is None or tuple(row[:2]) != tuple(stat[:2]):
+            return None
+
+        data = str(row[2])
+        hashes = [data[i:i + 16] for i in xrange(0, len(data), 16)]
+        if len(hashes) * fileInfo.ED2K_CHUNK_SIZE > stat[2]:
+            return None
+        return (hashes, row[3])
+
+    def store_chunks(self, filePath, stat, hashes):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO chunks "
+                            "(path, device, inode, hashes, mtime) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (filePath, stat[0], stat[1],
+                             sqlite3.Binary("".join(hashes)), stat[3]))
+            self.db.commit()
+
+    def hash(self, filePath, log, budget=None):
+        """Return the (ed2k, size) of `filePath`, only hashing the file if it
+        isn't in the index yet. The file is read within the limits of the
+        aniDBfileInfo.IOBudget `budget`."""
+        stat = self.stat(filePath)
+        cached = self.lookup(filePath, stat)
+        if cached:
+            log("Found the ed2k in the hash index")
+            return cached
+
+        # The file might just have been moved or renamed
+        fingerprint = fileInfo.get_file_fingerprint(filePath)
+        ed2k = self.lookup_fingerprint(stat[2], fingerprint)
+        if ed2k:
+            log("Found the ed2k of a moved file in the hash index")
+            self.store(filePath, ed2k, stat[2], stat, fingerprint)
+            return (ed2k, stat[2])
+
+        # Resume from the last checkpoint. If the file was modified since,
+        # only the blocks that are unchanged can be kept: for a file that
+        # has been appended to that's all of them.
+        chunkHashes = None
+        checkpointed = self.load_chunks(filePath, stat)
+        if checkpointed:
+            (chunkHashes, mtime) = checkpointed
+            if mtime != stat[3]:
+                unchanged = fileInfo.check_chunk_hashes(filePath, chunkHashes,
+                                                        budget)
+                chunkHashes = chunkHashes[:unchanged]
+
+        if chunkHashes:
+            log("Resuming the ed2k calculation after block %i. Please "
+                "wait..." % len(chunkHashes))
+        else:
+            log("Calculating the ed2k. Please wait...")
+
+        ed2k = fileInfo.get_file_hash(
+            filePath, chunkHashes=chunkHashes,
+            checkpoint=lambda hashes: self.store_chunks(filePath, stat,
+                                                        hashes),
+            budget=budget)
+        size = fileInfo.get_file_size(filePath)
+        self.store(filePath, ed2k, size, stat, fingerprint)
+        return (ed2k, size)
+
+    def forget(self, filePath):
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE path = ?", (filePath, ))
+            self.db.execute("DELETE FROM chunks WHERE path = ?", (filePath, ))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -21,23 +21,90 @@ else:
     Log("Running under Plex")
 
 
+import heapq
+import itertools
 import socket
 import sys
 import zlib
-from time import time, sleep
+from time import time
 import threading
 from aniDBresponses import ResponseResolver
+from aniDBrateLimiter import RateLimiter, monotonic
+from aniDBcircuitBreaker import CircuitBreaker
+from aniDBmetrics import MetricsRegistry
 import aniDBerrors as err
 
+# Longest the link thread waits for a packet before checking deadlines again
+POLL_INTERVAL = 0.5
+
+# Commands are tagged T001 to T999, so no more can be waiting for a response
+MAX_TAGS = 999
+
+
+class RttEstimator(object):
+    """Round trip time estimate of one type of command, from which the
+    retransmission timeout is derived as in RFC 6298."""
+
+    def __init__(self, initialRto=4.0, minRto=1.0, maxRto=20.0):
+        self.minRto = minRto
+        self.maxRto = maxRto
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initialRto
+        self.samples = 0
+        self.retransmissions = 0
+        self.timeouts = 0
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples += 1
+        self.rto = min(self.maxRto,
+                       max(self.minRto, self.srtt + 4 * self.rttvar))
+
+    def timeout(self, transmission):
+        """Return the timeout for the `transmission`th sending of a command,
+        doubling with every retransmission."""
+        return min(self.maxRto, self.rto * 2 ** (transmission - 1))
+
+    def stats(self):
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "rto": self.rto,
+                "samples": self.samples,
+                "retransmissions": self.retransmissions,
+                "timeouts": self.timeouts}
+
 
 class AniDBLink(threading.Thread):
-    def __init__(self, server, port, myport, logFunction, delay=2, timeout=20,
-                 logPrivate=False):
+    """Sends commands to the AniDB UDP API and dispatches the responses.
+
+    Every packet sent gets a deadline. Idempotent commands that aren't
+    answered in time are handed to `retransmitter` (usually the
+    RequestScheduler, so they go through the rate limiter again) up to
+    `maxTransmissions` times, with the timeout adapted to the measured
+    round trip time of that type of command and doubled on every retry.
+    Other commands, and commands that haven't been answered within
+    `timeout` seconds of being first sent, are given up on.
+
+    Every packet sent and received is recorded to `capture`, a
+    PacketCapture, if given. `transport` replaces socket.socket for creating
+    the socket, for replaying a capture instead of talking to AniDB.
+    """
+
+    def __init__(self, server, port, myport, logFunction, timeout=20,
+                 logPrivate=False, rateLimiter=None, maxTransmissions=3,
+                 circuitBreaker=None, metrics=None, capture=None,
+                 transport=None):
         threading.Thread.__init__(self)
         self.server = server
         self.port = port
         self.target = (server, port)
         self.timeout = timeout
+        self.capture = capture
+        self.transport = transport or socket.socket
 
         self.myport = 0
         self.bound = self.connectSocket(myport, self.timeout)
@@ -46,23 +113,53 @@ class AniDBLink(threading.Thread):
         self.resp_tagged_queue = {}
         self.resp_untagged_queue = []
         self.tags = []
+        self.tagLock = threading.Lock()
+        self.lastTag = 0
         self.lastpacket = time()
-        self.delay = delay
+        self.rateLimiter = rateLimiter or RateLimiter()
+
+        self.maxTransmissions = maxTransmissions
+        self.retransmitter = None
+        self.latency = {}
+        self.deadlines = []
+        self.deadlineLock = threading.Lock()
+        self.sequence = itertools.count()
         self.session = None
-        self.banned = False
+        self.circuitBreaker = circuitBreaker or CircuitBreaker()
+        self.metrics = metrics or MetricsRegistry()
         self.banmsg = "Unknown"
         self.crypt = None
 
         self.log = logFunction
         self.logPrivate = logPrivate
 
+        # Called with the link, the commands it was waiting on and the error
+        # when the link thread dies
+        self.onDeath = None
+        self.dead = False
+
         self.stopp = threading.Event()
         self.quiting = False
         self.setDaemon(True)
         self.start()
 
+    def respawn(self):
+        """Return a new link with the same settings and state, to take over
+        from this one after it died."""
+        link = AniDBLink(self.server, self.port, self.myport, self.log,
+                         self.timeout, self.logPrivate, self.rateLimiter,
+                         self.maxTransmissions, self.circuitBreaker,
+                         self.metrics, self.capture, self.transport)
+        with self.tagLock:
+            link.tags = list(self.tags)
+            link.lastTag = self.lastTag
+        link.latency = dict(self.latency)
+        link.session = self.session
+        link.banmsg = self.banmsg
+        return link
+
     def connectSocket(self, myport, timeout):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock = self.transport(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.settimeout(timeout)
         portlist = [myport] + [7654]
         for port in portlist:
@@ -79,12 +176,27 @@ class AniDBLink(threading.Thread):
     def disconnectSocket(self):
         self.sock.close()
 
-    def stop(self):
+    def stop(self, error=None):
+        """Stop the link, failing the commands still waiting for a response
+        with `error`."""
         self.log("Releasing socket and stopping link thread")
         self.quiting = True
         self.disconnectSocket()
         self.stopp.set()
 
+        pending = self.cmd_queue.values()
+        self.cmd_queue = {}
+        with self.deadlineLock:
+            self.deadlines = []
+
+        error = error or err.AniDBError("connection closed")
+        for cmd in pending:
+            self.release_tag(cmd.tag)
+            cmd.fail(error)
+
+        if self.capture:
+            self.capture.close()
+
     def stopped(self):
         return self.stopp.isSet()
 
@@ -96,13 +208,22 @@ class AniDBLink(threading.Thread):
 
     def run(self):
         while not self.quiting:
+            self.handle_timeouts()
             try:
+                self.sock.settimeout(self.next_wait())
                 data = self.sock.recv(8192)
             except socket.timeout:
-                self.handle_timeouts()
-
                 continue
+            except socket.error, e:
+                if self.quiting:
+                    break
+                self.die(e)
+                return
             self.log("NetIO < %s" % repr(data))
+            received = monotonic()
+            if self.capture:
+                self.capture.inbound(data)
+            cmd = None
             try:
                 for i in range(2):
                     try:
@@ -124,10 +245,18 @@ class AniDBLink(threading.Thread):
                         "packet failed"
                     )
                 cmd = self.cmd_dequeue(resp)
+                if resp.restag and cmd is None:
+                    self.log("Dropping response to unknown or expired tag "
+                             "%s" % resp.restag)
+                    continue
+                self.measure(cmd, received)
                 Log(repr(cmd))
                 resp = resp.resolve(cmd)
                 resp.parse()
                 Log(repr(resp))
+                self.metrics.histogram(
+                    "parse_seconds", command=cmd.command if cmd else None
+                ).observe(monotonic() - received)
                 if resp.rescode in ('200', '201'):
                     self.session = resp.attrs['sesskey']
                 if resp.rescode in ('209',):
@@ -141,7 +270,7 @@ class AniDBLink(threading.Thread):
                     self.session = None
                     self.crypt = None
                 elif resp.rescode in ('504', '555'):
-                    self.banned = True
+                    self.circuitBreaker.trip(resp.resstr)
                     self.banmsg = resp
                     Log("AniDB API informs that user or client is banned:",
                         resp)
@@ -151,43 +280,130 @@ class AniDBLink(threading.Thread):
                 else:
                     Log("Got unhandled status code %s, proceeding as usual." %
                         resp.rescode.__repr__())
+                if resp.rescode not in ('504', '555'):
+                    self.circuitBreaker.success()
                 resp.handle()
                 if not cmd or not cmd.mode:
                     self.resp_queue(resp)
                 else:
-                    self.tags.remove(resp.restag)
-            except:
+                    self.release_tag(resp.restag)
+            except Exception, e:
                 sys.excepthook(*sys.exc_info())
-                Log("Avoiding flood by paranoidly panicing: Aborting link "
-                    "thread, killing connection, releasing waiters and "
-                    "quiting")
-                self.sock.close()
+                self.die(e, cmd)
+                return
+
+    def die(self, error, current=None):
+        """Stop the link after an unexpected error, handing the commands
+        still waiting for a response to onDeath, or giving up on them."""
+        Log("Avoiding flood by paranoidly panicing: Aborting link "
+            "thread, killing connection, releasing waiters and "
+            "quiting")
+        self.dead = True
+        self.metrics.counter("link_deaths",
+                             error=error.__class__.__name__).inc()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+        pending = self.cmd_queue.values()
+        if current is not None and current not in pending and \
+                not current.finished:
+            pending.append(current)
+        self.cmd_queue = {}
+        with self.deadlineLock:
+            self.deadlines = []
 
-                try:
-                    cmd.waiter.release()
-                except:
-                    pass
+        if self.onDeath:
+            self.onDeath(self, pending, error)
+            return
 
-                for tag, cmd in self.cmd_queue.iteritems():
-                    try:
-                        cmd.waiter.release()
-                    except:
-                        pass
-                sys.exit()
+        for cmd in pending:
+            try:
+                cmd.expire()
+            except:
+                pass
+
+    def rtt(self, command):
+        """Return the RttEstimator of the type of `command`."""
+        with self.deadlineLock:
+            if command.command not in self.latency:
+                self.latency[command.command] = RttEstimator(
+                    maxRto=self.timeout)
+            return self.latency[command.command]
+
+    def latency_stats(self):
+        """Return the round trip time statistics per type of command."""
+        with self.deadlineLock:
+            return dict((name, estimator.stats())
+                        for (name, estimator) in self.latency.iteritems())
+
+    def measure(self, command, received):
+        if not command:
+            return
+        self.metrics.histogram("response_seconds", command=command.command,
+                               transmissions=command.transmissions
+                               ).observe(received - command.sent)
+
+        # Only a command sent once tells which packet the response is for
+        # (Karn's algorithm).
+        if command.transmissions == 1:
+            self.rtt(command).sample(received - command.sent)
+
+    def set_deadline(self, command):
+        if command.idempotent and self.retransmitter:
+            deadline = command.sent + \
+                self.rtt(command).timeout(command.transmissions)
+            deadline = min(deadline, command.firstSent + self.timeout)
+        else:
+            deadline = command.firstSent + self.timeout
+
+        with self.deadlineLock:
+            heapq.heappush(self.deadlines,
+                           (deadline, next(self.sequence), command,
+                            command.transmissions))
+
+    def next_wait(self):
+        """Return how long to wait for a packet before a deadline passes."""
+        with self.deadlineLock:
+            if not self.deadlines:
+                return POLL_INTERVAL
+            wait = self.deadlines[0][0] - monotonic()
+        return min(POLL_INTERVAL, max(wait, 0.01))
 
     def handle_timeouts(self):
-        willpop = []
-        for tag, cmd in self.cmd_queue.iteritems():
-            if not tag:
+        now = monotonic()
+        expired = []
+        with self.deadlineLock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                expired.append(heapq.heappop(self.deadlines))
+
+        for (deadline, _, cmd, transmissions) in expired:
+            # Answered, or sent again since
+            if self.cmd_queue.get(cmd.tag) is not cmd or \
+                    cmd.transmissions != transmissions:
+                continue
+            if cmd.finished:
+                self.cmd_queue.pop(cmd.tag, None)
                 continue
-            if time() - cmd.started > self.timeout:
-                self.tags.remove(cmd.tag)
-                willpop.append(cmd.tag)
 
-                cmd.waiter.release()
+            if cmd.idempotent and self.retransmitter and \
+                    transmissions < self.maxTransmissions and \
+                    now < cmd.firstSent + self.timeout:
+                self.log("NetIO | no response to %s %s after %.1fs, "
+                         "retransmitting" % (cmd.command, cmd.tag,
+                                             now - cmd.sent))
+                self.rtt(cmd).retransmissions += 1
+                self.metrics.counter("retransmissions",
+                                     command=cmd.command).inc()
+                self.retransmitter(cmd)
+                continue
 
-        for tag in willpop:
-            self.cmd_queue.pop(tag)
+            self.log("NetIO | %s %s timed out" % (cmd.command, cmd.tag))
+            self.rtt(cmd).timeouts += 1
+            self.metrics.counter("timeouts", command=cmd.command).inc()
+            self.release_tag(cmd.tag)
+            cmd.expire()
 
     def resp_queue(self, response):
         if response.restag:
@@ -200,56 +416,99 @@ class AniDBLink(threading.Thread):
             resp = self.resp_tagged_queue.pop(command.tag)
         else:
             resp = self.resp_untagged_queue.pop()
-        self.tags.remove(resp.restag)
+        self.release_tag(resp.restag)
         return resp
 
     def cmd_enqueue(self, command):
         self.cmd_queue[command.tag] = command
-        self.tags.append(command.tag)
 
     def cmd_dequeue(self, resp):
         if not resp.restag:
             return None
         else:
-            return self.cmd_queue.pop(resp.restag)
-
-    def get_delay(self):
-        return min(self.delay, 2.1)
+            return self.cmd_queue.pop(resp.restag, None)
 
     def do_delay(self):
-        age = time() - self.lastpacket
-        delay = self.get_delay()
-        if age <= delay:
-            sleep(delay - age)
+        wait = self.rateLimiter.acquire()
+        self.metrics.histogram("ratelimit_wait_seconds").observe(wait)
+        return wait
+
+    @property
+    def banned(self):
+        return self.circuitBreaker.blocked()
 
-    def send(self, command):
-        if self.banned:
+    def send(self, command, delay=True):
+        if not self.circuitBreaker.allow():
             self.log("NetIO | BANNED")
             raise err.AniDBError("Not sending, banned: %s" % self.banmsg)
-        self.do_delay()
+        if delay:
+            self.do_delay()
         self.lastpacket = time()
         command.started = time()
         data = command.raw_data()
 
+        # Before sending, as the response can be handled before sendto
+        # returns
+        command.sent = monotonic()
+        if command.transmissions == 0 and command.queued is not None:
+            self.metrics.histogram("queue_seconds", command=command.command
+                                   ).observe(command.sent - command.queued)
+        command.transmissions += 1
+        if command.transmissions == 1:
+            command.firstSent = command.sent
+        if command.tag:
+            self.set_deadline(command)
+
         self.sock.sendto(data, self.target)
+        if self.capture:
+            self.capture.outbound(data)
+
         if command.command == 'AUTH' and self.logPrivate:
             self.log("NetIO > sensitive data is not logged!")
         else:
             self.log("NetIO > %s" % repr(data))
 
     def new_tag(self):
-        if not len(self.tags):
-            maxtag = "T000"
-        else:
-            maxtag = max(self.tags)
-        newtag = "T%03d" % (int(maxtag[1:]) + 1)
+        """Reserve and return a tag no other pending command is using.
+
+        Tags aren't reused until all the others have been handed out, so a
+        late duplicate response to a retransmitted command can't be taken
+        for the response to a newer command. Raises AniDBError if every tag
+        is taken.
+        """
+        with self.tagLock:
+            if len(self.tags) >= MAX_TAGS:
+                raise err.AniDBError("All %i tags are taken by pending "
+                                     "commands" % MAX_TAGS)
+            while True:
+                self.lastTag = self.lastTag % MAX_TAGS + 1
+                newtag = "T%03d" % self.lastTag
+                if newtag not in self.tags:
+                    break
+            self.tags.append(newtag)
         return newtag
 
-    def request(self, command):
+    def release_tag(self, tag):
+        """Release the tag of a command that won't be answered."""
+        with self.tagLock:
+            if tag in self.tags:
+                self.tags.remove(tag)
+        self.cmd_queue.pop(tag, None)
+
+    def request(self, command, delay=True):
+        if self.quiting:
+            raise err.AniDBError("connection closed")
         if not (self.session and command.session) \
                 and command.command not in ('AUTH', 'PING', 'ENCRYPT'):
             raise err.AniDBMustAuthError("You must be authed to execute "
                                          "commands besides AUTH and PING")
+        # Answered while waiting to be retransmitted
+        if command.finished:
+            return
         command.started = time()
         self.cmd_enqueue(command)
-        self.send(command)
+        try:
+            self.send(command, delay)
+        except:
+            self.cmd_queue.pop(command.tag, None)
+            raise
@@ -62,13 +62,11 @@ class AniDBMaper(object):
         """Returns a list with the corresponding fields as set in the bitChain
         (hex string)
         """
-        codeList = []
         bitChain = int(bitChain, 16)
-        mapLength = len(map)
-        for i in reversed(range(mapLength)):
-            if bitChain & (2 ** i):
-                codeList.append(map[mapLength - i - 1])
-        return codeList
+        # The first field of the map is the highest bit
+        shift = len(map) - 1
+        return [field for (index, field) in enumerate(map)
+                if bitChain >> (shift - index) & 1]
 
     def getAnimeMapA(self):
         # each line is one byte
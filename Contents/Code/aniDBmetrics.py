@@ -0,0 +1,183 @@
+# This file is part of aDBa.
+#
+# aDBa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# aDBa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from aniDBrateLimiter import monotonic
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16,
+                   32, 64)
+
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return {"value": self.value}
+
+
+class Histogram(object):
+    """Distribution of observed values, counted in fixed buckets."""
+    kind = "histogram"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding the `q` quantile,
+        or the largest value seen for the overflow bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if i < len(self.buckets):
+                    return min(self.buckets[i], self.max)
+                return self.max
+        return self.max
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else None,
+                "min": self.min,
+                "max": self.max,
+                "p50": self.quantile(0.5),
+                "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99),
+                "buckets": dict(("%g" % bound, count) for (bound, count) in
+                                zip(self.buckets + (float("inf"), ),
+                                    self.counts)
+                                if count),
+            }
+
+
+class MetricsRegistry(object):
+    """Named counters and histograms, each split by a set of labels such as
+    the command and the result code.
+
+    metrics.counter("timeouts", command="ANIME").inc()
+    with metrics.timer("parse_seconds", command="ANIME"):
+        ...
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.started = time.time()
+
+    def get(self, cls, name, labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(key, cls())
+        return metric
+
+    def counter(self, name, **labels):
+        return self.get(Counter, name, labels)
+
+    def histogram(self, name, **labels):
+        return self.get(Histogram, name, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the time the block takes in the histogram `name`."""
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.histogram(name, **labels).observe(monotonic() - started)
+
+    def snapshot(self):
+        """Return every metric as a list of dicts."""
+        with self.lock:
+            items = sorted(self.metrics.items())
+
+        result = []
+        for ((name, labels), metric) in items:
+            entry = {"name": name, "type": metric.kind,
+                     "labels": dict(labels)}
+            entry.update(metric.snapshot())
+            result.append(entry)
+        return result
+
+    def format(self):
+        """Return the metrics as human readable lines, for the log."""
+        lines = []
+        for entry in self.snapshot():
+            labels = ",".join("%s=%s" % item for item in
+                              sorted(entry["labels"].items()))
+            name = "%s{%s}" % (entry["name"], labels)
+            if entry["type"] == "counter":
+                lines.append("%s %i" % (name, entry["value"]))
+            elif entry["count"]:
+                lines.append("%s count=%i mean=%.4f p50=%.4f p90=%.4f "
+                             "max=%.4f" % (name, entry["count"],
+                                           entry["mean"], entry["p50"],
+                                           entry["p90"], entry["max"]))
+        return lines
+
+    def log(self, logFunction):
+        for line in self.format():
+            logFunction("Metrics | %s" % line)
+
+    def dump(self, path):
+        """Write the metrics to `path` as JSON."""
+        state = {"started": self.started, "dumped": time.time(),
+                 "metrics": self.snapshot()}
+
+        temp = path + ".tmp"
+        try:
+            with open(temp, "w") as f:
+                json.dump(state, f, indent=1, sort_keys=True)
+            if os.name == "nt" and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp, path)
+        except (IOError, OSError):
+            pass
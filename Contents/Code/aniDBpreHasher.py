@@ -0,0 +1,225 @@
+# This file is part of aDBa.
+#
+# aDBa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# aDBa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import Queue
+import select
+import struct
+import sys
+import threading
+import traceback
+from time import time
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# Files that are still being downloaded
+IGNORED_SUFFIXES = (".part", ".!qb", ".!ut", ".crdownload", ".tmp")
+
+
+class Inotify(object):
+    """Minimal ctypes wrapper around the Linux inotify API."""
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self.raise_errno()
+
+    def raise_errno(self, path=None):
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding() or "utf-8")
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self.raise_errno(path)
+        return wd
+
+    def read_events(self, timeout):
+        """Return a list of (wd, mask, name) tuples, waiting at most
+        `timeout` seconds for events to arrive."""
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, _, length) = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PreHasher(threading.Thread):
+    """Background thread hashing new files in the library ahead of time.
+
+    Watches `roots` recursively, and once a new or modified file hasn't been
+    written to for `settle` seconds it's hashed into `hashIndex`, reading
+    within the limits of the aniDBfileInfo.IOBudget `budget`. A later hash
+    search for the file will then find its ed2k in the index.
+
+    Files are hashed on a worker thread, so the events of the kernel keep
+    being read while a large file is hashed rather than overflowing its
+    queue.
+    """
+
+    def __init__(self, roots, hashIndex, logFunction, settle=60,
+                 budget=None):
+        threading.Thread.__init__(self)
+        self.roots = roots
+        self.hashIndex = hashIndex
+        self.log = logFunction
+        self.settle = settle
+        self.budget = budget
+
+        self.inotify = Inotify()
+        self.dirs = {}
+        self.pending = {}
+        self.settled = Queue.Queue()
+
+        self.quiting = False
+        self.setDaemon(True)
+
+    def stop(self):
+        self.quiting = True
+
+    def watch_tree(self, root, queueFiles=False):
+        """Watch `root` and every directory below it. If `queueFiles` is set,
+        existing files are queued for hashing as well, for directories that
+        were moved into the library."""
+        for (path, dirnames, filenames) in os.walk(root):
+            try:
+                wd = self.inotify.add_watch(path)
+            except OSError, e:
+                self.log("Unable to watch %r: %s" % (path, e))
+                continue
+            self.dirs[wd] = path
+
+            if queueFiles:
+                for filename in filenames:
+                    self.pending[os.path.join(path, filename)] = time()
+
+    def ignored(self, path):
+        name = os.path.basename(path)
+        return name.startswith(".") or \
+            name.lower().endswith(IGNORED_SUFFIXES)
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.log("Pre-hasher missed events, some new files won't be "
+                     "hashed ahead of time")
+            return
+
+        if mask & IN_IGNORED:
+            self.dirs.pop(wd, None)
+            return
+
+        if wd not in self.dirs or not name:
+            return
+
+        path = os.path.join(self.dirs[wd], name)
+
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path, queueFiles=True)
+
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.pending.pop(path, None)
+
+        elif not self.ignored(path):
+            self.pending[path] = time()
+
+    def queue_settled(self):
+        """Hand the files that haven't been written to for `settle` seconds
+        to the worker thread."""
+        settled = time() - self.settle
+        for (path, lastWrite) in self.pending.items():
+            if lastWrite <= settled:
+                del self.pending[path]
+                self.settled.put(path)
+
+    def hash_settled(self):
+        """Hash the files queued by queue_settled until stopped."""
+        while not self.quiting:
+            try:
+                path = self.settled.get(True, 1)
+            except Queue.Empty:
+                continue
+            self.hash_file(path)
+
+    def hash_file(self, path):
+        # Written to again since it was queued, it will be queued again
+        if path in self.pending or self.ignored(path) or \
+                not os.path.isfile(path):
+            return
+
+        try:
+            self.hashIndex.hash(path, self.log, self.budget)
+            self.log("Pre-hashed %r" % path)
+        except (IOError, OSError), e:
+            self.log("Unable to pre-hash %r: %s" % (path, e))
+        except Exception:
+            # e.g. the hash index failing, which shouldn't stop the
+            # pre-hasher for good
+            self.log("Unable to pre-hash %r, traceback:\n%s" %
+                     (path, traceback.format_exc()))
+
+    def run(self):
+        for root in self.roots:
+            self.watch_tree(root)
+        self.log("Pre-hasher watching %i directories" % len(self.dirs))
+
+        worker = threading.Thread(target=self.hash_settled)
+        worker.setDaemon(True)
+        worker.start()
+        try:
+            while not self.quiting:
+                for (wd, mask, name) in self.inotify.read_events(1):
+                    self.handle_event(wd, mask, name)
+                self.queue_settled()
+        finally:
+            self.inotify.close()
+            worker.join()
@@ -0,0 +1,183 @@
+# This file is part of aDBa.
+#
+# aDBa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# aDBa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
+
+import ctypes
+import ctypes.util
+import json
+import os
+import sys
+import threading
+import time
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _monotonic_clock():
+    """Return a monotonic clock function, falling back to the wall clock on
+    platforms where clock_gettime(CLOCK_MONOTONIC) isn't available."""
+    if not sys.platform.startswith("linux"):
+        return time.time
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return time.time
+
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        ts = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)):
+            return time.time()
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    return monotonic
+
+monotonic = _monotonic_clock()
+
+
+class RateLimiter(object):
+    """Flood protection for the AniDB UDP API.
+
+    The API allows at most one packet every two seconds (short term), and at
+    most one packet every four seconds over an extended amount of time (long
+    term). The long term limit is modelled as a token bucket holding up to
+    `burst` packets and refilled with one packet every `longInterval`
+    seconds, so a client that has been quiet for a while may send a few
+    packets at the short term rate before settling at the long term rate.
+
+    The state of the bucket is saved to `statePath` after every packet and
+    restored on start, so restarting doesn't reset the budget. The clocks
+    can be swapped out for testing:
+
+    clock     - monotonic clock used for scheduling packets
+    wallClock - clock used for the saved state, which has to survive reboots
+    sleep     - function used for waiting
+    """
+
+    def __init__(self, statePath=None, shortInterval=2.0, longInterval=4.0,
+                 burst=5, clock=monotonic, wallClock=time.time,
+                 sleep=time.sleep):
+        self.statePath = statePath
+        self.shortInterval = shortInterval
+        self.longInterval = longInterval
+        self.burst = burst
+        self.clock = clock
+        self.wallClock = wallClock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+
+        # Tokens in the long term bucket as of `updated`, and the time the
+        # last packet was (or is scheduled to be) sent.
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.last = None
+        self.previous = None
+
+        self.load()
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) / self.longInterval)
+            self.updated = now
+
+    def reserve(self):
+        """Reserve the next free slot for sending a packet, and return the
+        number of seconds until it."""
+        with self.lock:
+            now = self.clock()
+            self.refill(now)
+
+            ready = max(now, self.updated)
+            if self.last is not None:
+                ready = max(ready, self.last + self.shortInterval)
+
+            tokens = min(self.burst, self.tokens +
+                         (ready - self.updated) / self.longInterval)
+            if tokens < 1:
+                ready += (1 - tokens) * self.longInterval
+                tokens = 1
+
+            self.tokens = tokens - 1
+            self.updated = ready
+            self.previous = self.last
+            self.last = ready
+
+            return ready - now
+
+    def refund(self):
+        """Give back the last slot reserved, which went unused."""
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+            self.last = self.previous
+
+    def acquire(self):
+        """Wait until a packet may be sent. Returns the time waited."""
+        wait = self.reserve()
+        if wait > 0:
+            self.sleep(wait)
+        self.save()
+        return max(wait, 0)
+
+    def load(self):
+        if not self.statePath or not os.path.exists(self.statePath):
+            return
+
+        try:
+            with open(self.statePath, "r") as f:
+                state = json.load(f)
+            tokens = float(state["tokens"])
+            updated = float(state["updated"])
+            last = state["last"]
+        except (IOError, ValueError, KeyError, TypeError):
+            return
+
+        now = self.clock()
+        wallNow = self.wallClock()
+
+        # If the wall clock went backwards, assume no time has passed rather
+        # than handing out budget we might not have.
+        self.tokens = min(self.burst, tokens)
+        self.updated = now - max(0, wallNow - updated)
+        self.refill(now)
+        if last is not None:
+            self.last = now - max(-self.shortInterval, wallNow - float(last))
+
+    def save(self):
+        if not self.statePath:
+            return
+
+        with self.lock:
+            offset = self.wallClock() - self.clock()
+            state = {
+                "tokens": self.tokens,
+                "updated": self.updated + offset,
+                "last": self.last + offset if self.last is not None else None,
+            }
+
+        temp = self.statePath + ".tmp"
+        try:
+            with open(temp, "w") as f:
+                json.dump(state, f)
+            if os.name == "nt" and os.path.exists(self.statePath):
+                os.remove(self.statePath)
+            os.rename(temp, self.statePath)
+        except (IOError, OSError):
+            pass
@@ -12,8 +12,36 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
+from itertools import izip
 from aniDBmaper import AniDBMaper
 
+# Compiled Decoders, by command and masks for the responses whose fields
+# depend on the masks of the command, else by fields
+DECODERS = {}
+
+
+class Decoder(object):
+    """Turns the values of a dataline into a dict of `fields`."""
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.count = len(self.fields)
+
+    def decode(self, values):
+        if len(values) < self.count:
+            raise IndexError("%i values for %i fields" %
+                             (len(values), self.count))
+        return dict(izip(self.fields, values))
+
+
+def compiled(key, fields):
+    """Return the Decoder cached under `key`, compiling it from the fields
+    returned by `fields` on first use."""
+    try:
+        return DECODERS[key]
+    except KeyError:
+        return DECODERS.setdefault(key, Decoder(fields()))
+
 
 class ResponseResolver(object):
     def __init__(self, data):
@@ -49,13 +77,15 @@ class ResponseResolver(object):
 
 
 class Response:
+    maper = AniDBMaper()
+    decoder = None
+
     def __init__(self, cmd, restag, rescode, resstr, rawlines):
         self.req = cmd
         self.restag = restag
         self.rescode = rescode
         self.resstr = resstr
         self.rawlines = rawlines
-        self.maper = AniDBMaper()
         self.attrs = []
 
     def __repr__(self):
@@ -84,23 +114,20 @@ class Response:
         self.attrs = self.toMap(self.codehead, tmp[:-1])
         self.resstr = tmp[-1]
 
-        self.datalines = []
-
-        for rawline in self.rawlines:
-            normal = self.toMap(self.codetail, rawline)
-            self.datalines.append(normal)
+        decoder = self.decoder
+        if decoder is None:
+            codetail = tuple(self.codetail)
+            decoder = compiled(codetail, lambda: codetail)
+        decode = decoder.decode
+        self.datalines = [decode(rawline) for rawline in self.rawlines]
 
     def handle(self):
         if self.req:
             self.req.handle(self)
 
     def toMap(self, seq1, seq2):
-        result = {}
-        index = 0
-        for item in seq1:
-            result[item] = seq2[index]
-            index = index + 1
-        return result
+        seq1 = tuple(seq1)
+        return compiled(seq1, lambda: seq1).decode(seq2)
 
 
 class LoginAcceptedResponse(Response):
@@ -378,10 +405,11 @@ class FileResponse(Response):
         fmask = cmd.parameters['fmask']
         amask = cmd.parameters['amask']
 
-        codeListF = self.maper.getFileCodesF(fmask)
-        codeListA = self.maper.getFileCodesA(amask)
-
-        self.codetail = tuple(['fid'] + codeListF + codeListA)
+        self.decoder = compiled(
+            ('FILE', fmask, amask),
+            lambda: ['fid'] + self.maper.getFileCodesF(fmask) +
+            self.maper.getFileCodesA(amask))
+        self.codetail = self.decoder.fields
 
 
 class MylistResponse(Response):
@@ -454,8 +482,9 @@ class AnimeResponse(Response):
 
         # TODO: impl random anime
         amask = cmd.parameters['amask']
-        codeList = self.maper.getAnimeCodesA(amask)
-        self.codetail = tuple(codeList)
+        self.decoder = compiled(('ANIME', amask),
+                                lambda: self.maper.getAnimeCodesA(amask))
+        self.codetail = self.decoder.fields
 
 
 class AnimeDescResponse(Response):
@@ -0,0 +1,194 @@
+# This file is part of aDBa.
+#
+# aDBa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# aDBa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+from aniDBrateLimiter import monotonic
+import aniDBerrors as err
+
+# Priority classes, most urgent first
+PRIORITY_INTERACTIVE = 0  # a user waiting on a search
+PRIORITY_FOREGROUND = 1   # metadata updates
+PRIORITY_BACKGROUND = 2   # refreshes and prefetching nobody's waiting on
+
+# Seconds between checks of whether the probe of a half-open circuit breaker
+# has been answered
+PROBE_POLL_INTERVAL = 0.1
+
+_local = threading.local()
+
+
+def current_priority():
+    """Return the priority commands issued by the calling thread get."""
+    return getattr(_local, "priority", PRIORITY_FOREGROUND)
+
+
+@contextmanager
+def prioritized(priority):
+    """Give commands issued by the calling thread within the block the
+    priority `priority`."""
+    previous = current_priority()
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+class RequestScheduler(threading.Thread):
+    """Sends commands through an AniDBLink in order of priority.
+
+    Commands wait in a queue until the rate limiter of the link allows
+    another packet, at which point the oldest of the most urgent commands
+    waiting is sent. Commands that can't be sent are failed with the error
+    that prevented it. Retransmissions of commands the link didn't get a
+    response to queue up the same way. While the circuit breaker of the link
+    is probing whether a ban has been lifted, commands stay queued until the
+    probe is answered. Commands still queued when the scheduler is stopped
+    are failed.
+    """
+
+    def __init__(self, link, logFunction):
+        threading.Thread.__init__(self)
+        self.link = link
+        self.log = logFunction
+
+        self.queue = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+        # The queue entry waiting for a packet slot, and the command being
+        # handed to the link
+        self.waiting = None
+        self.sending = None
+
+        self.quiting = False
+        self.setDaemon(True)
+        self.start()
+
+    def submit(self, command, priority=None):
+        if priority is None:
+            priority = current_priority()
+        command.priority = priority
+        if command.transmissions == 0:
+            command.queued = monotonic()
+
+        with self.condition:
+            if not self.quiting:
+                heapq.heappush(self.queue,
+                               (priority, next(self.sequence), command))
+                self.condition.notify()
+                return
+        self.abort(command, err.AniDBError("connection closed"))
+
+    def retransmit(self, command):
+        """Queue `command` to be sent again, at the priority it was first
+        submitted with."""
+        self.submit(command, command.priority)
+
+    def remove(self, command):
+        """Take `command` out of the queue. Returns False if it isn't queued,
+        e.g. because it has already been sent."""
+        with self.condition:
+            if self.waiting is not None and self.waiting[2] is command:
+                self.waiting = None
+                return True
+            for (i, entry) in enumerate(self.queue):
+                if entry[2] is command:
+                    del self.queue[i]
+                    heapq.heapify(self.queue)
+                    return True
+        return False
+
+    def pending(self):
+        with self.condition:
+            return len(self.queue) + (self.waiting is not None)
+
+    def stop(self, error=None):
+        """Stop sending, failing the commands that haven't been sent with
+        `error`."""
+        with self.condition:
+            self.quiting = True
+            entries = self.queue
+            self.queue = []
+            if self.waiting is not None:
+                entries.append(self.waiting)
+                self.waiting = None
+            commands = [entry[2] for entry in entries]
+            # Sent or not, nothing is going to handle its response
+            if self.sending is not None:
+                commands.append(self.sending)
+            self.condition.notifyAll()
+
+        error = error or err.AniDBError("connection closed")
+        for command in commands:
+            self.abort(command, error)
+
+    def abort(self, command, error):
+        self.link.release_tag(command.tag)
+        command.fail(error)
+
+    def next_command(self):
+        """Wait for a command to be queued and a packet slot to be free, and
+        return the most urgent command."""
+        with self.condition:
+            while not self.quiting:
+                if not self.queue:
+                    self.condition.wait(1)
+                elif self.link.circuitBreaker.awaiting_probe():
+                    self.condition.wait(PROBE_POLL_INTERVAL)
+                else:
+                    break
+            if self.quiting:
+                return None
+            self.waiting = heapq.heappop(self.queue)
+
+        # Hold on to a command while waiting for the slot, so the queue can't
+        # empty in the meantime.
+        self.link.do_delay()
+
+        with self.condition:
+            (entry, self.waiting) = (self.waiting, None)
+            if self.quiting:
+                return None
+            if entry is None:
+                if not self.queue:
+                    # The command was removed, and nothing else is waiting
+                    self.link.rateLimiter.refund()
+                    return None
+                entry = heapq.heappop(self.queue)
+            elif self.queue and self.queue[0] < entry:
+                # A command queued in the meantime can still jump ahead
+                entry = heapq.heapreplace(self.queue, entry)
+            self.sending = entry[2]
+            return entry[2]
+
+    def run(self):
+        while not self.quiting:
+            command = self.next_command()
+            if command is None:
+                continue
+
+            try:
+                self.link.request(command, delay=False)
+            except Exception, e:
+                self.log("Unable to send command %s: %s" % (command.command,
+                                                           e))
+                self.abort(command, e)
+            finally:
+                with self.condition:
+                    self.sending = None
@@ -0,0 +1,88 @@
+# This file is part of aDBa.
+#
+# aDBa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# aDBa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import time
+
+# AniDB drops sessions that have been idle for 35 minutes. Leave some margin
+# rather than sending a packet that's bound to fail.
+SESSION_TIMEOUT = 30 * 60
+
+
+class SessionStore(object):
+    """Saves the session key of a connection to `path`, so that a restarted
+    client can keep using it instead of authenticating again.
+
+    AniDB ties a session to the address and port it was created from, so the
+    local port is saved along with it, as well as the time of the last
+    packet, past which the session is assumed to have expired.
+    """
+
+    def __init__(self, path, timeout=SESSION_TIMEOUT, wallClock=time.time):
+        self.path = path
+        self.timeout = timeout
+        self.wallClock = wallClock
+        self.lock = threading.Lock()
+
+    def load(self, username=None):
+        """Return the saved (session, port) if the session might still be
+        valid, and was created for `username` if given, else None."""
+        try:
+            with open(self.path, "r") as f:
+                state = json.load(f)
+            session = state["session"]
+            port = int(state["port"])
+            lastActivity = float(state["lastActivity"])
+            savedUsername = state.get("username")
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+        if not session:
+            return None
+        if username is not None and savedUsername != username:
+            return None
+        if not 0 <= self.wallClock() - lastActivity < self.timeout:
+            return None
+        return (session, port)
+
+    def save(self, session, port, username=None, lastActivity=None):
+        if lastActivity is None:
+            lastActivity = self.wallClock()
+        state = {
+            "session": session,
+            "port": port,
+            "username": username,
+            "lastActivity": lastActivity,
+        }
+
+        with self.lock:
+            temp = self.path + ".tmp"
+            try:
+                with open(temp, "w") as f:
+                    json.dump(state, f)
+                if os.name == "nt" and os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(temp, self.path)
+            except (IOError, OSError):
+                pass
+
+    def clear(self):
+        with self.lock:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,123 @@
+# This file is part of aDBa.
+#
+# aDBa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# aDBa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with aDBa.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from time import time, sleep
+import aniDBerrors as err
+
+
+class LinkSupervisor(object):
+    """Replaces the link of a Connection when its thread dies.
+
+    The new link takes over the socket settings, tags, rate limiter and
+    circuit breaker of the dead one, and re-authenticates if the
+    credentials are known. Idempotent commands that were waiting for a
+    response are sent again, the others fail with the error that killed the
+    link. A link that keeps dying is replaced after a growing delay, up to
+    `maxDelay` seconds.
+    """
+
+    def __init__(self, connection, logFunction, maxDelay=60):
+        self.connection = connection
+        self.log = logFunction
+        self.maxDelay = maxDelay
+
+        self.lock = threading.Lock()
+        self.deaths = 0
+        self.lastDeath = None
+
+    def watch(self, link):
+        link.onDeath = self.link_died
+
+    def link_died(self, link, pending, error):
+        # Called from the dying link thread, which has to be let go
+        thread = threading.Thread(target=self.recover,
+                                  args=(link, pending, error))
+        thread.setDaemon(True)
+        thread.start()
+
+    def check(self):
+        """Replace the link if its thread died without saying so."""
+        link = self.connection.link
+        if not link.quiting and (link.dead or not link.is_alive()):
+            self.recover(link, [], None)
+
+    def delay(self):
+        now = time()
+        if self.lastDeath is not None and now - self.lastDeath < \
+                self.maxDelay:
+            self.deaths += 1
+        else:
+            self.deaths = 0
+        self.lastDeath = now
+
+        if not self.deaths:
+            return 0
+        return min(self.maxDelay, 2 ** (self.deaths - 1))
+
+    def replace(self, link):
+        """Return the link replacing `link`, and whether it was created by
+        this call."""
+        with self.lock:
+            if self.connection.link is not link or link.quiting or \
+                    self.connection.scheduler.quiting:
+                return (self.connection.link, False)
+
+            delay = self.delay()
+            if delay:
+                self.log("Link died again, waiting %is before replacing it" %
+                         delay)
+                sleep(delay)
+
+            newLink = link.respawn()
+            self.watch(newLink)
+            newLink.retransmitter = self.connection.scheduler.retransmit
+            self.connection.scheduler.link = newLink
+            self.connection.link = newLink
+            self.log("Replaced the dead link")
+            return (newLink, True)
+
+    def recover(self, link, pending, error):
+        (newLink, replaced) = self.replace(link)
+
+        replay = []
+        for command in pending:
+            if command.finished:
+                continue
+            if command.idempotent:
+                replay.append(command)
+            else:
+                newLink.release_tag(command.tag)
+                command.fail(err.AniDBInternalError(
+                    "The link died waiting for the response: %s" % error))
+
+        # The session might not have survived whatever killed the link. The
+        # AUTH goes through the rate limiter like everything else.
+        if replaced and self.connection.username and \
+                self.connection.password:
+            try:
+                newLink.session = None
+                self.connection.reAuthenticate()
+            except Exception, e:
+                self.log("Unable to re-authenticate after replacing the "
+                         "link: %s" % e)
+
+        for command in replay:
+            self.log("Replaying %s %s" % (command.command, command.tag))
+            command.authorize(command.mode, command.tag, newLink.session,
+                              command.callback)
+            command.transmissions = 0
+            command.firstSent = None
+            self.connection.scheduler.submit(command, command.priority)
@@ -0,0 +1,142 @@
+"""Shared setup of the tests: puts the agent and the tools on the path, and
+runs Connections against a mock AniDB server.
+
+Run the tests from the root of the repository with:
+    python2 -m unittest discover -s tests
+"""
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+TOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                     "tools")
+if TOOLS not in sys.path:
+    sys.path.insert(0, TOOLS)
+
+import plex_framework  # NOQA
+import adba  # NOQA
+import aniDBfileInfo as fileInfo  # NOQA
+from aniDBrateLimiter import monotonic  # NOQA
+from mock_anidb import Dataset, MockAniDB  # NOQA
+
+USERNAME = "user"
+PASSWORD = "secret"
+
+# The flood limits of the API scaled down so the tests run quickly, and the
+# client's a little above the server's so timer jitter doesn't get it banned
+SERVER_SHORT_INTERVAL = 0.02
+SERVER_LONG_INTERVAL = 0.04
+SHORT_INTERVAL = 0.03
+LONG_INTERVAL = 0.05
+
+
+def ed2k(path):
+    """The ed2k of `path`, computed the simplest way."""
+    hashes = []
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(fileInfo.ED2K_CHUNK_SIZE), ""):
+            hashes.append(hashlib.new("md4", data).digest())
+    if len(hashes) == 1:
+        return hashes[0].encode("hex")
+    return hashlib.new("md4", "".join(hashes)).hexdigest()
+
+
+class ScriptedMockAniDB(MockAniDB):
+    """A MockAniDB whose misbehaviour can be scripted per command.
+
+    drop    - {command: count}, the next `count` requests of `command` are
+              lost
+    replies - {command: [response, ...]}, the next requests of `command`
+              are answered with these responses rather than from the
+              dataset
+    """
+
+    def __init__(self, *args, **kwargs):
+        MockAniDB.__init__(self, *args, **kwargs)
+        self.drop = {}
+        self.replies = {}
+
+    def receive(self, data, address):
+        command = data.split(" ", 1)[0].upper()
+        with self.lock:
+            replies = self.replies.get(command)
+            if self.drop.get(command):
+                self.drop[command] -= 1
+                reply = False
+            elif replies:
+                reply = replies.pop(0)
+            else:
+                reply = None
+        if reply is None:
+            return MockAniDB.receive(self, data, address)
+
+        with self.lock:
+            self.stats["received"] += 1
+            self.requests.append((monotonic(), command))
+        if reply is False:
+            self.stats["lostRequests"] += 1
+            return
+        tag = self.parse(data)[1].get("tag")
+        if tag:
+            reply = "%s %s" % (tag, reply)
+        self.reply(reply, address, False)
+
+    def sent(self, command):
+        """Return how many requests of `command` were received, lost ones
+        included."""
+        return len([name for (_, name) in self.requests if name == command])
+
+
+class MockTestCase(unittest.TestCase):
+    """Starts a ScriptedMockAniDB for every test, and gives it a logged in
+    Connection unless `login` is False."""
+    latency = 0.01
+    login = True
+
+    def setUp(self):
+        self.server = ScriptedMockAniDB(
+            Dataset.synthetic(3, 12), latency=self.latency,
+            shortInterval=SERVER_SHORT_INTERVAL,
+            longInterval=SERVER_LONG_INTERVAL, tolerance=0.005,
+            users={USERNAME: PASSWORD}, seed=0)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.connection = self.connect()
+        if self.login:
+            self.connection.auth(USERNAME, PASSWORD)
+
+    def connect(self, **kwargs):
+        kwargs.setdefault("rateLimiter", adba.RateLimiter(
+            shortInterval=SHORT_INTERVAL, longInterval=LONG_INTERVAL))
+        kwargs.setdefault("myport", 0)
+        connection = adba.Connection(server="127.0.0.1",
+                                     port=self.server.port, **kwargs)
+        self.addCleanup(self.disconnect, connection)
+        return connection
+
+    def disconnect(self, connection):
+        connection.cut()
+        connection.scheduler.join(1)
+        connection.link.join(1)
+
+
+class AgentTestCase(MockTestCase):
+    """A MockTestCase that also loads the agent as Plex would, with its data
+    in a temporary directory and the Connection as its CONNECTION."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = plex_framework.install(self.directory, prefs={
+            "username": USERNAME, "password": PASSWORD})
+        self.module = plex_framework.load_agent()
+        if self.module.HASH_INDEX is not None:
+            self.addCleanup(self.module.HASH_INDEX.close)
+
+        MockTestCase.setUp(self)
+        self.module.CONNECTION = self.connection
+        self.agent = self.module.AniDBAgentTV()
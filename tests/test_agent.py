@@ -0,0 +1,56 @@
+import unittest
+
+import support
+from support import adba, plex_framework
+
+
+class PrefetchTest(support.AgentTestCase):
+    def test_episodes_are_prefetched_in_windows(self):
+        self.module.PREFETCH_WINDOW = 5
+        sizes = []
+        batch = self.connection.batch
+
+        def counting(commands, priority=None):
+            sizes.append(len(commands))
+            return batch(commands, priority)
+
+        self.connection.batch = counting
+        metadata = plex_framework.show_metadata(1)
+        metadata.title = "Synthetic Anime 1"
+        media = plex_framework.show_media({1: range(1, 13)})
+        self.agent.prefetchEpisodes(metadata, media, False)
+
+        self.assertEqual(sizes, [5, 5, 2])
+        for episode in xrange(1, 13):
+            key = self.agent.getEpisodeKey(metadata, "1", str(episode))
+            self.assertTrue(self.agent.isEpisodeCached(key, False))
+
+
+class PrewarmImportTest(support.AgentTestCase):
+    def test_only_missing_and_newer_entries_are_imported(self):
+        self.cache.update({
+            "aid:1": {"aid": "1", "date_record_updated": "100"},
+            "aid:2": {"aid": "2", "date_record_updated": "300"},
+            "aid:1-1-1-english_name": "Watched live",
+        })
+        export = adba.CacheExport(self.module.dataPath(
+            self.module.PREWARM_FILE))
+        export.save({
+            "aid:1": {"aid": "1", "date_record_updated": "200"},
+            "aid:2": {"aid": "2", "date_record_updated": "200"},
+            "aid:3": {"aid": "3", "date_record_updated": "200"},
+            "aid:1-1-1-english_name": "Prewarmed",
+            "aid:1-1-2-english_name": "Prewarmed",
+        })
+        self.module.importPrewarmedCache()
+
+        self.assertEqual(self.cache["aid:1"]["date_record_updated"], "200")
+        self.assertEqual(self.cache["aid:2"]["date_record_updated"], "300")
+        self.assertEqual(self.cache["aid:3"]["date_record_updated"], "200")
+        self.assertEqual(self.cache["aid:1-1-1-english_name"], "Watched live")
+        self.assertEqual(self.cache["aid:1-1-2-english_name"], "Prewarmed")
+        self.assertEqual(export.load(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
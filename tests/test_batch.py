@@ -0,0 +1,48 @@
+import unittest
+
+import support
+from support import adba
+from aniDBcommands import EpisodeCommand
+
+
+class BatchTest(support.MockTestCase):
+    latency = 0.1
+
+    def test_results_in_order(self):
+        batch = self.connection.batch([EpisodeCommand(aid=1, epno=epno)
+                                       for epno in xrange(1, 7)])
+        self.assertEqual(len(batch), 6)
+        self.assertEqual([response.datalines[0]["epno"]
+                          for response in batch.wait(5)],
+                         [str(epno) for epno in xrange(1, 7)])
+        self.assertEqual(batch.completed(), 6)
+        self.assertEqual(batch.eta(), 0)
+
+    def test_as_completed(self):
+        episodes = [adba.Episode(self.connection, aid=1, epno=epno)
+                    for epno in xrange(1, 7)]
+        batch = self.connection.batch([episode.command()
+                                       for episode in episodes])
+        indices = []
+        for (index, response, error) in batch.as_completed(5):
+            self.assertIsNone(error)
+            episodes[index].load_response(response)
+            indices.append(index)
+        self.assertEqual(sorted(indices), range(6))
+        self.assertEqual([episode.dataDict["eid"] for episode in episodes],
+                         [1000 + epno for epno in xrange(1, 7)])
+
+    def test_failures_dont_stop_the_batch(self):
+        self.connection.link.rateLimiter.shortInterval = 0.3
+        self.connection.link.rateLimiter.longInterval = 0.3
+        batch = self.connection.batch([EpisodeCommand(aid=1, epno=epno)
+                                       for epno in xrange(1, 4)])
+        batch.futures[1].cancel()
+        outcomes = list(batch.results(5))
+        self.assertEqual([index for (index, _, _) in outcomes], [0, 1, 2])
+        self.assertIsInstance(outcomes[1][2], adba.AniDBCancelledError)
+        self.assertEqual([response and response.datalines[0]["epno"]
+                          for response in batch.wait()], ["1", None, "3"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+from support import adba
+from aniDBcommands import EpisodeCommand
+
+
+class CaptureTest(support.MockTestCase):
+    login = False
+
+    def setUp(self):
+        support.MockTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "packets.capture")
+
+        capture = adba.PacketCapture(self.path)
+        connection = self.connect(capture=capture)
+        connection.auth(support.USERNAME, support.PASSWORD)
+        self.session = connection.link.session
+        for epno in (1, 2):
+            connection.episode(aid=1, epno=epno)
+        self.disconnect(connection)
+        capture.close()
+
+    def test_secrets_are_redacted(self):
+        with open(self.path) as f:
+            capture = f.read()
+        self.assertNotIn(support.PASSWORD, capture)
+        self.assertNotIn(self.session, capture)
+        self.assertIn("user=*", capture)
+
+    def test_responses(self):
+        replay = adba.CaptureReplay(self.path)
+        responses = [(command.command, response.rescode)
+                     for (command, response) in replay.responses()]
+        self.assertEqual(responses, [("AUTH", "200"), ("EPISODE", "240"),
+                                     ("EPISODE", "240")])
+
+    def test_replay_through_a_link(self):
+        replay = adba.CaptureReplay(self.path)
+        connection = self.connect(transport=replay.socket,
+                                  circuitBreaker=adba.CircuitBreaker())
+        connection.link.session = "replay"
+        futures = [connection.submit(EpisodeCommand(aid=1, epno=epno))
+                   for epno in (2, 1)]
+        self.assertEqual([future.result(5).datalines[0]["epno"]
+                          for future in futures], ["2", "1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
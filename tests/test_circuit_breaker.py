@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import support
+from aniDBcircuitBreaker import CircuitBreaker
+from aniDBcommands import EpisodeCommand
+from aniDBerrors import AniDBError
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.statePath = os.path.join(self.directory, "circuit.json")
+        self.now = 1000.0
+
+    def breaker(self, statePath=True):
+        return CircuitBreaker(self.statePath if statePath else None,
+                              initialCooldown=100, cap=1000,
+                              clock=lambda: self.now)
+
+    def test_cooldown_doubles_up_to_cap(self):
+        breaker = self.breaker()
+        self.assertTrue(breaker.allow())
+        cooldowns = []
+        for _ in xrange(6):
+            breaker.trip("banned")
+            cooldowns.append(breaker.remaining())
+            self.assertTrue(breaker.blocked())
+            self.assertFalse(breaker.allow())
+            self.now += cooldowns[-1]
+            self.assertTrue(breaker.allow())
+        self.assertEqual(cooldowns, [100, 200, 400, 800, 1000, 1000])
+
+        breaker.success()
+        self.assertTrue(breaker.closed())
+        self.now += 1000
+        breaker.trip("banned")
+        self.assertEqual(breaker.remaining(), 100)
+
+    def test_state_survives_restart(self):
+        self.breaker().trip("banned")
+        self.now += 40
+        breaker = self.breaker()
+        self.assertTrue(breaker.blocked())
+        self.assertEqual(breaker.remaining(), 60)
+
+    def test_single_probe(self):
+        breaker = self.breaker()
+        breaker.trip("banned")
+        self.now += 100
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        self.assertFalse(breaker.blocked())
+        # An unanswered probe is given up on after probeTimeout
+        self.now += breaker.probeTimeout
+        self.assertTrue(breaker.allow())
+
+    def test_awaiting_probe(self):
+        breaker = self.breaker(False)
+        self.assertFalse(breaker.awaiting_probe())
+        breaker.trip("banned")
+        self.assertFalse(breaker.awaiting_probe())
+        self.now += 100
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.awaiting_probe())
+        breaker.success()
+        self.assertFalse(breaker.awaiting_probe())
+
+        breaker.trip("banned")
+        self.now += 200
+        self.assertTrue(breaker.allow())
+        breaker.trip("still banned")
+        self.assertFalse(breaker.awaiting_probe())
+        self.assertTrue(breaker.blocked())
+
+
+class BanTest(support.MockTestCase):
+    latency = 0.2
+
+    def setUp(self):
+        support.MockTestCase.setUp(self)
+        self.breaker = CircuitBreaker(None, initialCooldown=0.5)
+        self.connection.link.circuitBreaker = self.breaker
+
+    def test_ban_opens_the_breaker(self):
+        self.server.ban(0.5)
+        self.assertEqual(self.connection.episode(aid=1, epno=1).rescode,
+                         "555")
+        self.assertTrue(self.connection.ban_cooldown_active)
+        self.assertRaises(AniDBError, self.connection.episode, aid=1,
+                          epno=2)
+        self.assertEqual(self.server.sent("EPISODE"), 1)
+
+        time.sleep(0.6)
+        self.assertEqual(self.connection.episode(aid=1, epno=3).rescode,
+                         "240")
+        self.assertTrue(self.breaker.closed())
+
+    def test_commands_during_probe_are_sent_after_it(self):
+        self.breaker.trip("banned")
+        time.sleep(0.6)
+        futures = [self.connection.submit(EpisodeCommand(aid=1, epno=epno))
+                   for epno in xrange(1, 4)]
+        time.sleep(0.1)
+        self.assertTrue(self.breaker.awaiting_probe())
+        self.assertEqual(self.server.sent("EPISODE"), 1)
+        self.assertEqual(self.connection.scheduler.pending(), 2)
+        self.assertEqual([future.result(5).rescode for future in futures],
+                         ["240"] * 3)
+        self.assertTrue(self.breaker.closed())
+
+
+if __name__ == "__main__":
+    unittest.main()
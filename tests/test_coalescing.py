@@ -0,0 +1,38 @@
+import threading
+import unittest
+
+import support
+
+
+class CoalescingTest(support.MockTestCase):
+    latency = 0.3
+
+    def episodes(self, epnos):
+        results = []
+
+        def request(epno):
+            response = self.connection.episode(aid=1, epno=epno)
+            results.append((epno, response.datalines[0]["epno"]))
+
+        threads = [threading.Thread(target=request, args=(epno,))
+                   for epno in epnos]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return sorted(results)
+
+    def test_identical_commands_share_a_packet(self):
+        results = self.episodes([5, 5, 5, 5, 6])
+        self.assertEqual(results, [(5, "5")] * 4 + [(6, "6")])
+        self.assertEqual(self.server.sent("EPISODE"), 2)
+        self.assertFalse(self.connection.inflight)
+
+    def test_answered_commands_are_sent_again(self):
+        self.episodes([5, 5])
+        self.episodes([5])
+        self.assertEqual(self.server.sent("EPISODE"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zlib
+
+from support import ed2k
+import aniDBfileInfo as fileInfo
+
+
+class HashingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(setattr, fileInfo, "ED2K_CHUNK_SIZE",
+                        fileInfo.ED2K_CHUNK_SIZE)
+        fileInfo.ED2K_CHUNK_SIZE = 100
+
+    def video(self, size):
+        path = os.path.join(self.directory, "%i.mkv" % size)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        return path
+
+    def test_buffers_across_block_boundaries(self):
+        # Buffers smaller than, equal to and larger than a block, and ones
+        # that don't divide it
+        for size in (0, 1, 99, 100, 101, 550, 1000):
+            path = self.video(size)
+            for bufferSize in (7, 33, 100, 150, 1024):
+                self.assertEqual(
+                    fileInfo.get_file_hash(path, bufferSize), ed2k(path),
+                    "size %i, buffer %i" % (size, bufferSize))
+
+    def test_read_file_reuses_its_buffer(self):
+        path = self.video(550)
+        with open(path, "rb") as f:
+            content = f.read()
+            f.seek(0)
+            data = []
+            for view in fileInfo.read_file(f, 200):
+                if not data:
+                    first = view
+                data.append(view.tobytes())
+        self.assertEqual([len(piece) for piece in data], [200, 200, 150])
+        self.assertEqual("".join(data), content)
+        # The first slice has been overwritten by the last read
+        self.assertEqual(first.tobytes()[:150], content[400:])
+
+    def test_hashes_in_one_pass(self):
+        path = self.video(550)
+        with open(path, "rb") as f:
+            content = f.read()
+        hashes = fileInfo.get_file_hashes(path, ("ed2k", "md5", "sha1"), 33)
+        self.assertEqual(hashes, {
+            "ed2k": ed2k(path),
+            "md5": hashlib.md5(content).hexdigest(),
+            "sha1": hashlib.sha1(content).hexdigest(),
+        })
+
+    def test_hash_files(self):
+        paths = [self.video(size) for size in (99, 100, 550)]
+        missing = os.path.join(self.directory, "missing.mkv")
+        results = fileInfo.hash_files(paths + [missing], workers=2,
+                                      maxMemory=33)
+        expected = dict((path, (path, ed2k(path), os.path.getsize(path)))
+                        for path in paths)
+        expected[missing] = (missing, None, None)
+        self.assertEqual(dict((result[0], result) for result in results),
+                         expected)
+
+    def test_threaded_hashing(self):
+        for size in (0, 99, 100, 550, 1000):
+            path = self.video(size)
+            for threads in (1, 3, 8):
+                self.assertEqual(
+                    fileInfo.get_file_hash_threaded(path, threads, 33),
+                    ed2k(path), "size %i, %i threads" % (size, threads))
+
+    def test_crc32(self):
+        path = self.video(550)
+        with open(path, "rb") as f:
+            crc = zlib.crc32(f.read()) & 0xffffffff
+        self.assertEqual(fileInfo.get_file_hashes(path, ("crc32", ), 33),
+                         {"crc32": "%08x" % crc})
+
+    def test_io_budget(self):
+        path = self.video(550)
+        priority = fileInfo._ioprio()
+        started = time.time()
+        budget = fileInfo.IOBudget(rate=2000)
+        self.assertEqual(fileInfo.get_file_hash(path, 100, budget=budget),
+                         ed2k(path))
+        self.assertGreaterEqual(time.time() - started, 0.25)
+        # Idle priority only lasts as long as the read
+        self.assertEqual(fileInfo._ioprio(), priority)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import time
+import unittest
+
+import support
+from support import adba
+from aniDBcommands import EpisodeCommand
+from aniDBerrors import AniDBError
+from aniDBlink import MAX_TAGS
+
+
+class FutureTest(support.MockTestCase):
+    latency = 0.3
+
+    def test_submitted_commands_are_pipelined(self):
+        started = time.time()
+        futures = [self.connection.submit(EpisodeCommand(aid=1, epno=epno))
+                   for epno in xrange(1, 9)]
+        self.assertLess(time.time() - started, 0.1)
+        self.assertEqual([future.result(5).datalines[0]["epno"]
+                          for future in futures],
+                         [str(epno) for epno in xrange(1, 9)])
+        # One after the other, these would take at least 8 round trips
+        self.assertLess(time.time() - started, 8 * self.latency)
+        self.assertEqual(self.connection.link.tags, [])
+
+    def test_tags_exhausted(self):
+        link = self.connection.link
+        link.tags = ["T%03d" % tag for tag in xrange(1, MAX_TAGS + 1)]
+        self.assertRaises(AniDBError, self.connection.submit,
+                          EpisodeCommand(aid=1, epno=1))
+        link.release_tag("T500")
+        future = self.connection.submit(EpisodeCommand(aid=1, epno=1))
+        self.assertEqual(future.command.tag, "T500")
+
+    def test_result_timeout(self):
+        future = self.connection.submit(EpisodeCommand(aid=1, epno=1))
+        self.assertRaises(adba.AniDBCommandTimeoutError, future.result, 0.1)
+        self.assertEqual(future.result(5).datalines[0]["epno"], "1")
+
+    def test_cancel_queued_commands(self):
+        self.connection.link.rateLimiter.shortInterval = 1.0
+        self.connection.link.rateLimiter.longInterval = 1.0
+        futures = [self.connection.submit(EpisodeCommand(aid=2, epno=epno))
+                   for epno in xrange(1, 5)]
+        time.sleep(0.1)
+        self.assertEqual([future.cancel() for future in futures[1:]],
+                         [True] * 3)
+        self.assertEqual(futures[0].result(5).datalines[0]["epno"], "1")
+        for future in futures[1:]:
+            self.assertRaises(adba.AniDBCancelledError, future.result)
+        self.assertEqual(self.server.sent("EPISODE"), 1)
+        self.assertEqual(self.connection.scheduler.pending(), 0)
+
+    def test_done_callback(self):
+        called = []
+        future = self.connection.submit(EpisodeCommand(aid=3, epno=1))
+        future.add_done_callback(called.append)
+        future.result(5)
+        time.sleep(0.1)
+        self.assertEqual(called, [future])
+
+
+if __name__ == "__main__":
+    unittest.main()
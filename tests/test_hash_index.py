@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import ed2k
+import aniDBfileInfo as fileInfo
+from aniDBhashIndex import HashIndex
+
+
+class HashIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # Small blocks, checkpointed every other block
+        self.patch(fileInfo, "ED2K_CHUNK_SIZE", 100)
+        self.patch(fileInfo, "CHECKPOINT_CHUNKS", 2)
+
+        self.index = HashIndex(os.path.join(self.directory, "hashes.db"))
+        self.addCleanup(self.index.close)
+        self.logs = []
+
+    def patch(self, target, name, value):
+        self.addCleanup(setattr, target, name, getattr(target, name))
+        setattr(target, name, value)
+
+    def video(self, name, size):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        return path
+
+    def hash(self, path):
+        (digest, size) = self.index.hash(path, self.logs.append)
+        self.assertEqual(digest, ed2k(path))
+        self.assertEqual(size, os.path.getsize(path))
+        return self.logs[-1]
+
+    def interrupt(self, path, blocks):
+        """Hash `path`, failing after `blocks` blocks."""
+        update = fileInfo.Ed2kHash.__dict__["update"]
+        hashed = []
+
+        def failing(hasher, data):
+            if len(hashed) == blocks:
+                raise IOError("interrupted")
+            hashed.append(data)
+            update(hasher, data)
+
+        fileInfo.Ed2kHash.update = failing
+        try:
+            self.assertRaises(IOError, self.index.hash, path,
+                              self.logs.append)
+        finally:
+            fileInfo.Ed2kHash.update = update
+
+    def chunks(self):
+        return self.index.db.execute("SELECT path FROM chunks").fetchall()
+
+    def test_hashed_once(self):
+        path = self.video("episode.mkv", 550)
+        self.assertEqual(self.hash(path), "Calculating the ed2k. Please "
+                         "wait...")
+        self.assertEqual(self.hash(path), "Found the ed2k in the hash index")
+
+    def test_moved_file(self):
+        path = self.video("episode.mkv", 550)
+        self.hash(path)
+        moved = os.path.join(self.directory, "moved.mkv")
+        os.rename(path, moved)
+        self.assertEqual(self.hash(moved), "Found the ed2k of a moved file "
+                         "in the hash index")
+
+    def test_copy_of_an_existing_file_is_hashed(self):
+        path = self.video("episode.mkv", 550)
+        self.hash(path)
+        copy = os.path.join(self.directory, "copy.mkv")
+        shutil.copy(path, copy)
+        self.assertEqual(self.hash(copy), "Calculating the ed2k. Please "
+                         "wait...")
+
+    def test_ambiguous_fingerprint_is_hashed(self):
+        # Files that only differ outside of the sampled blocks
+        self.patch(fileInfo, "FINGERPRINT_BLOCK_SIZE", 10)
+        first = self.video("first.mkv", 550)
+        second = os.path.join(self.directory, "second.mkv")
+        shutil.copy(first, second)
+        self.modify(second, 100, 10)
+        self.hash(first)
+        self.hash(second)
+        fingerprint = fileInfo.get_file_fingerprint(first)
+        self.assertEqual(fileInfo.get_file_fingerprint(second), fingerprint)
+
+        moved = os.path.join(self.directory, "moved.mkv")
+        os.rename(second, moved)
+        os.remove(first)
+        self.assertIsNone(self.index.lookup_fingerprint(550, fingerprint))
+        self.assertEqual(self.hash(moved), "Calculating the ed2k. Please "
+                         "wait...")
+
+    def modify(self, path, offset, length):
+        with open(path, "r+b") as f:
+            f.seek(offset)
+            f.write(os.urandom(length))
+        os.utime(path, (0, 0))
+
+    def test_interrupted_hashing_resumes(self):
+        path = self.video("episode.mkv", 1000)
+        self.interrupt(path, 5)
+        self.assertEqual(len(self.chunks()), 1)
+        self.assertEqual(self.hash(path), "Resuming the ed2k calculation "
+                         "after block 4. Please wait...")
+
+    def test_rewritten_file_resumes_before_the_change(self):
+        path = self.video("episode.mkv", 1000)
+        self.interrupt(path, 5)
+        self.modify(path, 350, 10)
+        self.assertEqual(self.hash(path), "Resuming the ed2k calculation "
+                         "after block 3. Please wait...")
+
+    def test_rewritten_start_is_hashed_again(self):
+        path = self.video("episode.mkv", 1000)
+        self.interrupt(path, 5)
+        self.modify(path, 50, 10)
+        self.assertEqual(self.hash(path), "Calculating the ed2k. Please "
+                         "wait...")
+
+    def test_grown_file_only_has_its_tail_hashed(self):
+        path = self.video("episode.mkv", 550)
+        self.hash(path)
+        with open(path, "ab") as f:
+            f.write(os.urandom(300))
+        os.utime(path, (0, 0))
+        self.assertEqual(self.hash(path), "Resuming the ed2k calculation "
+                         "after block 5. Please wait...")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+from support import adba
+from aniDBmetrics import Histogram
+
+
+class HistogramTest(unittest.TestCase):
+    def test_quantiles(self):
+        histogram = Histogram(buckets=(1, 2, 4))
+        for value in (0.5, 0.5, 1.5, 3, 10):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual((snapshot["count"], snapshot["min"],
+                          snapshot["max"]), (5, 0.5, 10))
+        self.assertEqual(snapshot["p50"], 2)
+        self.assertEqual(snapshot["p99"], 10)
+        self.assertEqual(snapshot["buckets"],
+                         {"1": 2, "2": 1, "4": 1, "inf": 1})
+
+
+class RegistryTest(support.MockTestCase):
+    def test_responses_are_timed_per_command(self):
+        self.connection.episode(aid=1, epno=1)
+        metrics = dict(((entry["name"], entry["labels"].get("command")),
+                        entry) for entry in self.connection.metrics.snapshot())
+        self.assertEqual(metrics[("response_seconds", "EPISODE")]["count"], 1)
+        self.assertEqual(metrics[("response_seconds", "AUTH")]["count"], 1)
+
+    def test_dump(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "metrics.json")
+        registry = adba.MetricsRegistry()
+        registry.counter("timeouts", command="ANIME").inc(2)
+        registry.dump(path)
+        with open(path) as f:
+            state = json.load(f)
+        self.assertEqual(state["metrics"], [{
+            "name": "timeouts", "type": "counter",
+            "labels": {"command": "ANIME"}, "value": 2}])
+
+
+if __name__ == "__main__":
+    unittest.main()
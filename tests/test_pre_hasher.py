@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import support  # NOQA
+from aniDBpreHasher import PreHasher
+
+
+class BlockingIndex(object):
+    """A hash index whose hashing waits for `release` to be set."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.hashed = []
+
+    def hash(self, path, log, budget=None):
+        self.started.set()
+        self.release.wait(5)
+        self.hashed.append(os.path.basename(path))
+
+
+class PreHasherTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.index = BlockingIndex()
+        self.logs = []
+        self.preHasher = PreHasher([self.directory], self.index,
+                                   self.logs.append, settle=0)
+        self.preHasher.start()
+        self.addCleanup(self.preHasher.join, 5)
+        self.addCleanup(self.preHasher.stop)
+        self.addCleanup(self.index.release.set)
+
+    def video(self, name):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write("video")
+        return path
+
+    def wait(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_events_are_read_while_hashing(self):
+        self.assertTrue(self.wait(lambda: self.preHasher.dirs))
+        self.video("first.mkv")
+        self.assertTrue(self.index.started.wait(5))
+
+        # Queued while the first file is still being hashed
+        second = self.video("second.mkv")
+        self.assertTrue(self.wait(
+            lambda: second in self.preHasher.settled.queue))
+        self.assertEqual(self.index.hashed, [])
+        self.index.release.set()
+        self.assertTrue(self.wait(lambda: "second.mkv" in self.index.hashed))
+        self.assertEqual(self.index.hashed[0], "first.mkv")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+from aniDBrateLimiter import RateLimiter
+
+
+class Clock(object):
+    """A monotonic clock that only moves when slept on."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.statePath = os.path.join(self.directory, "ratelimit.json")
+        self.clock = Clock()
+        self.wallOffset = 5e8
+
+    def limiter(self):
+        return RateLimiter(self.statePath, clock=self.clock,
+                           wallClock=lambda: self.wallOffset + self.clock(),
+                           sleep=self.clock.sleep)
+
+    def send(self, limiter, count):
+        times = []
+        for _ in xrange(count):
+            limiter.acquire()
+            times.append(self.clock())
+        return [b - a for (a, b) in zip(times, times[1:])]
+
+    def test_burst_then_long_term_rate(self):
+        gaps = self.send(self.limiter(), 10)
+        for gap in gaps:
+            self.assertGreaterEqual(gap, 2.0 - 1e-9)
+        self.assertAlmostEqual(gaps[0], 2.0)
+        self.assertAlmostEqual(gaps[-1], 4.0)
+
+    def test_state_survives_restart(self):
+        self.send(self.limiter(), 10)
+        # A restart resets the monotonic clock but not the wall clock
+        self.wallOffset += self.clock() - 50.0
+        self.clock.now = 50.0
+        self.assertAlmostEqual(self.limiter().acquire(), 4.0)
+
+    def test_idle_time_refills_the_bucket(self):
+        limiter = self.limiter()
+        self.send(limiter, 10)
+        self.clock.sleep(100)
+        gaps = self.send(limiter, 5)
+        self.assertEqual([round(gap, 6) for gap in gaps], [2.0] * 4)
+
+    def test_refund(self):
+        limiter = self.limiter()
+        limiter.acquire()
+        self.assertAlmostEqual(limiter.reserve(), 2.0)
+        limiter.refund()
+        self.assertAlmostEqual(limiter.reserve(), 2.0)
+
+
+class FloodLimitTest(support.MockTestCase):
+    def test_no_flood_ban(self):
+        for epno in xrange(1, 13):
+            self.connection.episode(aid=1, epno=epno)
+        self.assertEqual(self.server.stats["floodViolations"], 0)
+        self.assertFalse(self.server.banned())
+
+
+if __name__ == "__main__":
+    unittest.main()
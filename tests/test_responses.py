@@ -0,0 +1,70 @@
+import unittest
+
+import support
+import aniDBresponses
+from aniDBcommands import AnimeCommand, EpisodeCommand, FileCommand
+from aniDBmaper import AniDBMaper
+from aniDBresponses import Decoder, ResponseResolver
+
+FMASK = "7FF8FEF8"
+AMASK = "C000F0C0"
+ANIME_AMASK = "b2f0e0fc000000"
+
+
+def resolve(command, code, fields):
+    """Resolve a response to `command` whose values are their own
+    positions."""
+    data = "%s\n%s\n" % (code, "|".join(str(i) for i in xrange(fields)))
+    response = ResponseResolver(data).resolve(command)
+    response.parse()
+    return response
+
+
+class DecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.maper = AniDBMaper()
+
+    def test_decode(self):
+        decoder = Decoder(["aid", "epno"])
+        self.assertEqual(decoder.decode(["1", "2"]),
+                         {"aid": "1", "epno": "2"})
+        self.assertRaises(IndexError, decoder.decode, ["1"])
+
+    def test_file_fields_follow_masks(self):
+        fields = ["fid"] + self.maper.getFileCodesF(FMASK) + \
+            self.maper.getFileCodesA(AMASK)
+        command = FileCommand(fid=1, fmask=FMASK, amask=AMASK)
+        response = resolve(command, "220 FILE", len(fields))
+        self.assertEqual(response.datalines,
+                         [dict((field, str(i))
+                               for (i, field) in enumerate(fields))])
+
+    def test_decoders_are_cached_per_masks(self):
+        first = resolve(AnimeCommand(aid=1, amask=ANIME_AMASK), "230 ANIME",
+                        len(self.maper.getAnimeCodesA(ANIME_AMASK)))
+        second = resolve(AnimeCommand(aid=2, amask=ANIME_AMASK), "230 ANIME",
+                         len(self.maper.getAnimeCodesA(ANIME_AMASK)))
+        self.assertIs(first.decoder, second.decoder)
+        self.assertIs(aniDBresponses.DECODERS[("ANIME", ANIME_AMASK)],
+                      first.decoder)
+
+        other = resolve(AnimeCommand(aid=1, amask="80000000000000"),
+                        "230 ANIME", 1)
+        self.assertIsNot(other.decoder, first.decoder)
+        self.assertEqual(other.datalines, [{"aid": "0"}])
+
+    def test_too_few_values(self):
+        command = EpisodeCommand(aid=1, epno=1)
+        self.assertRaises(IndexError, resolve, command, "240 EPISODE", 2)
+
+
+class MockResponseTest(support.MockTestCase):
+    def test_anime(self):
+        response = self.connection.anime(aid=1, amask=ANIME_AMASK)
+        self.assertEqual(response.datalines[0]["aid"], "1")
+        self.assertEqual(response.datalines[0]["romaji_name"],
+                         "Synthetic Anime 1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+import time
+import unittest
+
+import support
+from support import adba
+
+
+class RetransmissionTest(support.MockTestCase):
+    def test_lost_request_is_sent_again(self):
+        # Enough round trips for the timeout to adapt to the mock's latency
+        for epno in xrange(1, 4):
+            self.connection.episode(aid=1, epno=epno)
+
+        self.server.drop["EPISODE"] = 1
+        started = time.time()
+        response = self.connection.episode(aid=1, epno=7)
+        self.assertLess(time.time() - started, 2.5)
+        self.assertEqual(response.datalines[0]["epno"], "7")
+        self.assertEqual(self.server.sent("EPISODE"), 5)
+        stats = self.connection.link.latency_stats()["EPISODE"]
+        self.assertEqual(stats["retransmissions"], 1)
+
+    def test_commands_with_side_effects_time_out(self):
+        self.connection.link.timeout = 1
+        self.server.drop["UPTIME"] = 1
+        self.assertRaises(adba.AniDBCommandTimeoutError,
+                          self.connection.uptime)
+        self.assertEqual(self.server.sent("UPTIME"), 1)
+        self.assertFalse(self.connection.link.cmd_queue)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import threading
+import time
+import unittest
+
+import support
+from support import adba
+from aniDBerrors import AniDBError
+
+
+def run_threads(target, count):
+    threads = [threading.Thread(target=target, args=(i,))
+               for i in xrange(count)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    return threads
+
+
+class SchedulerTest(support.MockTestCase):
+    def test_interactive_commands_jump_the_queue(self):
+        self.connection.link.rateLimiter.shortInterval = 0.1
+        self.connection.link.rateLimiter.longInterval = 0.1
+        order = []
+
+        def background(i):
+            with adba.prioritized(adba.PRIORITY_BACKGROUND):
+                self.connection.episode(aid=1, epno=i + 1)
+            order.append("background")
+
+        def interactive():
+            with adba.prioritized(adba.PRIORITY_INTERACTIVE):
+                self.connection.episode(aid=2, epno=1)
+            order.append("interactive")
+
+        threads = run_threads(background, 8)
+        time.sleep(0.3)
+        threads.append(threading.Thread(target=interactive))
+        threads[-1].start()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(len(order), 9)
+        self.assertLess(order.index("interactive"), 5)
+
+
+class ShutdownTest(support.MockTestCase):
+    # Slow enough for commands to still be queued or waiting for their
+    # response when the connection is cut
+    latency = 0.5
+
+    def setUp(self):
+        support.MockTestCase.setUp(self)
+        self.connection.link.rateLimiter.shortInterval = 0.3
+        self.connection.link.rateLimiter.longInterval = 0.3
+
+    def test_cut_fails_pending_commands(self):
+        errors = []
+
+        def request(i):
+            try:
+                self.connection.episode(aid=1, epno=i + 1)
+                errors.append(None)
+            except AniDBError, e:
+                errors.append(str(e))
+
+        threads = run_threads(request, 5)
+        time.sleep(0.4)
+        self.assertTrue(self.connection.busy())
+        self.connection.cut()
+        for thread in threads:
+            thread.join(2)
+
+        self.assertFalse([thread for thread in threads if thread.is_alive()])
+        self.assertEqual(errors, ["connection closed"] * 5)
+        self.assertEqual(self.connection.scheduler.pending(), 0)
+        self.assertFalse(self.connection.link.cmd_queue)
+
+    def test_commands_after_cut_fail(self):
+        self.connection.cut()
+        self.assertRaises(AniDBError, self.connection.ping)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import support
+from support import adba
+from aniDBsession import SESSION_TIMEOUT
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class SessionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "session.json")
+        self.now = 1000.0
+        self.store = adba.SessionStore(self.path, timeout=100,
+                                       wallClock=lambda: self.now)
+
+    def test_session_expires(self):
+        self.store.save("abcde", 9876, "user")
+        self.now += 99
+        self.assertEqual(self.store.load("user"), ("abcde", 9876))
+        self.now += 1
+        self.assertIsNone(self.store.load("user"))
+
+    def test_session_of_another_user(self):
+        self.store.save("abcde", 9876, "user")
+        self.assertIsNone(self.store.load("someone else"))
+        self.assertEqual(self.store.load(), ("abcde", 9876))
+
+    def test_clock_gone_backwards(self):
+        self.store.save("abcde", 9876, "user")
+        self.now -= 1
+        self.assertIsNone(self.store.load("user"))
+
+    def test_unreadable_state(self):
+        self.assertIsNone(self.store.load())
+        with open(self.path, "w") as f:
+            f.write("{")
+        self.assertIsNone(self.store.load())
+        self.store.clear()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class ResumeTest(support.MockTestCase):
+    login = False
+
+    def setUp(self):
+        support.MockTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.now = 1000.0
+        self.store = adba.SessionStore(
+            os.path.join(self.directory, "session.json"),
+            wallClock=lambda: self.now)
+        self.port = free_port()
+
+    def restart(self, connection):
+        """Stop `connection` and return a new one sharing its session
+        store, as after a restart of the client."""
+        self.disconnect(connection)
+        return self.connect(myport=self.port, sessionStore=self.store)
+
+    def test_saved_session_is_resumed(self):
+        first = self.connect(myport=self.port, sessionStore=self.store)
+        first.auth(support.USERNAME, support.PASSWORD)
+        self.assertEqual(self.store.load(support.USERNAME)[1], self.port)
+
+        second = self.restart(first)
+        self.assertEqual(second.resume(support.USERNAME,
+                                       support.PASSWORD).rescode, "208")
+        self.assertEqual(second.episode(aid=1, epno=1).rescode, "240")
+        self.assertEqual(self.server.sent("AUTH"), 1)
+
+    def test_expired_session_authenticates_again(self):
+        first = self.connect(myport=self.port, sessionStore=self.store)
+        first.auth(support.USERNAME, support.PASSWORD)
+
+        self.now += SESSION_TIMEOUT
+        second = self.restart(first)
+        self.assertEqual(second.resume(support.USERNAME,
+                                       support.PASSWORD).rescode, "200")
+        self.assertEqual(self.server.sent("AUTH"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
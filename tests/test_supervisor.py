@@ -0,0 +1,27 @@
+import unittest
+
+import support
+
+
+class SupervisorTest(support.MockTestCase):
+    def test_dead_link_is_replaced(self):
+        self.server.replies["EPISODE"] = ["999 GARBAGE"]
+        link = self.connection.link
+
+        response = self.connection.episode(aid=1, epno=3)
+        self.assertEqual(response.rescode, "240")
+        self.assertEqual(response.datalines[0]["epno"], "3")
+        self.assertTrue(link.dead)
+        self.assertIsNot(self.connection.link, link)
+        self.assertIs(self.connection.scheduler.link, self.connection.link)
+        self.assertTrue(self.connection.link.is_alive())
+        # Logged in again from the port of the new link
+        self.assertEqual(self.server.sent("AUTH"), 2)
+        self.assertEqual(self.server.sent("EPISODE"), 2)
+
+        self.assertEqual(self.connection.episode(aid=1, epno=4).rescode,
+                         "240")
+
+
+if __name__ == "__main__":
+    unittest.main()
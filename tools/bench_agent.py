@@ -0,0 +1,365 @@
+"""Benchmark the TV agent end to end, offline.
+
+Usage:
+    python2 tools/bench_agent.py [--shows 200] [--episodes 12]
+                                 [--workers 4] [--passes 2] [--by-name P]
+                                 [--latency S] [--jitter S] [--loss P]
+                                 [--time-scale X] [--seed N] [--json FILE]
+
+A synthetic library of --shows shows of --episodes episodes is generated,
+along with a matching dataset served by tools/mock_anidb.py. The agent
+(Contents/Code/__init__.py) is loaded with in-memory stand-ins for the Plex
+framework (Dict, Prefs, HTTP, Proxy, Thread, ...), and every show is
+searched for and updated the way Plex does it when scanning the library,
+from --workers threads. Shows are searched for by the hash of their first
+episode, or by name for a fraction --by-name of them.
+
+Each pass over the library reports:
+
+- the time until every show was matched and had its metadata loaded
+- the packets the agent sent, by command
+- the hit rates of the metadata cache (Dict) and of the hash index
+- the p50/p99 duration of the search and update calls, and of the API
+  requests
+
+The first pass starts with an empty cache, the next ones reuse it. The
+flood limits of the API are enforced by the mock server, and both they and
+the rate limiter of the agent are sped up --time-scale times, so a library
+can be scanned in minutes rather than hours. Durations are reported in
+real seconds.
+"""
+import argparse
+import json
+import os
+import Queue
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import urllib
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import plex_framework as framework  # NOQA
+from plex_framework import Log, Object, Results  # NOQA
+import adba  # NOQA
+import aniDBfileInfo as fileInfo  # NOQA
+from mock_anidb import Dataset, MockAniDB  # NOQA
+
+USERNAME = "bench"
+PASSWORD = "bench"
+
+# What a Dict key caches, from the way the agent builds them
+CACHE_KINDS = [
+    ("description", re.compile(r"^aid:\d+:desc$")),
+    ("anime", re.compile(r"^aid:\d+$")),
+    ("episode", re.compile(r"^aid:\d+-")),
+    ("file", re.compile(r"^file:")),
+]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Hits(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, kind, hit):
+        with self.lock:
+            (hits, total) = self.counts.get(kind, (0, 0))
+            self.counts[kind] = (hits + bool(hit), total + 1)
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+
+
+class BenchDict(framework.Dict):
+    """Dict, counting the lookups that hit and miss by kind of key."""
+
+    def __init__(self):
+        framework.Dict.__init__(self)
+        self.hits = Hits()
+
+    def kind(self, key):
+        for (kind, pattern) in CACHE_KINDS:
+            if pattern.match(str(key)):
+                return kind
+        return "other"
+
+    def __contains__(self, key):
+        found = dict.__contains__(self, key)
+        self.hits.count(self.kind(key), found)
+        return found
+
+
+def build_library(path, shows, episodes, seed):
+    """Return the mock dataset and the list of (aid, name, first episode)
+    of a generated library. The first episode of every show is a small
+    file registered in the dataset, so hash searches find it."""
+    dataset = Dataset.synthetic(shows, episodes, seed)
+    library = []
+    for (aid, anime) in sorted(dataset.anime.iteritems()):
+        folder = os.path.join(path, anime["english_name"])
+        os.makedirs(folder)
+        filePath = os.path.join(folder, "%s - 01.mkv" % anime["english_name"])
+        with open(filePath, "wb") as f:
+            f.write("synthetic episode of anime %i\n" % aid * 64)
+
+        record = dict(dataset.files[aid * 1000 + 1])
+        record["size"] = fileInfo.get_file_size(filePath)
+        record["ed2k"] = fileInfo.get_file_hash(filePath)
+        dataset.add_file(record)
+        library.append((aid, anime["english_name"], filePath))
+    return (dataset, library)
+
+
+class Scan(object):
+    """One pass of the agent over the library."""
+
+    def __init__(self, agentModule, library, episodes, workers, byName,
+                 seed):
+        self.agent = agentModule.AniDBAgentTV()
+        self.library = library
+        self.episodes = episodes
+        self.workers = workers
+        self.byName = byName
+        self.seed = seed
+
+        self.lock = threading.Lock()
+        self.matched = []
+        self.failed = []
+        self.timings = {"search": [], "update": []}
+
+    def run(self):
+        import random
+        rand = random.Random(self.seed)
+        queue = Queue.Queue()
+        for show in self.library:
+            queue.put((show, rand.random() < self.byName))
+
+        self.started = time()
+        threads = [threading.Thread(target=self.work, args=(queue, ))
+                   for _ in xrange(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time() - self.started
+
+    def work(self, queue):
+        while True:
+            try:
+                (show, byName) = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                ok = self.scan_show(show, byName)
+            except Exception, e:
+                Log("Scanning %r failed: %r" % (show, e))
+                ok = False
+            with self.lock:
+                if ok:
+                    self.matched.append(time() - self.started)
+                else:
+                    self.failed.append(show)
+
+    def scan_show(self, show, byName):
+        (aid, name, filePath) = show
+
+        results = Results()
+        media = Object(filename=None if byName else urllib.quote(filePath),
+                       name=None, show=name)
+        started = time()
+        self.agent.search(results, media, "en")
+        self.timing("search", started)
+        if not results or results[0].id != str(aid):
+            return False
+
+        metadata = framework.show_metadata(aid)
+        media = framework.show_media({1: xrange(1, self.episodes + 1)})
+        started = time()
+        self.agent.update(metadata, media, "en", False)
+        self.timing("update", started)
+
+        episodes = metadata.seasons["1"].episodes
+        return metadata.title is not None and \
+            len(episodes) == self.episodes and \
+            all(episode.title for episode in episodes.itervalues())
+
+    def timing(self, call, started):
+        with self.lock:
+            self.timings[call].append(time() - started)
+
+
+class Counting(object):
+    """Wraps a function, counting the calls returning something."""
+
+    def __init__(self, function):
+        self.function = function
+        self.hits = 0
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        result = self.function(*args, **kwargs)
+        self.calls += 1
+        if result:
+            self.hits += 1
+        return result
+
+
+def report(number, scan, server, requests, cache, hashLookups, metrics):
+    total = len(scan.library)
+    result = {
+        "pass": number,
+        "shows": total,
+        "matched": len(scan.matched),
+        "elapsed": scan.elapsed,
+        "fullyMatched": max(scan.matched) if len(scan.matched) == total
+        else None,
+        "matched50": percentile(scan.matched, 0.5),
+        "matched90": percentile(scan.matched, 0.9),
+        "packets": server.stats["received"] - requests["received"],
+        "packetsByCommand": dict(
+            (command, count - requests["commands"].get(command, 0))
+            for (command, count) in server.stats["commands"].iteritems()
+            if count > requests["commands"].get(command, 0)),
+        "cache": dict((kind, {"hits": hits, "lookups": lookups})
+                      for (kind, (hits, lookups)) in
+                      cache.hits.counts.iteritems()),
+        "hashIndex": {"hits": hashLookups.hits,
+                      "lookups": hashLookups.calls},
+        "calls": dict((call, {"count": len(values),
+                              "p50": percentile(values, 0.5),
+                              "p99": percentile(values, 0.99)})
+                      for (call, values) in scan.timings.iteritems()),
+        "api": [entry for entry in metrics.snapshot()
+                if entry["name"] == "request_seconds"],
+    }
+
+    print "Pass %i: %i/%i shows matched in %.2fs" % (
+        number, result["matched"], total, scan.elapsed)
+    if result["fullyMatched"] is not None:
+        print "    fully matched after %.2fs (50%% after %.2fs, 90%% after " \
+            "%.2fs)" % (result["fullyMatched"], result["matched50"],
+                        result["matched90"])
+    print "    %i packets sent: %s" % (result["packets"], ", ".join(
+        "%s %i" % item for item in sorted(result["packetsByCommand"].items())))
+    for (kind, (hits, lookups)) in sorted(cache.hits.counts.iteritems()):
+        print "    cache %-12s %6i/%-6i hits (%.0f%%)" % (
+            kind, hits, lookups, 100.0 * hits / lookups)
+    if hashLookups.calls:
+        print "    hash index   %6i/%-6i hits (%.0f%%)" % (
+            hashLookups.hits, hashLookups.calls,
+            100.0 * hashLookups.hits / hashLookups.calls)
+    for (call, values) in sorted(scan.timings.iteritems()):
+        if values:
+            print "    %-6s n=%-6i p50=%.4fs p99=%.4fs" % (
+                call, len(values), percentile(values, 0.5),
+                percentile(values, 0.99))
+    for entry in result["api"]:
+        if entry["count"]:
+            print "    API %-12s %-4s n=%-6i p50<=%.4fs p99<=%.4fs" % (
+                entry["labels"]["command"], entry["labels"]["result"],
+                entry["count"], entry["p50"], entry["p99"])
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the TV agent against a mock AniDB")
+    parser.add_argument("--shows", type=int, default=200)
+    parser.add_argument("--episodes", type=int, default=12)
+    parser.add_argument("--workers", type=int, default=4,
+                        help="shows scanned at the same time")
+    parser.add_argument("--passes", type=int, default=2)
+    parser.add_argument("--by-name", type=float, default=0.1,
+                        help="fraction of the shows searched for by name")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--loss", type=float, default=0)
+    parser.add_argument("--time-scale", type=float, default=0.01,
+                        help="factor applied to the flood limits")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="FILE",
+                        help="also write the results to FILE")
+    parser.add_argument("--verbose", action="store_true",
+                        help="print the log of the agent")
+    args = parser.parse_args(argv)
+    framework.verbose = args.verbose
+
+    workDir = tempfile.mkdtemp(prefix="bench_agent")
+    try:
+        dataPath = os.path.join(workDir, "data")
+        os.makedirs(dataPath)
+        cache = framework.install(dataPath, BenchDict(),
+                                  {"username": USERNAME,
+                                   "password": PASSWORD})
+        agentModule = framework.load_agent()
+
+        print "Generating a library of %i shows..." % args.shows
+        (dataset, library) = build_library(os.path.join(workDir, "library"),
+                                           args.shows, args.episodes,
+                                           args.seed)
+
+        shortInterval = 2.0 * args.time_scale
+        longInterval = 4.0 * args.time_scale
+        server = MockAniDB(dataset, latency=args.latency,
+                           jitter=args.jitter, loss=args.loss,
+                           shortInterval=shortInterval,
+                           longInterval=longInterval,
+                           tolerance=0.005,
+                           users={USERNAME: PASSWORD}, seed=args.seed)
+        server.start()
+
+        # The agent reuses the connection it finds, so it talks to the mock
+        metrics = agentModule.metrics()
+        agentModule.CONNECTION = adba.Connection(
+            server="127.0.0.1", port=server.port, myport=0,
+            rateLimiter=adba.RateLimiter(shortInterval=shortInterval,
+                                         longInterval=longInterval),
+            circuitBreaker=agentModule.circuitBreaker(), metrics=metrics)
+        agentModule.CONNECTION.auth(USERNAME, PASSWORD)
+
+        index = agentModule.hashIndex()
+        hashLookups = Counting(index.lookup)
+        index.lookup = hashLookups
+
+        results = []
+        for number in xrange(1, args.passes + 1):
+            requests = json.loads(json.dumps(server.stats))
+            cache.hits.reset()
+            hashLookups.hits = hashLookups.calls = 0
+            metrics.metrics.clear()
+
+            scan = Scan(agentModule, library, args.episodes, args.workers,
+                        args.by_name, args.seed + number)
+            scan.run()
+            results.append(report(number, scan, server, requests, cache,
+                                  hashLookups, metrics))
+
+        if server.stats["floodViolations"]:
+            print "The mock server saw %i flood limit violations" % \
+                server.stats["floodViolations"]
+
+        agentModule.CONNECTION.cut()
+        agentModule.CONNECTION.link.join(1)
+        server.stop()
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
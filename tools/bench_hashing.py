@@ -0,0 +1,182 @@
+"""Benchmark and check the ed2k hashing strategies of aniDBfileInfo.
+
+Usage:
+    python2 tools/bench_hashing.py [--large GB[,GB...]] [--real]
+                                   [--threads 2,4] [--dir DIR] [FILE...]
+
+Without FILE arguments, test files are generated around the ed2k block
+boundaries (empty, 1 byte, one block minus/plus one byte, exact multiples of
+a block, ...), both as sparse files and as files of random data, plus any
+multi-GB files asked for with --large (sparse unless --real is given).
+
+Every strategy runs in a child process for every file, and reports its
+throughput, the peak RSS of the child and whether the hash matches a
+reference implementation that reads the file naively. A mismatch makes the
+script exit with a non-zero status.
+
+Mind the page cache: sparse files and freshly generated files are read from
+memory, which measures the CPU side of hashing. Benchmark real files with a
+cold cache (echo 3 > /proc/sys/vm/drop_caches) to measure the disks.
+"""
+import argparse
+import hashlib
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "Contents", "Code"))
+
+import aniDBfileInfo as fileInfo  # NOQA
+
+CHUNK = fileInfo.ED2K_CHUNK_SIZE
+
+BOUNDARY_SIZES = [
+    ("empty", 0),
+    ("1 byte", 1),
+    ("block - 1", CHUNK - 1),
+    ("block", CHUNK),
+    ("block + 1", CHUNK + 1),
+    ("2 blocks", 2 * CHUNK),
+    ("2 blocks + 1", 2 * CHUNK + 1),
+    ("5 blocks", 5 * CHUNK),
+]
+
+
+def reference_hash(path):
+    """The ed2k hash as the agent originally computed it, block by block."""
+    hashes = []
+    with open(path, "rb") as f:
+        data = f.read(CHUNK)
+        while data:
+            hashes.append(hashlib.new("md4", data).digest())
+            data = f.read(CHUNK)
+
+    if len(hashes) == 1:
+        return hashes[0].encode("hex")
+    return hashlib.new("md4", "".join(hashes)).hexdigest()
+
+
+def make_file(directory, name, size, real):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        if real:
+            block = os.urandom(1024 * 1024)
+            remaining = size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+        else:
+            f.truncate(size)
+    return path
+
+
+def strategies(threads):
+    result = [
+        ("sequential", fileInfo.get_file_hash),
+        ("single pass", lambda p: fileInfo.get_file_hashes(p)["ed2k"]),
+        ("single pass+3", lambda p: fileInfo.get_file_hashes(
+            p, ("ed2k", "md5", "sha1", "crc32"))["ed2k"]),
+        ("budgeted", lambda p: fileInfo.get_file_hash(
+            p, budget=fileInfo.IOBudget(idle=False))),
+        ("64K buffer", lambda p: fileInfo.get_file_hash(p, 64 * 1024)),
+    ]
+    for count in threads:
+        result.append(("%i threads" % count,
+                       lambda p, count=count:
+                       fileInfo.get_file_hash_threaded(p, count)))
+    return result
+
+
+def run_strategy(func, path, queue):
+    started = time()
+    try:
+        ed2k = func(path)
+    except Exception, e:
+        ed2k = "error: %s" % e
+    elapsed = time() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak / 1024
+    queue.put((ed2k, elapsed, peak))
+
+
+def measure(func, path):
+    """Run `func` on `path` in a child process, returning the hash, the time
+    it took and the peak RSS of the child in KiB."""
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=run_strategy,
+                                    args=(func, path, queue))
+    child.start()
+    result = queue.get()
+    child.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("files", nargs="*", metavar="FILE")
+    parser.add_argument("--large", default="",
+                        help="comma separated sizes of large files, in GB")
+    parser.add_argument("--real", action="store_true",
+                        help="fill large files with random data instead of "
+                        "making them sparse")
+    parser.add_argument("--threads", default="2,4",
+                        help="comma separated thread counts to try")
+    parser.add_argument("--dir", default=None,
+                        help="where to generate the test files")
+    args = parser.parse_args()
+
+    threads = [int(t) for t in args.threads.split(",") if t]
+    directory = None
+    files = [(os.path.basename(path), path) for path in args.files]
+
+    if not files:
+        directory = tempfile.mkdtemp(prefix="ed2k-bench-", dir=args.dir)
+        for (name, size) in BOUNDARY_SIZES:
+            files.append(("%s, sparse" % name,
+                          make_file(directory, "sparse-%i" % size, size,
+                                    False)))
+            files.append(("%s, random" % name,
+                          make_file(directory, "random-%i" % size, size,
+                                    True)))
+        for gb in [float(size) for size in args.large.split(",") if size]:
+            size = int(gb * 1000 ** 3)
+            kind = "random" if args.real else "sparse"
+            files.append(("%g GB, %s" % (gb, kind),
+                          make_file(directory, "large-%i" % size, size,
+                                    args.real)))
+
+    failures = 0
+    print "%-22s %12s  %-14s %10s %9s  %s" % (
+        "file", "bytes", "strategy", "MB/s", "peak RSS", "result")
+
+    try:
+        for (name, path) in files:
+            size = fileInfo.get_file_size(path)
+            expected = reference_hash(path)
+
+            for (strategy, func) in strategies(threads):
+                (ed2k, elapsed, peak) = measure(func, path)
+                ok = ed2k == expected
+                failures += not ok
+                rate = size / elapsed / 1e6 if elapsed else 0
+                print "%-22s %12i  %-14s %10.1f %7.1fMB  %s" % (
+                    name, size, strategy, rate, peak / 1024.0,
+                    "ok" if ok else "MISMATCH (%s != %s)" % (ed2k, expected))
+    finally:
+        if directory:
+            shutil.rmtree(directory)
+
+    if failures:
+        print "%i hashes didn't match the reference" % failures
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
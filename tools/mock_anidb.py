@@ -0,0 +1,721 @@
+"""A local stand-in for the AniDB UDP API, for testing and benchmarking the
+agent without talking to (or getting banned by) the real server.
+
+Usage:
+    python2 tools/mock_anidb.py [--port 9000] [--fixtures FILE]
+                                [--synthetic SHOWS] [--latency S]
+                                [--jitter S] [--loss P] [--busy P]
+                                [--compress never|requested|always]
+                                [--ban PACKETS:SECONDS[:CODE]]
+                                [--no-flood-limit] [--seed N]
+
+The server answers AUTH, LOGOUT, PING, UPTIME, ANIME, ANIMEDESC, EPISODE,
+FILE and GROUPSTATUS from a fixture dataset (tools/fixtures/anidb.json by
+default, or a generated one with --synthetic), with the response codes and
+field layouts of the real API. On top of that it can:
+
+- delay every response by --latency seconds, give or take --jitter
+- drop requests and responses with probability --loss
+- answer 602 SERVER BUSY with probability --busy
+- zlib compress responses, as the API does for clients asking for it
+- ban the client with 555 (or 504) after a number of packets, with --ban
+- enforce the flood limits of the API, banning clients that break them
+
+All randomness comes from --seed, so a run can be reproduced. Point a
+Connection at it with server="127.0.0.1" and the port. The statistics of the
+run are printed as JSON on exit.
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import zlib
+from HTMLParser import HTMLParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "Contents", "Code"))
+
+from aniDBmaper import AniDBMaper  # NOQA
+from aniDBrateLimiter import monotonic  # NOQA
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "fixtures", "anidb.json")
+
+# The masks adba uses when none is given
+DEFAULT_AMASK = "b2f0e0fc000000"
+DEFAULT_FILE_FMASK = "7FF8FEF8"
+DEFAULT_FILE_AMASK = "C000F0C0"
+
+# Commands that may be sent without a session
+NO_SESSION = ("AUTH", "PING", "ENCODING", "ENCRYPT", "VERSION")
+
+# Lists the API separates with commas rather than apostrophes
+COMMA_LISTS = ("category_list", "category_weight_list", "category_id_list",
+               "tag_name_list", "tag_id_list", "tag_weight_list",
+               "character_id_list", "creator_id_list",
+               "main_creator_id_list", "main_creator_name_list")
+
+SESSION_TIMEOUT = 35 * 60
+MTU = 1400
+DESCRIPTION_PART = 1000
+
+
+def encode(value, listItem=False, separator="'"):
+    """Format a value the way the API does: lists separated by `separator`,
+    with the separators used by the format replaced in the values."""
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        return separator.join(encode(item, True) for item in value)
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    value = str(value).replace("|", "/").replace("\n", "<br />")
+    if listItem:
+        value = value.replace("'", "`")
+    return value
+
+
+def encode_field(record, name):
+    return encode(record.get(name),
+                  separator="," if name in COMMA_LISTS else "'")
+
+
+class Dataset(object):
+    """The anime, episodes, groups and files the mock server knows about."""
+
+    def __init__(self, anime=(), episodes=(), groups=(), files=()):
+        self.anime = {}
+        self.names = {}
+        self.episodes = {}
+        self.episodeNumbers = {}
+        self.groups = {}
+        self.groupNames = {}
+        self.files = {}
+        self.hashes = {}
+
+        for record in anime:
+            self.add_anime(record)
+        for record in episodes:
+            self.add_episode(record)
+        for record in groups:
+            self.add_group(record)
+        for record in files:
+            self.add_file(record)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            data = json.load(f)
+        return cls(data.get("anime", ()), data.get("episodes", ()),
+                   data.get("groups", ()), data.get("files", ()))
+
+    @classmethod
+    def synthetic(cls, shows, episodes=12, seed=0):
+        """Generate `shows` anime of `episodes` episodes each, with a file
+        and a release group for every episode."""
+        rand = random.Random(seed)
+        dataset = cls()
+        for g in xrange(1, 11):
+            dataset.add_group({"gid": g, "name": "Group %i" % g,
+                               "short_name": "G%i" % g,
+                               "rating": rand.randint(0, 1000),
+                               "votes": rand.randint(0, 500)})
+
+        for a in xrange(1, shows + 1):
+            year = rand.randint(1980, 2016)
+            dataset.add_anime({
+                "aid": a,
+                "year": str(year),
+                "type": rand.choice(["TV Series", "OVA", "Movie", "Web"]),
+                "romaji_name": "Synthetic Anime %i" % a,
+                "kanji_name": "",
+                "english_name": "Synthetic Show %i" % a,
+                "other_name": "",
+                "synonym_list": ["Synth %i" % a],
+                "episodes": episodes,
+                "highest_episode_number": episodes,
+                "air_date": int(time.mktime((year, 1, 1, 0, 0, 0, 0, 0,
+                                             0))),
+                "picname": "%i.jpg" % a,
+                "rating": rand.randint(100, 1000),
+                "vote_count": rand.randint(0, 5000),
+                "tag_name_list": ["tag %i" % rand.randint(1, 50)
+                                  for _ in xrange(3)],
+                "tag_weight_list": [rand.choice([0, 200, 400, 600])
+                                    for _ in xrange(3)],
+                "description": "Synthetic anime number %i.\n%s" % (
+                    a, "Lorem ipsum dolor sit amet. " * rand.randint(1, 60)),
+            })
+            gid = rand.randint(1, 10)
+            for e in xrange(1, episodes + 1):
+                eid = a * 1000 + e
+                dataset.add_episode({
+                    "eid": eid, "aid": a, "epno": str(e),
+                    "length": 24, "rating": rand.randint(0, 1000),
+                    "votes": rand.randint(0, 100),
+                    "english_name": "Episode %i" % e,
+                    "romaji_name": "", "kanji_name": "",
+                    "aired": 0})
+                dataset.add_file({
+                    "fid": eid, "aid": a, "eid": eid, "gid": gid,
+                    "size": 100000000 + eid,
+                    "ed2k": "%032x" % rand.getrandbits(128),
+                    "anidb_file_name": "Synthetic Anime %i - %02i.mkv" %
+                    (a, e)})
+        return dataset
+
+    def dump(self, path):
+        state = {
+            "anime": sorted(self.anime.values(), key=lambda r: r["aid"]),
+            "episodes": sorted(self.episodes.values(),
+                               key=lambda r: r["eid"]),
+            "groups": sorted(self.groups.values(), key=lambda r: r["gid"]),
+            "files": sorted(self.files.values(), key=lambda r: r["fid"]),
+        }
+        with open(path, "w") as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+
+    def add_anime(self, record):
+        aid = int(record["aid"])
+        self.anime[aid] = record
+        names = [record.get(key) for key in ("romaji_name", "english_name",
+                                             "kanji_name", "other_name")]
+        names += record.get("short_name_list") or []
+        names += record.get("synonym_list") or []
+        for name in names:
+            if name:
+                self.names.setdefault(name.lower(), aid)
+
+    def add_episode(self, record):
+        self.episodes[int(record["eid"])] = record
+        self.episodeNumbers[(int(record["aid"]),
+                             str(record["epno"]).lower())] = record
+
+    def add_group(self, record):
+        self.groups[int(record["gid"])] = record
+        self.groupNames[record["name"].lower()] = record
+        self.groupNames[record["short_name"].lower()] = record
+
+    def add_file(self, record):
+        self.files[int(record["fid"])] = record
+        self.hashes[(int(record["size"]), record["ed2k"].lower())] = record
+
+    def find_anime(self, aid=None, aname=None):
+        if aid:
+            return self.anime.get(int(aid))
+        if aname:
+            aid = self.names.get(aname.decode("utf-8").lower())
+            return self.anime.get(aid)
+        return None
+
+    def find_episode(self, eid=None, aid=None, aname=None, epno=None):
+        if eid:
+            return self.episodes.get(int(eid))
+        anime = self.find_anime(aid, aname)
+        if not anime or not epno:
+            return None
+        return self.episodeNumbers.get((int(anime["aid"]), epno.lower()))
+
+    def find_group(self, gid=None, gname=None):
+        if gid:
+            return self.groups.get(int(gid))
+        if gname:
+            return self.groupNames.get(gname.decode("utf-8").lower())
+        return None
+
+    def find_file(self, fid=None, size=None, ed2k=None, aid=None, aname=None,
+                  gid=None, gname=None, epno=None):
+        if fid:
+            return self.files.get(int(fid))
+        if size and ed2k:
+            return self.hashes.get((int(size), ed2k.lower()))
+
+        episode = self.find_episode(aid=aid, aname=aname, epno=epno)
+        group = self.find_group(gid, gname)
+        if not episode or not group:
+            return None
+        for record in self.files.itervalues():
+            if record["eid"] == episode["eid"] and \
+                    record["gid"] == group["gid"]:
+                return record
+        return None
+
+    def file_fields(self, record):
+        """Return every field FILE can return for `record`."""
+        anime = self.anime.get(int(record["aid"]), {})
+        episode = self.episodes.get(int(record["eid"]), {})
+        group = self.groups.get(int(record["gid"]), {})
+
+        fields = dict(anime)
+        fields.update({
+            "anime_total_episodes": anime.get("episodes"),
+            "date_aid_record_updated": anime.get("date_record_updated"),
+            "epno": episode.get("epno"),
+            "ep_name": episode.get("english_name"),
+            "ep_romaji_name": episode.get("romaji_name"),
+            "ep_kanji_name": episode.get("kanji_name"),
+            "episode_rating": episode.get("rating"),
+            "episode_vote_count": episode.get("votes"),
+            "aired_date": episode.get("aired"),
+            "group_name": group.get("name"),
+            "group_short_name": group.get("short_name"),
+            "state": 1,
+        })
+        fields.update(record)
+        return fields
+
+    def group_status(self, aid):
+        """Return (gid, name, state, last episode, rating, votes, range) of
+        every group having released episodes of `aid`."""
+        anime = self.anime[aid]
+        released = {}
+        for record in self.files.itervalues():
+            if record["aid"] != aid:
+                continue
+            episode = self.episodes.get(int(record["eid"]), {})
+            try:
+                released.setdefault(record["gid"], set()).add(
+                    int(episode.get("epno")))
+            except (TypeError, ValueError):
+                pass
+
+        result = []
+        for (gid, numbers) in sorted(released.iteritems()):
+            group = self.groups.get(int(gid), {})
+            last = max(numbers)
+            complete = last >= anime.get("episodes", 0) > 0
+            result.append((gid, group.get("name"), 3 if complete else 1,
+                           last, group.get("rating"), group.get("votes"),
+                           "%i-%i" % (min(numbers), last)))
+        return result
+
+
+class MockAniDB(threading.Thread):
+    """A UDP server answering like the AniDB API, from a Dataset.
+
+    latency, jitter  - every response is delayed by latency +/- jitter
+                       seconds, which may reorder them
+    loss             - probability of a request, and of a response, being
+                       lost
+    busy             - probability of answering 602 SERVER BUSY
+    compress         - "never", "requested" (when AUTH asked for it and it
+                       makes the packet smaller) or "always"
+    bans             - (packets, seconds, code) tuples, banning the client
+                       with `code` for `seconds` once it has sent `packets`
+                       packets
+    floodLimit       - ban clients breaking the flood limits for floodBan
+                       seconds. The first `burst` packets may be sent at
+                       any rate, after that packets have to be at least
+                       shortInterval seconds apart, and no more than
+                       `burst` packets over the rate of one every
+                       longInterval seconds. `tolerance` seconds of slack
+                       are allowed for timer inaccuracy.
+    users            - {username: password}, or None to accept anyone
+    """
+
+    def __init__(self, dataset=None, host="127.0.0.1", port=0, latency=0,
+                 jitter=0, loss=0, busy=0, compress="requested", bans=(),
+                 floodLimit=True, shortInterval=2.0, longInterval=4.0,
+                 burst=5, tolerance=0.05, floodBan=30 * 60, users=None,
+                 seed=None, mtu=MTU):
+        threading.Thread.__init__(self, name="MockAniDB")
+        self.setDaemon(True)
+
+        self.dataset = dataset if dataset is not None else \
+            Dataset.load(DEFAULT_FIXTURES)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.busy = busy
+        self.compress = compress
+        self.bans = sorted(bans)
+        self.floodLimit = floodLimit
+        self.shortInterval = shortInterval
+        self.longInterval = longInterval
+        self.burst = burst
+        self.tolerance = tolerance
+        self.floodBan = floodBan
+        self.users = users
+        self.mtu = mtu
+
+        self.random = random.Random(seed)
+        self.maper = AniDBMaper()
+        self.unescaper = HTMLParser()
+        self.started = time.time()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+
+        self.lock = threading.Lock()
+        self.quiting = False
+        self.outbox = []
+        self.sequence = 0
+
+        self.sessions = {}
+        self.clients = {}
+        self.bannedUntil = None
+        self.banCode = None
+        self.banReason = None
+
+        self.stats = {
+            "received": 0,
+            "sent": 0,
+            "lostRequests": 0,
+            "lostResponses": 0,
+            "busy": 0,
+            "compressed": 0,
+            "floodViolations": 0,
+            "bans": 0,
+            "commands": {},
+            "codes": {},
+        }
+        self.requests = []
+
+    def stop(self):
+        self.quiting = True
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def ban(self, seconds, code="555", reason="mock ban"):
+        """Ban the client for `seconds`, answering every packet with
+        `code`."""
+        with self.lock:
+            self.bannedUntil = monotonic() + seconds
+            self.banCode = code
+            self.banReason = reason
+            self.stats["bans"] += 1
+
+    def unban(self):
+        with self.lock:
+            self.bannedUntil = None
+
+    def banned(self):
+        return self.bannedUntil is not None and \
+            monotonic() < self.bannedUntil
+
+    def run(self):
+        while not self.quiting:
+            now = monotonic()
+            wait = 0.5
+            if self.outbox:
+                # A timeout of 0 would make the socket non-blocking
+                wait = max(0.001, min(wait, self.outbox[0][0] - now))
+            try:
+                self.sock.settimeout(wait)
+                (data, address) = self.sock.recvfrom(8192)
+            except socket.timeout:
+                data = None
+            except socket.error:
+                if self.quiting:
+                    break
+                raise
+
+            if data is not None:
+                self.receive(data, address)
+            self.flush()
+
+    def flush(self):
+        now = monotonic()
+        while self.outbox and self.outbox[0][0] <= now:
+            (_, _, data, address) = heapq.heappop(self.outbox)
+            try:
+                self.sock.sendto(data, address)
+            except socket.error:
+                continue
+            self.stats["sent"] += 1
+
+    def receive(self, data, address):
+        now = monotonic()
+        with self.lock:
+            self.stats["received"] += 1
+            self.requests.append((now, data.split(" ", 1)[0]))
+
+        if self.random.random() < self.loss:
+            self.stats["lostRequests"] += 1
+            return
+
+        (command, parameters) = self.parse(data)
+        self.count("commands", command)
+
+        tag = parameters.get("tag")
+        (response, compress) = self.answer(command, parameters, address, now)
+        self.count("codes", response.split(" ", 1)[0])
+        if tag:
+            response = "%s %s" % (tag, response)
+
+        if self.random.random() < self.loss:
+            self.stats["lostResponses"] += 1
+            return
+        self.reply(response, address, compress)
+
+    def count(self, stat, key):
+        with self.lock:
+            self.stats[stat][key] = self.stats[stat].get(key, 0) + 1
+
+    def parse(self, data):
+        (command, _, rest) = data.partition(" ")
+        parameters = {}
+        for pair in rest.split("&"):
+            if "=" not in pair:
+                continue
+            (key, value) = pair.split("=", 1)
+            value = self.unescaper.unescape(value.replace("<br />", "\n"))
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            parameters[key] = value
+        return (command.upper(), parameters)
+
+    def reply(self, response, address, compress):
+        data = response + "\n"
+        if self.compress == "always" or (self.compress == "requested" and
+                                         compress):
+            packed = "\x00\x00" + zlib.compress(data)
+            if self.compress == "always" or len(packed) < len(data):
+                data = packed
+                self.stats["compressed"] += 1
+        data = data[:self.mtu]
+
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(-self.jitter, self.jitter)
+        self.sequence += 1
+        heapq.heappush(self.outbox, (monotonic() + max(0, delay),
+                                     self.sequence, data, address))
+
+    def flooding(self, address, now):
+        """Check a packet from `address` against the flood limits, and
+        return whether it breaks them."""
+        (count, tokens, updated, last) = self.clients.get(
+            address, (0, float(self.burst), now, None))
+
+        tokens = min(self.burst, tokens + (now - updated) / self.longInterval)
+        violation = tokens + self.tolerance / self.longInterval < 1
+        if count >= self.burst and last is not None and \
+                now - last < self.shortInterval - self.tolerance:
+            violation = True
+
+        self.clients[address] = (count + 1, max(0, tokens - 1), now, now)
+        return violation
+
+    def answer(self, command, parameters, address, now):
+        """Return the response to a packet, without the tag, and whether it
+        may be compressed."""
+        for (packets, seconds, code) in self.bans:
+            if self.stats["received"] == packets:
+                self.ban(seconds, code, "scripted ban after %i packets" %
+                         packets)
+
+        if self.floodLimit and self.flooding(address, now):
+            self.stats["floodViolations"] += 1
+            if not self.banned():
+                self.ban(self.floodBan, "555", "FLOOD")
+
+        if self.banned():
+            if self.banCode == "504":
+                return ("504 CLIENT BANNED - %s" % self.banReason, False)
+            return ("555 BANNED\n%s" % self.banReason, False)
+
+        if self.random.random() < self.busy:
+            self.stats["busy"] += 1
+            return ("602 SERVER BUSY", False)
+
+        handler = getattr(self, "do_" + command.lower(), None)
+        if handler is None:
+            return ("598 UNKNOWN COMMAND", False)
+
+        session = None
+        if command not in NO_SESSION:
+            key = parameters.get("s")
+            if not key:
+                return ("501 LOGIN FIRST", False)
+            session = self.sessions.get(key)
+            if session is None or session["address"] != address or \
+                    time.time() - session["lastActivity"] > SESSION_TIMEOUT:
+                self.sessions.pop(key, None)
+                return ("506 INVALID SESSION", False)
+            session["lastActivity"] = time.time()
+
+        try:
+            response = handler(parameters, address, session)
+        except (KeyError, ValueError):
+            response = "505 ILLEGAL INPUT OR ACCESS DENIED"
+        return (response, bool(session and session["compress"]))
+
+    def do_auth(self, parameters, address, session):
+        for key in ("user", "pass", "protover", "client", "clientver"):
+            if not parameters.get(key):
+                return "505 ILLEGAL INPUT OR ACCESS DENIED"
+        if int(parameters["protover"]) < 3:
+            return "503 CLIENT VERSION OUTDATED"
+        if self.users is not None and \
+                self.users.get(parameters["user"]) != parameters["pass"]:
+            return "500 LOGIN FAILED"
+
+        key = "".join(self.random.choice("abcdefghijklmnopqrstuvwxyz"
+                                         "0123456789") for _ in xrange(5))
+        self.sessions[key] = {
+            "address": address,
+            "user": parameters["user"],
+            "compress": parameters.get("comp") == "1",
+            "lastActivity": time.time(),
+        }
+        if parameters.get("nat") == "1":
+            return "200 %s %s:%i LOGIN ACCEPTED" % ((key, ) + address)
+        return "200 %s LOGIN ACCEPTED" % key
+
+    def do_logout(self, parameters, address, session):
+        self.sessions.pop(parameters["s"], None)
+        return "203 LOGGED OUT"
+
+    def do_ping(self, parameters, address, session):
+        if parameters.get("nat") == "1":
+            return "300 PONG\n%i" % address[1]
+        return "300 PONG"
+
+    def do_uptime(self, parameters, address, session):
+        return "208 UPTIME\n%i" % ((time.time() - self.started) * 1000)
+
+    def do_anime(self, parameters, address, session):
+        anime = self.dataset.find_anime(parameters.get("aid"),
+                                        parameters.get("aname"))
+        if anime is None:
+            return "330 NO SUCH ANIME"
+        fields = self.maper.getAnimeCodesA(parameters.get("amask",
+                                                          DEFAULT_AMASK))
+        return "230 ANIME\n%s" % "|".join(encode_field(anime, field)
+                                          for field in fields)
+
+    def do_animedesc(self, parameters, address, session):
+        anime = self.dataset.find_anime(parameters["aid"])
+        if anime is None:
+            return "330 NO SUCH ANIME"
+        description = encode(anime.get("description"))
+        parts = [description[i:i + DESCRIPTION_PART] for i in
+                 xrange(0, len(description), DESCRIPTION_PART)]
+        part = int(parameters.get("part", 0))
+        if not 0 <= part < len(parts):
+            return "333 NO SUCH DESCRIPTION"
+        return "233 ANIMEDESC\n%i|%i|%s" % (part, len(parts), parts[part])
+
+    def do_episode(self, parameters, address, session):
+        episode = self.dataset.find_episode(
+            parameters.get("eid"), parameters.get("aid"),
+            parameters.get("aname"), parameters.get("epno"))
+        if episode is None:
+            return "340 NO SUCH EPISODE"
+        fields = ("eid", "aid", "length", "rating", "votes", "epno",
+                  "english_name", "romaji_name", "kanji_name", "aired")
+        return "240 EPISODE\n%s" % "|".join(encode(episode.get(field))
+                                            for field in fields)
+
+    def do_file(self, parameters, address, session):
+        record = self.dataset.find_file(
+            parameters.get("fid"), parameters.get("size"),
+            parameters.get("ed2k"), parameters.get("aid"),
+            parameters.get("aname"), parameters.get("gid"),
+            parameters.get("gname"), parameters.get("epno"))
+        if record is None:
+            return "320 NO SUCH FILE"
+
+        fields = self.dataset.file_fields(record)
+        names = ["fid"] + \
+            self.maper.getFileCodesF(parameters.get("fmask",
+                                                    DEFAULT_FILE_FMASK)) + \
+            self.maper.getFileCodesA(parameters.get("amask",
+                                                    DEFAULT_FILE_AMASK))
+        return "220 FILE\n%s" % "|".join(encode_field(fields, name)
+                                         for name in names)
+
+    def do_groupstatus(self, parameters, address, session):
+        anime = self.dataset.find_anime(parameters["aid"])
+        if anime is None:
+            return "330 NO SUCH ANIME"
+        status = parameters.get("status")
+        lines = ["|".join(encode(value) for value in line) for line in
+                 self.dataset.group_status(int(anime["aid"]))
+                 if not status or str(line[2]) == status]
+        if not lines:
+            return "325 NO GROUPS FOUND"
+        return "225 GROUPSTATUS\n%s" % "\n".join(lines)
+
+
+def parse_ban(value):
+    parts = value.split(":")
+    if len(parts) not in (2, 3) or (len(parts) == 3 and
+                                    parts[2] not in ("504", "555")):
+        raise argparse.ArgumentTypeError("expected PACKETS:SECONDS[:CODE] "
+                                         "with CODE 504 or 555")
+    return (int(parts[0]), float(parts[1]),
+            parts[2] if len(parts) == 3 else "555")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a mock AniDB UDP API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES,
+                        help="JSON dataset to serve")
+    parser.add_argument("--synthetic", type=int, metavar="SHOWS",
+                        help="serve a generated dataset of SHOWS anime")
+    parser.add_argument("--episodes", type=int, default=12,
+                        help="episodes per generated anime")
+    parser.add_argument("--dump", metavar="FILE",
+                        help="write the dataset to FILE and exit")
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--loss", type=float, default=0)
+    parser.add_argument("--busy", type=float, default=0)
+    parser.add_argument("--compress", default="requested",
+                        choices=("never", "requested", "always"))
+    parser.add_argument("--ban", type=parse_ban, action="append", default=[],
+                        metavar="PACKETS:SECONDS[:CODE]")
+    parser.add_argument("--no-flood-limit", dest="floodLimit",
+                        action="store_false")
+    parser.add_argument("--short-interval", type=float, default=2.0)
+    parser.add_argument("--long-interval", type=float, default=4.0)
+    parser.add_argument("--burst", type=int, default=5)
+    parser.add_argument("--flood-ban", type=float, default=30 * 60)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    if args.synthetic:
+        dataset = Dataset.synthetic(args.synthetic, args.episodes,
+                                    args.seed or 0)
+    else:
+        dataset = Dataset.load(args.fixtures)
+    if args.dump:
+        dataset.dump(args.dump)
+        return 0
+
+    server = MockAniDB(dataset, args.host, args.port, args.latency,
+                       args.jitter, args.loss, args.busy, args.compress,
+                       args.ban, args.floodLimit, args.short_interval,
+                       args.long_interval, args.burst,
+                       floodBan=args.flood_ban, seed=args.seed)
+    server.start()
+    print "Mock AniDB listening on %s:%i, %i anime" % (
+        args.host, server.port, len(dataset.anime))
+
+    try:
+        while server.is_alive():
+            server.join(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    print json.dumps(server.stats, indent=1, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""In-memory stand-ins for the parts of the Plex plugin framework the agent
+uses, for running it outside of Plex.
+
+Import this before adba or the agent: it puts Log in the builtins, which
+every module of the agent expects to find there. install() then provides
+the rest (Dict, Prefs, HTTP, Proxy, Thread, ...), and load_agent() loads
+Contents/Code/__init__.py as a module.
+"""
+import imp
+import os
+import sys
+
+CODE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                    "Contents", "Code")
+if CODE not in sys.path:
+    sys.path.insert(0, CODE)
+
+import __builtin__  # NOQA
+
+# Print the log of the agent
+verbose = False
+
+
+def Log(*args):
+    if verbose:
+        print " ".join(str(arg) for arg in args)
+
+__builtin__.Log = Log
+
+
+class Dict(dict):
+    """The persistent dictionary of the plugin, kept in memory."""
+
+    def Save(self):
+        pass
+
+
+class Prefs(dict):
+    def __getitem__(self, key):
+        return self.get(key)
+
+
+DEFAULT_PREFS = {
+    "username": "",
+    "password": "",
+    "title_lang": "English",
+    "title_sort_lang": "---",
+    "tag_min_weight": "0",
+    "skip_cache": False,
+    "prehash_roots": "",
+    "metrics_interval": "0",
+    "capture_packets": False,
+}
+
+
+class Response(object):
+    def __init__(self, content):
+        self.content = content
+
+
+class HTTP(object):
+    """Answers every request with placeholder content, without fetching
+    anything."""
+    CacheTime = 0
+    requests = 0
+
+    @classmethod
+    def Request(cls, url):
+        cls.requests += 1
+        return Response("image data for %s" % url)
+
+
+class Proxy(object):
+    @staticmethod
+    def Media(content):
+        return content
+
+
+class Thread(object):
+    """Timers are dropped, the agent only uses them for housekeeping."""
+
+    @staticmethod
+    def CreateTimer(interval, function, *args, **kwargs):
+        pass
+
+
+class MetadataSearchResult(object):
+    def __init__(self, id, name, year, score, lang):
+        self.id = id
+        self.name = name
+        self.year = year
+        self.score = score
+        self.lang = lang
+
+
+class Locale(object):
+    class Language(object):
+        English = "en"
+
+
+class Agent(object):
+    class Movies(object):
+        pass
+
+    class TV_Shows(object):
+        pass
+
+
+class Storage(object):
+    def __init__(self, path):
+        self.data_path = path
+
+    def join_path(self, *parts):
+        return os.path.join(*parts)
+
+
+class Core(object):
+    def __init__(self, path):
+        self.storage = Storage(path)
+
+
+class Results(list):
+    """The list search results are appended to."""
+
+    def Append(self, result):
+        self.append(result)
+
+
+class AutoDict(dict):
+    """A dict creating missing items with `factory`, like the containers of
+    Plex metadata objects."""
+
+    def __init__(self, factory):
+        dict.__init__(self)
+        self.factory = factory
+
+    def __getitem__(self, key):
+        if key not in self:
+            self[key] = self.factory()
+        return dict.__getitem__(self, key)
+
+
+class Object(object):
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+def episode_metadata():
+    return Object(title=None, rating=None, duration=None,
+                  originally_available_at=None)
+
+
+def season_metadata():
+    return Object(posters={}, episodes=AutoDict(episode_metadata))
+
+
+def show_metadata(aid):
+    """Return an empty metadata object for the show `aid`."""
+    return Object(id=str(aid), title=None, title_sort=None, year=None,
+                  rating=None, originally_available_at=None, summary=None,
+                  genres=set(), posters={},
+                  seasons=AutoDict(season_metadata))
+
+
+def show_media(seasons):
+    """Return a media object for a show, from {season: [episode, ...]}."""
+    return Object(seasons=dict(
+        (str(season), Object(episodes=dict((str(episode), Object())
+                                           for episode in episodes)))
+        for (season, episodes) in seasons.iteritems()))
+
+
+def install(dataPath, cache=None, prefs=None):
+    """Put the stand-ins where the agent looks for them, with the plugin
+    data in `dataPath`. Returns the Dict."""
+    if cache is None:
+        cache = Dict()
+    settings = Prefs(DEFAULT_PREFS)
+    settings.update(prefs or {})
+
+    for (name, value) in [("Dict", cache), ("Prefs", settings),
+                          ("HTTP", HTTP), ("Proxy", Proxy),
+                          ("Thread", Thread),
+                          ("MetadataSearchResult", MetadataSearchResult),
+                          ("Locale", Locale), ("Agent", Agent),
+                          ("Core", Core(dataPath))]:
+        setattr(__builtin__, name, value)
+    return cache
+
+
+def load_agent():
+    """Load the agent and start it as Plex would."""
+    agent = imp.load_source("AniDBAgent", os.path.join(CODE, "__init__.py"))
+    agent.Start()
+    return agent
@@ -0,0 +1,296 @@
+"""Load the metadata of a library into the cache of the agent ahead of time,
+outside of Plex.
+
+Usage:
+    python2 tools/prewarm_cache.py --data-dir DIR [--username U]
+                                   [--password P] [--jobs 2] [--workers 2]
+                                   [--server HOST] [--port 9000]
+                                   [--local-port 9876] ROOT...
+
+Every video file under the ROOTs is hashed, --jobs files at a time, and
+looked up on AniDB the way the agent does when Plex scans a library. The
+anime and episodes found are then loaded through the agent as well, so the
+cache ends up holding exactly what the agent would have stored, under the
+same keys.
+
+--data-dir is the data directory of the plugin (Plug-in Support/Data/
+com.plexapp.agents.anidb), whose hash index and rate limiter state are
+shared with the agent: files hashed here aren't hashed again by Plex, and
+the flood limits of the API are respected across both. The cache is written
+to prewarm.json in that directory, and merged into the cache of the agent
+the next time it starts. Running the tool again resumes from prewarm.json
+if the agent hasn't imported it yet.
+
+The credentials can also be given in the ANIDB_USERNAME and ANIDB_PASSWORD
+environment variables. Don't run this while Plex is scanning the library:
+the two would share the flood limits of the API without knowing of each
+other.
+"""
+import argparse
+import os
+import Queue
+import sys
+import threading
+import urllib
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import plex_framework as framework  # NOQA
+from plex_framework import Log, Results  # NOQA
+import adba  # NOQA
+
+VIDEO_EXTENSIONS = (".mkv", ".mp4", ".avi", ".ogm", ".m4v", ".wmv", ".mov",
+                    ".mpg", ".mpeg", ".ts", ".m2ts", ".flv", ".webm", ".rmvb")
+
+# Seconds between saves of the cache, so an interrupted run loses little
+CHECKPOINT_INTERVAL = 60
+
+
+def find_videos(roots):
+    videos = []
+    for root in roots:
+        for (path, folders, files) in os.walk(root):
+            folders.sort()
+            for name in sorted(files):
+                if name.lower().endswith(VIDEO_EXTENSIONS):
+                    videos.append(os.path.join(path, name))
+    return videos
+
+
+def episode_of(epno):
+    """Return the (season, episode) Plex files the AniDB episode number
+    `epno` under, or None for credits, trailers and the like."""
+    if isinstance(epno, int):
+        return ("1", str(epno))
+    epno = unicode(epno)
+    if epno.startswith("S") and epno[1:].isdigit():
+        return ("0", str(int(epno[1:])))
+    if epno.isdigit():
+        return ("1", str(int(epno)))
+    return None
+
+
+class Prewarm(object):
+    """Hashes, looks up and loads the metadata of `videos` through the agent
+    in `agentModule`."""
+
+    def __init__(self, agentModule, cache, export, videos, jobs, workers):
+        self.agentModule = agentModule
+        self.agent = agentModule.AniDBAgentTV()
+        self.cache = cache
+        self.export = export
+        self.videos = videos
+        self.jobs = jobs
+        self.workers = workers
+
+        self.lock = threading.Lock()
+        self.shows = {}
+        self.unmatched = []
+        self.failed = []
+        self.looked = 0
+        self.matched = 0
+        self.checkpointed = time()
+
+    def run(self):
+        hashQueue = Queue.Queue()
+        for path in self.videos:
+            hashQueue.put(path)
+        lookupQueue = Queue.Queue()
+
+        hashers = self.start(self.jobs, self.hash_files,
+                             hashQueue, lookupQueue)
+        lookups = self.start(self.workers, self.look_up, lookupQueue)
+        for thread in hashers:
+            thread.join()
+        for _ in lookups:
+            lookupQueue.put(None)
+        for thread in lookups:
+            thread.join()
+
+        showQueue = Queue.Queue()
+        for item in sorted(self.shows.iteritems()):
+            showQueue.put(item)
+        for thread in self.start(self.workers, self.load_shows, showQueue):
+            thread.join()
+        self.checkpoint(force=True)
+
+    def start(self, count, target, *args):
+        threads = [threading.Thread(target=target, args=args)
+                   for _ in xrange(max(1, count))]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        return threads
+
+    def hash_files(self, hashQueue, lookupQueue):
+        index = self.agentModule.hashIndex()
+        while True:
+            try:
+                path = hashQueue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if index is not None:
+                    index.hash(path, Log)
+            except Exception, e:
+                self.fail(path, "hashing failed: %s" % e)
+                continue
+            lookupQueue.put(path)
+
+    def look_up(self, lookupQueue):
+        while True:
+            path = lookupQueue.get()
+            if path is None:
+                return
+
+            try:
+                fileInfo = self.agent.doHashSearch(Results(),
+                                                   urllib.quote(path))
+            except Exception, e:
+                self.fail(path, "lookup failed: %s" % e)
+                continue
+            if fileInfo is None:
+                self.fail(path, "banned from the API")
+                continue
+
+            with self.lock:
+                self.looked += 1
+                progress = "[%i/%i]" % (self.looked, len(self.videos))
+                if "aid" not in fileInfo.dataDict:
+                    self.unmatched.append(path)
+                    print "%s %s: no match" % (progress, path)
+                    continue
+
+                self.matched += 1
+                aid = fileInfo.dataDict["aid"]
+                episode = episode_of(fileInfo.dataDict.get("epno"))
+                seasons = self.shows.setdefault(aid, {})
+                if episode:
+                    seasons.setdefault(episode[0], set()).add(episode[1])
+                print "%s %s: anime %s episode %s" % (
+                    progress, path, aid, fileInfo.dataDict.get("epno"))
+            self.checkpoint()
+
+    def load_shows(self, showQueue):
+        while True:
+            try:
+                (aid, seasons) = showQueue.get_nowait()
+            except Queue.Empty:
+                return
+
+            metadata = framework.show_metadata(aid)
+            try:
+                self.agent.getAnimeInfo(str(aid), metadata)
+                if self.agent.is_banned:
+                    raise Exception("banned from the API")
+                media = framework.show_media(seasons)
+                self.agent.prefetchEpisodes(metadata, media, False)
+                # Whatever the batch missed, one at a time
+                for (season, episodes) in sorted(seasons.iteritems()):
+                    for episode in sorted(episodes, key=int):
+                        self.agent.loadEpisode(metadata, season, episode,
+                                               False)
+            except Exception, e:
+                self.fail("anime %s" % aid, "loading failed: %s" % e)
+                continue
+
+            print "Loaded anime %s (%s), %i episodes" % (
+                aid, metadata.title,
+                sum(len(episodes) for episodes in seasons.itervalues()))
+            self.checkpoint()
+
+    def fail(self, what, reason):
+        with self.lock:
+            self.failed.append(what)
+        print "%s: %s" % (what, reason)
+
+    def checkpoint(self, force=False):
+        with self.lock:
+            if not force and time() - self.checkpointed < CHECKPOINT_INTERVAL:
+                return
+            self.checkpointed = time()
+            self.export.save(dict(self.cache))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load the metadata of a library into the cache of the "
+        "agent ahead of time")
+    parser.add_argument("roots", nargs="+", metavar="ROOT")
+    parser.add_argument("--data-dir", required=True,
+                        help="data directory of the plugin")
+    parser.add_argument("--username",
+                        default=os.environ.get("ANIDB_USERNAME"))
+    parser.add_argument("--password",
+                        default=os.environ.get("ANIDB_PASSWORD"))
+    parser.add_argument("--jobs", type=int, default=2,
+                        help="files hashed at the same time")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="requests in flight at the same time")
+    parser.add_argument("--server", default="api.anidb.info")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--local-port", type=int, default=9876)
+    parser.add_argument("--verbose", action="store_true",
+                        help="print the log of the agent")
+    args = parser.parse_args(argv)
+    framework.verbose = args.verbose
+
+    if not args.username or not args.password:
+        parser.error("the AniDB username and password are required")
+    if not os.path.isdir(args.data_dir):
+        parser.error("%s is not a directory" % args.data_dir)
+
+    cache = framework.install(args.data_dir, prefs={
+        "username": args.username, "password": args.password})
+    # Starting the agent imports what's left of a previous run; save it back
+    # right away so it isn't lost if this run is interrupted
+    agentModule = framework.load_agent()
+    export = adba.CacheExport(os.path.join(args.data_dir,
+                                           agentModule.PREWARM_FILE))
+    if cache:
+        export.save(dict(cache))
+        print "Resuming with %i cache entries" % len(cache)
+
+    videos = find_videos(args.roots)
+    print "Found %i video files" % len(videos)
+    if not videos:
+        return 0
+
+    started = time()
+    agentModule.CONNECTION = adba.Connection(
+        server=args.server, port=args.port, myport=args.local_port,
+        rateLimiter=agentModule.rateLimiter(),
+        circuitBreaker=agentModule.circuitBreaker(),
+        metrics=agentModule.metrics())
+    connection = agentModule.CONNECTION
+    try:
+        connection.auth(args.username, args.password)
+    except Exception, e:
+        print "Unable to log in to AniDB: %s" % e
+        connection.cut()
+        return 1
+
+    prewarm = Prewarm(agentModule, cache, export, videos, args.jobs,
+                      args.workers)
+    try:
+        prewarm.run()
+    finally:
+        prewarm.checkpoint(force=True)
+        try:
+            connection.logout()
+        except Exception:
+            pass
+        connection.cut()
+        connection.link.join(1)
+
+    print "%i/%i files matched to %i anime in %.0fs, %i cache entries " \
+        "written to %s" % (prewarm.matched, len(videos), len(prewarm.shows),
+                           time() - started, len(cache), export.path)
+    for line in agentModule.metrics().format():
+        print "    %s" % line
+    return 1 if prewarm.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""Replay a capture recorded by AniDBLink (the capture_packets preference)
+as a regression benchmark.
+
+Usage:
+    python2 tools/replay_capture.py CAPTURE [--realtime] [--speed X]
+                                            [--repeat N] [--link]
+
+By default the recorded responses are resolved and parsed the way AniDBLink
+does, which measures the parsing. With --link, the recorded commands are
+sent again through a Connection whose socket answers them from the capture,
+which measures the scheduling, the link and the parsing together.
+
+--realtime plays the packets back with their recorded timing, sped up
+--speed times. Without it, they're played back as fast as possible.
+"""
+import argparse
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "Contents", "Code"))
+
+import __builtin__  # NOQA
+if not hasattr(__builtin__, "Log"):
+    __builtin__.Log = lambda *args: None
+
+import adba  # NOQA
+from aniDBcapture import CaptureReplay, ReplayCommand  # NOQA
+from aniDBmetrics import MetricsRegistry  # NOQA
+
+
+def replay_responses(replay, metrics):
+    count = 0
+    started = time()
+    responses = replay.responses()
+    while True:
+        parseStarted = time()
+        try:
+            (command, response) = next(responses)
+        except StopIteration:
+            break
+        metrics.histogram("parse_seconds", command=command.command
+                          ).observe(time() - parseStarted)
+        metrics.counter("responses", command=command.command,
+                        code=response.rescode).inc()
+        count += 1
+    return (count, time() - started)
+
+
+def replay_link(replay, metrics):
+    connection = adba.Connection(
+        server="replay", myport=0, transport=replay.socket, metrics=metrics,
+        rateLimiter=adba.RateLimiter(shortInterval=0, longInterval=1e-9),
+        circuitBreaker=adba.CircuitBreaker())
+    connection.link.session = "replay"
+
+    commands = []
+    for (data, sent, response, received) in replay.exchanges():
+        command = ReplayCommand(data)
+        if command.command not in ("AUTH", "LOGOUT", "ENCRYPT"):
+            commands.append(command)
+
+    started = time()
+    batch = connection.batch(commands)
+    count = len([error for (_, _, error) in batch.as_completed(
+        connection.link.timeout * 2) if error is None])
+    elapsed = time() - started
+    connection.cut()
+    connection.link.join(1)
+    return (count, elapsed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay an AniDB packet capture")
+    parser.add_argument("capture")
+    parser.add_argument("--realtime", action="store_true",
+                        help="keep the recorded timing")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--link", action="store_true",
+                        help="send the commands through a Connection")
+    args = parser.parse_args(argv)
+
+    replay = CaptureReplay(args.capture, args.realtime, args.speed)
+    print "%i packets, %i commands" % (len(replay.packets),
+                                       len(replay.exchanges()))
+
+    for run in xrange(args.repeat):
+        metrics = MetricsRegistry()
+        if args.link:
+            (count, elapsed) = replay_link(replay, metrics)
+        else:
+            (count, elapsed) = replay_responses(replay, metrics)
+        print "Run %i: %i responses in %.3fs (%.0f/s)" % (
+            run + 1, count, elapsed, count / elapsed if elapsed else 0)
+        for line in metrics.format():
+            print "    %s" % line
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())